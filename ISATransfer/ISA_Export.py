@@ -1,12 +1,28 @@
 import omero
-from omero.gateway import BlitzGateway
+import numpy as np
 import pandas as pd
-import getpass
+import argparse
+import os
 import re
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.annotation_cache import AnnotationCache, DEFAULT_CACHE_PATH, fetch_map_annotations
+from shared.connection import open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import phase, profiled, written
 
-def fetch_metadata_from_project(conn, object_type, object_id):
-    """Retrieve metadata key-value pairs from an OMERO Project as a nested dictionary."""
+# ISA values are stored as one string of comma separated, single-quoted values.
+QUOTED_VALUE = re.compile(r"'(.*?)'")
+
+
+def fetch_metadata_from_project(conn, object_type, object_id, cache=None):
+    """Retrieve metadata key-value pairs from an OMERO Project as a nested dictionary.
+
+    Values of ISA namespaces are decoded once into lists of the quoted values, values
+    of other namespaces are kept as stored. With an AnnotationCache, only annotations
+    changed since the last export are read from the server.
+    """
     obj = conn.getObject(object_type, object_id)
     if not obj:
         print("Invalid Project ID.")
@@ -52,8 +68,10 @@ def fetch_metadata_from_project(conn, object_type, object_id):
         "ARC:ISA:ASSAY:ASSAY CONTACTS"
     ]
   
-    for ann in obj.listAnnotations():
-        namespace = ann.getNs() or "No Namespace"
+    with phase("fetch"):
+        annotations, _ = fetch_map_annotations(conn, object_type, [obj.getId()], cache)
+    for ns, kv_pairs in annotations[obj.getId()]:
+        namespace = ns or "No Namespace"
         metadata_target = None
         
         if namespace in isa_namespaces_investigation:
@@ -68,10 +86,12 @@ def fetch_metadata_from_project(conn, object_type, object_id):
         if namespace not in metadata_target:
             metadata_target[namespace] = {}
         
-        value = ann.getValue()
-        for item in value:
+        for item in kv_pairs:
             key = item[0]
-            val = list(item[1:])
+            if metadata_target is other_metadata:
+                val = list(item[1:])
+            else:
+                val = QUOTED_VALUE.findall(item[1])  # Extract values inside single quotes.
             metadata_target[namespace][key] = val
           
     #Sorting the metadata result dict based on isa_namespaces list. 
@@ -85,76 +105,102 @@ def fetch_metadata_from_project(conn, object_type, object_id):
 
 
 
+def isa_table(metadata):
+    """Lay out the namespaces of one ISA file as sheet rows: the namespace, then one row per key and its values."""
+    # Maximum length of columns. Count of number of values.
+    max_len = max((len(values) for kv_pairs in metadata.values() for values in kv_pairs.values()), default=0)
+    # One header row per namespace plus one row per key, padded with empty strings.
+    n_rows = sum(1 + len(kv_pairs) for kv_pairs in metadata.values())
+    table = np.full((n_rows, max_len + 1), "", dtype=object)
+    row = 0
+    with phase("transform"):
+        for namespace, kv_pairs in metadata.items():
+            # Get header value and add it as first column row.
+            table[row, 0] = namespace.split(":")[-1]
+            row += 1
+            #Add the keys and values.
+            for key, values in kv_pairs.items():
+                table[row, 0] = key
+                table[row, 1:len(values) + 1] = values
+                row += 1
+        return pd.DataFrame(table)
+
+
+def write_isa_workbook(df, filename):
+    """Write an ISA table to an isa.<type>.xlsx file, on a sheet named isa_<type>."""
+    with phase("write"), pd.ExcelWriter(filename) as writer:
+        df.to_excel(writer, sheet_name=os.path.basename(filename)[0:3]+ "_" +os.path.basename(filename)[4:-5], index=False, header=False)
+    written(filename)
+
+
+def write_extra_metadata(other_metadata, filename):
+    """Write the key-value pairs of non-ISA namespaces to filename."""
+    with phase("write"), pd.ExcelWriter(filename) as writer:
+        for namespace, kv_pairs in other_metadata.items():
+            df_other = pd.DataFrame([(key, ", ".join(value)) for key, value in kv_pairs.items()], columns=["Key", "Value"])
+            df_other.to_excel(writer, index=False, header=False)
+    written(filename)
+
+
 # Function to save metadata to excel
-def save_metadata_to_excel(metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata):
+def save_metadata_to_excel(metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata, output_dir="."):
     """Save all metadata categories into separate Excel files with a second sheet for other metadata."""
+    os.makedirs(output_dir, exist_ok=True)
     files = {
-        "isa.investigation.xlsx": metadata_investigation_Ordered,
-        "isa.study.xlsx": metadata_study_Ordered,
-        "isa.assay.xlsx": metadata_assay_Ordered
+        os.path.join(output_dir, "isa.investigation.xlsx"): metadata_investigation_Ordered,
+        os.path.join(output_dir, "isa.study.xlsx"): metadata_study_Ordered,
+        os.path.join(output_dir, "isa.assay.xlsx"): metadata_assay_Ordered
     }
 
     
     for filename, metadata in files.items():
         if metadata != {} :  # If the metadata is not empty, create an excel sheet.
-            # Maximum length of columns. Count of number of values.
-            max_len = max(len(re.findall(r"'(.*?)'",values[0])) for keys in metadata.values() for values in keys.values())
-            print("Maxium number of columns :", max_len)
-            with pd.ExcelWriter(filename) as writer:
-                rows = []
-                for namespace, kv_pairs in metadata.items():
-                    # Get header value and add it as first column row.
-                    header = namespace.split(":")[-1]
-                    rows.append([header] + [''] * max_len)
-                    #Add the keys and values.
-                    for key, values in kv_pairs.items():
-                        #Extract values inside single quotes as one sigle string.
-                        value_str = re.findall(r"'(.*?)'", values[0])
-                        # Pad the extracted value string with empty strings to match max_values.
-                        value_str += [''] * (max_len - len(value_str))
-                        # Create row with the key followed by value_str columns.
-                        row = [key] + value_str
-                        rows.append(row)
-                # Create a dataframe and save it to Excel.        
-                df = pd.DataFrame(rows)
-                print(df)
-                df.to_excel(writer, sheet_name=filename[0:3]+ "_" +filename[4:-5], index=False, header=False)   
+            df = isa_table(metadata)
+            print("Maxium number of columns :", df.shape[1] - 1)
+            print(df)
+            write_isa_workbook(df, filename)
             
         elif metadata == {}:
           print("No relevant metadata found for", filename)
 
     if other_metadata != {}:
-            # Maximum length of columns. Count of number of values. Count vaulues inside single quotes.
-            max_len = max(len(re.findall(r"'(.*?)'",values[0])) for keys in metadata_investigation_Ordered.values() for values in keys.values())
-            print(max_len)
-            with pd.ExcelWriter("ExtraMetadata.xlsx") as writer:  
-                for namespace, kv_pairs in other_metadata.items():
-                    df_other = pd.DataFrame([(key, ", ".join(value)) for key, value in kv_pairs.items()], columns=["Key", "Value"])
-                    df_other.to_excel(writer, index=False, header=False)
+            write_extra_metadata(other_metadata, os.path.join(output_dir, "ExtraMetadata.xlsx"))
             print('Additonal key-value pairs in the ExtaMetadata.xlsx')      
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the ISA metadata of an OMERO Project to Excel.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="read all annotations from the server, bypassing the local cache")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH, help="location of the annotation cache")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
 #Main function
 def main():
     """Main script execution."""
-    host = input("OMERO Host: ")
-    username = input("OMERO Username: ")
-    password = getpass.getpass("OMERO Password: ")
-     
-    conn = BlitzGateway(username, password, host=host)
-    if not conn.connect():
-        print("Error: Could not connect to OMERO. Check credentials.")
+    args = parse_args()
+    instrumentation.start(args)
+    conn = open_connection()
+    if conn is None:
         return None
     
     object_id = input("Enter OMERO Project ID: ")
     object_type = "Project"
      
     # Call the function and capture the return values
-    metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata = fetch_metadata_from_project(conn, object_type, object_id)
+    cache = None if args.no_cache else AnnotationCache(args.cache_path)
+    with profiled():
+        metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata = fetch_metadata_from_project(conn, object_type, object_id, cache)
     
-    conn.close()
+    if cache is not None:
+        cache.close()
+    close_connection(conn)
     
-    save_metadata_to_excel(metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata)
+    with profiled():
+        save_metadata_to_excel(metadata_investigation_Ordered, metadata_study_Ordered, metadata_assay_Ordered, other_metadata)
+    instrumentation.finish(args)
 
 if __name__ == "__main__":
     main()
@@ -4,17 +4,35 @@ Upload metadata from selected ISA Excel file to OMERO.
 
 This script prompts the user to:
 - Choose a file type: Investigation, Study, or Assay
-- Provide OMERO credentials (host, username, password)
+- Provide OMERO credentials (host, username, password), unless the previous session is still open
 - Enter Project ID (for Investigation/Study/Assay)
 - Extract metadata and upload it as key-value pairs to OMERO
+
+In sync mode only namespaces whose key-value pairs changed are written, so running
+the upload twice with the same file does not duplicate the annotations.
 '''
 
 import omero
-from omero.gateway import BlitzGateway, MapAnnotationWrapper
+import omero.model
+import omero.rtypes
+from omero.gateway import MapAnnotationWrapper
+import numpy as np
+import openpyxl
 import pandas as pd
+import argparse
+import hashlib
+import json
 import os
+import sys
 import getpass
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.concurrency import chunked
+from shared.connection import open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import phase, profiled
+
+
 def prompt_user_input(prompt, optional=True, hidden=False):
     """Helper function to get user input with optional hidden input."""
     while True:
@@ -26,33 +44,71 @@ def prompt_user_input(prompt, optional=True, hidden=False):
             return value
         print("This field is optional. Press Enter to skip.")
 
+# Cell texts the pandas Excel reader treats as missing (its default na_values), plus the
+# Excel error codes it also reads as missing. They end up as empty cells.
+NA_STRINGS = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+    "#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!",
+])
+
+# Rows processed per block while streaming a sheet, bounds the memory used.
+XLSX_CHUNK_ROWS = 10000
+
+def cell_text(value):
+    """Convert a cell value to the text pandas produces when parsing with dtype=str."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value)
+    return "" if text in NA_STRINGS else text
+
+def format_rows(rows):
+    """Strip, quote and join the value columns of a block of rows, column by column.
+
+    Returns the stripped first column and, per row, its values as a comma separated
+    string of quoted values with trailing empty values removed.
+    """
+    cells = pd.DataFrame(rows, dtype=object)
+    texts = pd.DataFrame({column: cells[column].map(cell_text).str.strip() for column in cells.columns})
+    keys = texts[0].tolist()
+    values = texts.iloc[:, 1:].to_numpy(dtype=object)
+    if values.shape[1] == 0:
+        return keys, [""] * len(keys)
+
+    filled = values != ""
+    # Every value is quoted, empty ones as "' '".
+    quoted = np.where(filled, "'" + values + "'", "' '")
+    # Only trailing empty values are removed, leading and middle ones are kept.
+    lengths = np.where(filled.any(axis=1), filled.shape[1] - np.argmax(filled[:, ::-1], axis=1), 0)
+    joined = [", ".join(row[:length]) for row, length in zip(quoted.tolist(), lengths.tolist())]
+    return keys, joined
+
 def extract_metadata_from_xlsx(file_path, file_type):
-    """Extracts metadata from an Excel (.xlsx) file using pandas."""
+    """Extracts metadata from an Excel (.xlsx) file.
+
+    The workbook is read in read-only, streaming mode and handled in blocks of rows.
+    Rows whose first column is upper case start a namespace, the following rows are
+    its keys with their formatted values.
+    """
     metadata = {}
     try:
-        xls = pd.ExcelFile(file_path)
-        for sheet_name in xls.sheet_names:
-            df = xls.parse(sheet_name, dtype=str, header=None).fillna("")
-            namespace = ""
-            
-            for _, row in df.iterrows():
-                if row.iloc[0].strip().isupper():  # Ensure first column with uppercase is included as namespace
-                    namespace = f"ARC:ISA:{file_type.upper()}:{row.iloc[0].strip()}"
-                    metadata[namespace] = {}
-                elif namespace:
-                    key = row.iloc[0].strip()
-                    values = [str(v).strip() if str(v).strip() else '' for v in row[1:]]
-                    
-                    # Format values
-                    if key:
-                        # columns as comma(,) seperated and quoted(('') seperated.
-                        formatted_values = [f"'{v}'" if v else "' '" for v in values]  # Ensure all values are quoted, even empty ones.
-                        #Remove only trailing '' in formatted_values. Peserves leading & middle '' with comma seperated.
-                        while formatted_values and formatted_values[-1] == "' '":
-                            formatted_values.pop()
-                        # Now join the formatted values into a comma-seperated string.    
-                        metadata[namespace][key] = ", ".join(formatted_values)  # join the comma seperated and quoted values.
-
+        with phase("parse"):
+            workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+            try:
+                for worksheet in workbook.worksheets:
+                    namespace = ""
+                    for rows in chunked(worksheet.iter_rows(values_only=True), XLSX_CHUNK_ROWS):
+                        keys, joined = format_rows(rows)
+                        for key, formatted_values in zip(keys, joined):
+                            if key.isupper():  # Ensure first column with uppercase is included as namespace
+                                namespace = f"ARC:ISA:{file_type.upper()}:{key}"
+                                metadata[namespace] = {}
+                            elif namespace and key:
+                                metadata[namespace][key] = formatted_values
+            finally:
+                workbook.close()
 
     except Exception as e:
         print(f"Error reading {file_path}: {e}")
@@ -70,23 +126,94 @@ def apply_metadata(obj, metadata, conn):
         map_ann = MapAnnotationWrapper(conn)
         map_ann.setNs(namespace)
         map_ann.setValue(list(values.items()))  # Convert dict to key-value list
-        map_ann.save()
-        obj.linkAnnotation(map_ann)  # Link annotation to the object
+        with phase("save"):
+            map_ann.save()
+            obj.linkAnnotation(map_ann)  # Link annotation to the object
+
+def kv_hash(kv_pairs):
+    """Hash an ordered list of key-value pairs to detect changed annotations."""
+    return hashlib.sha1(json.dumps([list(kv) for kv in kv_pairs]).encode("utf-8")).hexdigest()
+
+def sync_metadata(obj, metadata, conn, file_type, delete_removed=False):
+    """Synchronise metadata with the ISA annotations already on an OMERO object.
+
+    The existing annotations are read once and compared per namespace by hash.
+    Changed annotations are updated in place and new namespaces are created, together
+    in one saveArray call. With delete_removed, annotations of this file type whose
+    namespace is no longer in the file, and duplicates of a namespace, are deleted in
+    one more call. Nothing is written when nothing changed. Returns the counts printed
+    in the summary line.
+    """
+    prefix = f"ARC:ISA:{file_type.upper()}:"
+    existing = {}
+    duplicates = []
+    with phase("fetch"):
+        annotations = list(obj.listAnnotations())
+    for ann in annotations:
+        if not isinstance(ann, MapAnnotationWrapper) or not (ann.getNs() or "").startswith(prefix):
+            continue
+        if ann.getNs() in existing:
+            duplicates.append(ann.getId())
+        else:
+            existing[ann.getNs()] = ann
+
+    to_save = []
+    updated = created = unchanged = 0
+    link_class = getattr(omero.model, f"{obj.OMERO_CLASS}AnnotationLinkI")
+    for namespace, values in metadata.items():
+        kv_pairs = list(values.items())
+        named_values = [omero.model.NamedValue(key, value) for key, value in kv_pairs]
+        ann = existing.get(namespace)
+        if ann is None:
+            map_ann = omero.model.MapAnnotationI()
+            map_ann.setNs(omero.rtypes.rstring(namespace))
+            map_ann.setMapValue(named_values)
+            link = link_class()
+            link.setParent(obj._obj.__class__(obj.getId(), False))
+            link.setChild(map_ann)
+            to_save.append(link)
+            created += 1
+        elif kv_hash(ann.getValue()) != kv_hash(kv_pairs):
+            ann._obj.setMapValue(named_values)
+            to_save.append(ann._obj)
+            updated += 1
+        else:
+            unchanged += 1
+
+    write_calls = 0
+    if to_save:
+        with phase("save"):
+            conn.getUpdateService().saveArray(to_save, conn.SERVICE_OPTS)
+        write_calls += 1
+
+    to_delete = []
+    if delete_removed:
+        to_delete = [ann.getId() for namespace, ann in existing.items() if namespace not in metadata] + duplicates
+        if to_delete:
+            with phase("save"):
+                conn.deleteObjects("Annotation", to_delete, wait=True)
+            write_calls += 1
+
+    print(f"{unchanged} unchanged, {updated} updated, {created} created, {len(to_delete)} deleted "
+          f"annotations in {write_calls} write calls.")
+    return {"unchanged": unchanged, "updated": updated, "created": created, "deleted": len(to_delete)}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upload an ISA Excel file to an OMERO Project as key-value pairs.")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    instrumentation.start(args)
     print("\n--- OMERO Metadata Uploader ---")
     file_type = ""
     while file_type not in ["Investigation", "Study", "Assay"]:
         file_type = input("Select file to upload (Investigation, Study, Assay): ").strip()
     
-    host = prompt_user_input("OMERO Host: ", optional=False)
-    username = prompt_user_input("OMERO Username: ", optional=False)
-    password = prompt_user_input("OMERO Password: ", optional=False, hidden=True)
-
-    # Connect to OMERO
-    conn = BlitzGateway(username, password, host=host)
-    if not conn.connect():
-        print("Error: Could not connect to OMERO. Check credentials.")
+    # Connect to OMERO, reusing the session of the previous run when possible.
+    conn = open_connection()
+    if conn is None:
         return
     
     file_path = prompt_user_input(f"Path to isa.{file_type.lower()}.xlsx: ", optional=False)
@@ -105,14 +232,23 @@ def main():
         return
     
     if os.path.exists(file_path):
-        metadata = extract_metadata_from_xlsx(file_path, file_type)
-        apply_metadata(omero_object, metadata, conn)
+        with profiled():
+            metadata = extract_metadata_from_xlsx(file_path, file_type)
+        sync = input("Only upload changes to existing annotations? (Y/n): ").strip().lower() != "n"
+        if sync:
+            delete_removed = input(f"Delete {file_type} annotations that are not in the file? (y/N): ").strip().lower() == "y"
+            with profiled():
+                sync_metadata(omero_object, metadata, conn, file_type, delete_removed)
+        else:
+            with profiled():
+                apply_metadata(omero_object, metadata, conn)
         print(f"Metadata from {file_path} uploaded to OMERO {file_type} with ID {object_id}.")
     else:
         print("File not found. Exiting.")
     
     print("Upload complete!")
-    conn.close()
+    close_connection(conn)
+    instrumentation.finish(args)
 
 if __name__ == "__main__":
     main()
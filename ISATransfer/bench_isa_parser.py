@@ -0,0 +1,84 @@
+"""
+Benchmark of the ISA xlsx parser on a large synthetic assay sheet.
+
+Writes a workbook with one namespace header and many data-file rows, parses it with
+the previous pandas/iterrows parser and with ISA_Import.extract_metadata_from_xlsx,
+checks that both return the same metadata and prints the timings.
+
+    python bench_isa_parser.py --rows 100000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import openpyxl
+import pandas as pd
+from ISA_Import import extract_metadata_from_xlsx
+
+
+def write_synthetic_sheet(file_path, rows, columns):
+    """Write an assay sheet with rows keys of columns values, including blanks and NA texts."""
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet("isa_assay")
+    worksheet.append(["ASSAY DATA FILES"])
+    for i in range(rows):
+        values = [f" file_{i}_{c}.tif " if (i + c) % 7 else None for c in range(columns)]
+        if i % 11 == 0:
+            values[-1] = "NA"
+        if i % 13 == 0:
+            values[0] = float(i)
+        worksheet.append([f"Data File {i}"] + values + [None, ""])
+    workbook.save(file_path)
+
+
+def legacy_extract_metadata_from_xlsx(file_path, file_type):
+    """The pandas/iterrows parser ISA_Import used before, kept as the reference output."""
+    metadata = {}
+    xls = pd.ExcelFile(file_path)
+    for sheet_name in xls.sheet_names:
+        df = xls.parse(sheet_name, dtype=str, header=None).fillna("")
+        namespace = ""
+        for _, row in df.iterrows():
+            if row.iloc[0].strip().isupper():
+                namespace = f"ARC:ISA:{file_type.upper()}:{row.iloc[0].strip()}"
+                metadata[namespace] = {}
+            elif namespace:
+                key = row.iloc[0].strip()
+                values = [str(v).strip() if str(v).strip() else '' for v in row[1:]]
+                if key:
+                    formatted_values = [f"'{v}'" if v else "' '" for v in values]
+                    while formatted_values and formatted_values[-1] == "' '":
+                        formatted_values.pop()
+                    metadata[namespace][key] = ", ".join(formatted_values)
+    return metadata
+
+
+def timed(label, func, *args):
+    """Call func and print how long it took."""
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:<20} {time.perf_counter() - start:8.2f} s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000, help="number of data-file rows")
+    parser.add_argument("--columns", type=int, default=8, help="number of value columns")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_path = os.path.join(folder, "isa.assay.xlsx")
+        print(f"Writing {args.rows} x {args.columns} synthetic sheet...")
+        write_synthetic_sheet(file_path, args.rows, args.columns)
+        legacy = timed("pandas iterrows", legacy_extract_metadata_from_xlsx, file_path, "Assay")
+        streamed = timed("streaming parser", extract_metadata_from_xlsx, file_path, "Assay")
+
+    identical = json.dumps(legacy) == json.dumps(streamed)
+    print(f"Identical output: {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,77 +1,230 @@
 import omero
-from omero.gateway import BlitzGateway
+import omero.model
+import omero.sys
+from omero.rtypes import rstring
 import pandas as pd
-import getpass
+import argparse
+import os
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.annotation_cache import LINKED_ANNOTATIONS_QUERY, QUERY_BATCH
+from shared.concurrency import chunked
+from shared.connection import open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import phase, profiled
+from shared.paging import iter_children
+
+
+# Objects sent in one saveArray call.
+SAVE_BATCH = 500
+
+# Namespace of new annotations, the one OMERO.web uses for key-value pairs added by hand.
+CLIENT_NAMESPACE = "openmicroscopy.org/omero/client/mapAnnotation"
+
+# Columns written by Images_to_Excel that are image properties, not key-value pairs.
+ID_COLUMN = "ImageID"
+NAME_COLUMN = "ImageName"
+DIMENSION_COLUMNS = ["PixelSizeX", "PixelSizeY", "PixelSizeZ", "Channels", "TimeAxis"]
+
+
+def cell_text(value):
+    """Convert a cell value to annotation text, "" for blank cells."""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def read_sheet(file_path):
+    """Return the rows of an xlsx (all sheets), CSV or Parquet file as dicts of cell text."""
+    extension = os.path.splitext(file_path)[1].lower()
+    with phase("read"):
+        if extension == ".csv":
+            frames = [pd.read_csv(file_path, dtype=str, keep_default_na=False)]
+        elif extension == ".parquet":
+            frames = [pd.read_parquet(file_path)]
+        else:
+            # Tables longer than Excel's row limit continue on further sheets.
+            frames = list(pd.read_excel(file_path, sheet_name=None, dtype=str, keep_default_na=False).values())
+        rows = []
+        for df in frames:
+            columns = [str(column) for column in df.columns]
+            for values in df.itertuples(index=False, name=None):
+                rows.append({column: cell_text(value) for column, value in zip(columns, values)})
+    return rows
+
+
+def fetch_image_index(conn, dataset_id):
+    """Return {image ID: name} and {name: [image IDs]} of a dataset, read with paged projection queries."""
+    names = {}
+    by_name = {}
+    for image_id, name in iter_children(conn, "Dataset", dataset_id):
+        names[image_id] = name
+        by_name.setdefault(name, []).append(image_id)
+    return names, by_name
+
+
+def match_rows(rows, names, by_name):
+    """Map sheet rows to image IDs by the ImageID column, or else by ImageName.
+
+    Returns {image ID: {key: value}} with the non-blank key-value cells of each row, and
+    the counts of rows that matched no image or a name shared by several images. Later
+    rows for the same image override earlier ones.
+    """
+    skipped = set([ID_COLUMN, NAME_COLUMN] + DIMENSION_COLUMNS)
+    values_by_image = {}
+    unmatched = ambiguous = 0
+    for row in rows:
+        image_id = row.get(ID_COLUMN, "")
+        if image_id:
+            image_ids = [int(image_id)] if image_id.isdigit() and int(image_id) in names else []
+        else:
+            image_ids = by_name.get(row.get(NAME_COLUMN, ""), [])
+        if not image_ids:
+            unmatched += 1
+            continue
+        if len(image_ids) > 1:
+            ambiguous += 1
+            continue
+        kv_pairs = values_by_image.setdefault(image_ids[0], {})
+        kv_pairs.update((key, value) for key, value in row.items() if key not in skipped and value)
+    return values_by_image, unmatched, ambiguous
+
+
+def fetch_image_annotations(conn, image_ids):
+    """Fetch the MapAnnotations of many images, with their values, in a few paged queries.
+
+    Returns {image ID: [MapAnnotationI, ...]} in link order.
+    """
+    query = LINKED_ANNOTATIONS_QUERY.format(link="ImageAnnotationLink")
+    annotations = {image_id: [] for image_id in image_ids}
+    for batch in chunked(image_ids, QUERY_BATCH):
+        params = omero.sys.ParametersI()
+        params.addIds(batch)
+        with phase("fetch"):
+            links = conn.getQueryService().findAllByQuery(query, params, conn.SERVICE_OPTS)
+        for link in links:
+            annotations[link.getParent().getId().getValue()].append(link.getChild())
+    return annotations
+
+
+def diff_image(image_id, kv_pairs, annotations):
+    """Return the objects to save so that the image carries kv_pairs, and the pairs changed.
+
+    A key the image already has is changed in the annotation it is read from by
+    Images_to_Excel, the last one defining it. New keys are added to the image's
+    client-namespace annotation, which is created if there is none.
+    """
+    current = {}
+    owner = {}
+    for ann in annotations:
+        for nv in ann.getMapValue() or []:
+            current[nv.name] = nv.value
+            owner[nv.name] = ann
+    changes = {}    # annotation ID -> (annotation, {key: new value})
+    added = []
+    for key, value in kv_pairs.items():
+        if current.get(key) == value:
+            continue
+        if key in owner:
+            ann = owner[key]
+            changes.setdefault(ann.getId().getValue(), (ann, {}))[1][key] = value
+        else:
+            added.append(omero.model.NamedValue(key, value))
+
+    to_save = []
+    for ann, values in changes.values():
+        ann.setMapValue([omero.model.NamedValue(nv.name, values.get(nv.name, nv.value)) for nv in ann.getMapValue()])
+        to_save.append(ann)
+    if added:
+        client = next((ann for ann in annotations
+                       if ann.getNs() is not None and ann.getNs().getValue() == CLIENT_NAMESPACE), None)
+        if client is None:
+            map_ann = omero.model.MapAnnotationI()
+            map_ann.setNs(rstring(CLIENT_NAMESPACE))
+            map_ann.setMapValue(added)
+            link = omero.model.ImageAnnotationLinkI()
+            link.setParent(omero.model.ImageI(image_id, False))
+            link.setChild(map_ann)
+            to_save.append(link)
+        else:
+            client.setMapValue(list(client.getMapValue() or []) + added)
+            if client.getId().getValue() not in changes:
+                to_save.append(client)
+    return to_save, sum(len(values) for _, values in changes.values()) + len(added)
+
+
+def import_sheet(conn, dataset_id, file_path, dry_run=False):
+    """Write the key-value pairs of a sheet to the images of a dataset.
+
+    Rows are matched to images through one prefetched ID/name index, the existing
+    annotations of the matched images are fetched in bulk and only the changed pairs
+    are written, SAVE_BATCH objects per saveArray call. With dry_run nothing is
+    written. Returns the counts printed in the summary line.
+    """
+    rows = read_sheet(file_path)
+    names, by_name = fetch_image_index(conn, dataset_id)
+    values_by_image, unmatched, ambiguous = match_rows(rows, names, by_name)
+    annotations = fetch_image_annotations(conn, list(values_by_image))
+
+    to_save = []
+    changed_images = changed_pairs = 0
+    with phase("transform"):
+        for image_id, kv_pairs in values_by_image.items():
+            objects, pairs = diff_image(image_id, kv_pairs, annotations[image_id])
+            if objects:
+                to_save.extend(objects)
+                changed_images += 1
+                changed_pairs += pairs
+
+    write_calls = 0
+    if not dry_run:
+        update_service = conn.getUpdateService()
+        for batch in chunked(to_save, SAVE_BATCH):
+            with phase("save"):
+                update_service.saveArray(batch, conn.SERVICE_OPTS)
+            write_calls += 1
+
+    print(f"{len(rows)} rows: {len(values_by_image)} images matched, {unmatched} rows without a matching image, "
+          f"{ambiguous} rows with a name shared by several images.")
+    print(f"{changed_pairs} key-value pairs changed on {changed_images} images"
+          + (" (dry run, nothing written)." if dry_run else f" in {write_calls} write calls."))
+    return {"rows": len(rows), "matched": len(values_by_image), "unmatched": unmatched, "ambiguous": ambiguous,
+            "changed_images": changed_images, "changed_pairs": changed_pairs}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upload the key-value pairs of an image metadata sheet to OMERO.")
+    parser.add_argument("--dry-run", action="store_true", help="report the changes without writing them")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
 
-def extract_image_metadata(conn, dataset_id):
-    dataset = conn.getObject("Dataset", dataset_id)
-    if dataset is None:
-        print(f"Dataset with ID {dataset_id} not found.")
-        conn.close()
-        exit()
-    
-    data = [] # List to store all image metadata.
-  
-    for image in dataset.listChildren():
-        image_name = image.getName()
-        X = image.getSizeX()
-        Y = image.getSizeY()
-        Z = image.getSizeZ()
-        C = image.getSizeC()
-        T = image.getSizeT()
-
-        # Extract key-value paris (Map Annotations)
-        kv_pairs = {}
-        for ann in image.listAnnotations():
-          if isinstance(ann, omero.gateway.MapAnnotationWrapper):
-              for key, value in ann.getValue():
-                  kv_pairs[key] = value
-
-        # Create a dictionary for each image
-        row = {
-            "ImageName": image_name,
-            "PixelSizeX": X,
-            "PixelSizeY": Y,
-            "PixelSizeZ": Z,
-            "Channels": C,
-            "TimeAxis": T,
-        }
-        row.update(kv_pairs)  # Add dynamic key-value pairs
-
-        data.append(row)  # Append the structured dictionary
-
-    return data # Return a list of dictionaries 
-    
 
 def main():
-    # Prompt user to input OMERO credentials.
-    host = input("Enter OMERO host: ")
-    username = input("Enter OMERO username: ")
-    password = getpass.getpass("Enter OMERO password: ")
-  
-    # Connect to OMERO
-    conn = BlitzGateway(username, password, host=host)
-    if conn.connect():
-        print("Connected to OMERO successfully!")
-        return conn
-    else:
-        print("Failed to connect to OMERO. Check your credentials.")
+    args = parse_args()
+    instrumentation.start(args)
+
+    # Connect to OMERO, reusing the session of the previous run when possible.
+    conn = open_connection()
+    if conn is None:
+        return
 
-    # Get dataset ID.
+    # Get dataset ID and the sheet written by Images_to_Excel.
     dataset_id = input("Enter Dataset ID: ")
-    
-    # Extract the Image metatadata
-    data = extract_image_metadata(conn, dataset_id)
-    
-    # Save to excel
-    df = pd.DataFrame(data)
-    dataset = conn.getObject("Dataset", dataset_id)
-    dataset_name = dataset.getName().replace(" ","_")
-    excel_filename = f"{dataset_name}.xlsx"
-    df.to_excel(excel_filename, index=False)
-    print(f"Excel file saved successfully: {excel_filename}")
-    conn.close()
+    file_path = input("Enter path to the Excel, CSV or Parquet file: ")
+
+    if conn.getObject("Dataset", dataset_id) is None:
+        print(f"Dataset with ID {dataset_id} not found.")
+    elif not os.path.exists(file_path):
+        print(f"File {file_path} not found.")
+    else:
+        with profiled():
+            import_sheet(conn, dataset_id, file_path, args.dry_run)
+
+    close_connection(conn)
+    instrumentation.finish(args)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,169 @@
 import omero
-from omero.gateway import BlitzGateway
+import omero.sys
+from omero.rtypes import unwrap
 import pandas as pd
-import getpass
+import argparse
+import os
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.annotation_cache import AnnotationCache, DEFAULT_CACHE_PATH, fetch_map_annotations
+from shared.concurrency import map_ordered
+from shared.connection import ConnectionPool, open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import phase, profiled, written
+from shared.table_writer import TABLE_FORMATS, write_table
 
-def extract_image_metadata(conn, dataset_id):
+
+# Number of image IDs sent in one annotation query, keeps the "in (:ids)" list bounded.
+ANNOTATION_QUERY_BATCH = 1000
+
+# Name, ID and the five dimensions of every image in a dataset as one projection.
+IMAGE_DIMENSIONS_QUERY = (
+    "select i.id, i.name, p.sizeX, p.sizeY, p.sizeZ, p.sizeC, p.sizeT "
+    "from DatasetImageLink l join l.child i join i.pixels p "
+    "where l.parent.id = :id "
+    "order by l.id"
+)
+
+DIMENSION_COLUMNS = ["ImageID", "ImageName", "PixelSizeX", "PixelSizeY", "PixelSizeZ", "Channels", "TimeAxis"]
+
+
+def fetch_map_annotations_bulk(conn, image_ids, batch_size=ANNOTATION_QUERY_BATCH, cache=None, pool=None):
+    """Fetch the MapAnnotation key-value pairs of many images with paged queries.
+
+    With an AnnotationCache only new or changed annotations are read from the server.
+    With a ConnectionPool the pages are fetched concurrently on its connections.
+    Returns a dict of image ID -> {key: value} and the number of server round trips.
+    """
+    if pool is None:
+        with phase("fetch"):
+            annotations, round_trips = fetch_map_annotations(conn, "Image", image_ids, cache, batch_size)
+    else:
+        batches = [image_ids[start:start + batch_size] for start in range(0, len(image_ids), batch_size)]
+        annotations, round_trips = {}, 0
+        for _, (batch_annotations, batch_trips) in map_ordered(
+                lambda worker_conn, batch: fetch_annotation_page(worker_conn, batch, cache, batch_size),
+                batches, pool):
+            annotations.update(batch_annotations)
+            round_trips += batch_trips
+    kv_by_image = {}
+    for image_id, image_annotations in annotations.items():
+        kv_pairs = kv_by_image[image_id] = {}
+        for _, pairs in image_annotations:
+            kv_pairs.update(pairs)
+    return kv_by_image, round_trips
+
+
+def fetch_annotation_page(conn, image_ids, cache, batch_size):
+    """fetch_map_annotations for one page of images, timed as the fetch phase."""
+    with phase("fetch"):
+        return fetch_map_annotations(conn, "Image", image_ids, cache, batch_size)
+
+
+def fetch_image_dimensions(conn, dataset_id):
+    """Fetch ID, name and sizes of all images in a dataset with a single projection query.
+
+    Returns a DataFrame with one column per field instead of one ImageWrapper per image.
+    """
+    params = omero.sys.ParametersI()
+    params.addId(int(dataset_id))
+    with phase("fetch"):
+        rows = conn.getQueryService().projection(IMAGE_DIMENSIONS_QUERY, params, conn.SERVICE_OPTS)
+    dims = pd.DataFrame(unwrap(rows), columns=DIMENSION_COLUMNS)
+    size_columns = DIMENSION_COLUMNS[2:]
+    dims[size_columns] = dims[size_columns].astype("int64")
+    return dims
+
+
+def extract_image_table(conn, dataset_id, cache=None, pool=None):
+    """Build the image metadata table of a dataset as one DataFrame.
+
+    Fast path of extract_image_metadata: dimensions come from one projection query and
+    key-value pairs from the bulk annotation fetch, joined column-wise on the image ID.
+    Raises ValueError when the dataset does not exist.
+    """
+    if conn.getObject("Dataset", dataset_id) is None:
+        raise ValueError(f"Dataset with ID {dataset_id} not found.")
+
+    dims = fetch_image_dimensions(conn, dataset_id)
+    image_ids = dims["ImageID"].tolist()
+    kv_by_image, round_trips = fetch_map_annotations_bulk(conn, image_ids, cache=cache, pool=pool)
+    print(f"Metadata of {len(image_ids)} images fetched in {round_trips + 1} server round trips.")
+
+    with phase("transform"):
+        table = dims.set_index("ImageID")
+        annotations = pd.DataFrame(list(kv_by_image.values()), index=image_ids)
+        # Annotation keys named like a dimension column override it, as row.update() does.
+        shared = table.columns.intersection(annotations.columns)
+        table[shared] = annotations[shared].combine_first(table[shared])
+        table = table.join(annotations.drop(columns=shared))
+        return table.reset_index(drop=True)
+
+
+def iter_image_rows(conn, dataset_id, cache=None, page_size=ANNOTATION_QUERY_BATCH, names=None):
+    """Yield the metadata row of every image in a dataset, one page of images at a time.
+
+    Streaming counterpart of extract_image_table: each page costs one projection query
+    plus the bulk annotation fetch of its images, and only one page is held in memory.
+    With a names dict, the name of every image is also stored in it by image ID.
+    """
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addId(int(dataset_id))
+        params.page(offset, page_size)
+        with phase("fetch"):
+            dims = unwrap(conn.getQueryService().projection(IMAGE_DIMENSIONS_QUERY, params, conn.SERVICE_OPTS))
+        if not dims:
+            return
+        kv_by_image, _ = fetch_map_annotations_bulk(conn, [fields[0] for fields in dims], page_size, cache)
+        with phase("transform"):
+            rows = []
+            for image_id, *fields in dims:
+                if names is not None:
+                    names[image_id] = fields[0]
+                row = dict(zip(DIMENSION_COLUMNS[1:], fields))
+                row.update(kv_by_image[image_id])
+                rows.append(row)
+        yield from rows
+        if len(dims) < page_size:
+            return
+        offset += page_size
+
+
+def stream_image_table(conn, dataset_id, filename, fmt=None, cache=None, page_size=ANNOTATION_QUERY_BATCH):
+    """Write the image metadata table of a dataset to filename in constant memory.
+
+    fmt is "xlsx", "csv" or "parquet" and defaults to the extension of filename.
+    Images are read page_size at a time. Returns the number of images written.
+    """
+    count = write_table(iter_image_rows(conn, dataset_id, cache, page_size), filename, fmt)
+    written(filename)
+    print(f"Metadata of {count} images saved successfully: {filename}")
+    return count
+
+
+def extract_image_metadata(conn, dataset_id, bulk=True, cache=None):
+    """Collect name, dimensions and key-value pairs of every image in a dataset.
+
+    With bulk=True the annotations of all images are fetched with a few paged queries
+    instead of one listAnnotations() call per image. Both paths build the same rows.
+    Raises ValueError when the dataset does not exist.
+    """
     dataset = conn.getObject("Dataset", dataset_id)
     if dataset is None:
-        print(f"Dataset with ID {dataset_id} not found.")
-        conn.close()
-        exit()
+        raise ValueError(f"Dataset with ID {dataset_id} not found.")
     
     data = [] # List to store all image metadata.
+    images = list(dataset.listChildren())
+
+    if bulk:
+        kv_by_image, round_trips = fetch_map_annotations_bulk(conn, [image.getId() for image in images], cache=cache)
+    else:
+        round_trips = 0
   
-    for image in dataset.listChildren():
+    for image in images:
         image_name = image.getName()
         X = image.getSizeX()
         Y = image.getSizeY()
@@ -22,11 +172,15 @@ def extract_image_metadata(conn, dataset_id):
         T = image.getSizeT()
 
         # Extract key-value paris (Map Annotations)
-        kv_pairs = {}
-        for ann in image.listAnnotations():
-          if isinstance(ann, omero.gateway.MapAnnotationWrapper):
-              for key, value in ann.getValue():
-                  kv_pairs[key] = value
+        if bulk:
+            kv_pairs = kv_by_image[image.getId()]
+        else:
+            kv_pairs = {}
+            for ann in image.listAnnotations():
+              if isinstance(ann, omero.gateway.MapAnnotationWrapper):
+                  for key, value in ann.getValue():
+                      kv_pairs[key] = value
+            round_trips += 1
 
         # Create a dictionary for each image
         row = {
@@ -41,37 +195,120 @@ def extract_image_metadata(conn, dataset_id):
 
         data.append(row)  # Append the structured dictionary
 
+    print(f"Annotations of {len(images)} images fetched in {round_trips} server round trips.")
     return data # Return a list of dictionaries 
     
 
-def main():
-    # Prompt user to input OMERO credentials.
-    host = input("Enter OMERO host: ")
-    username = input("Enter OMERO username: ")
-    password = getpass.getpass("Enter OMERO password: ")
-  
-    # Connect to OMERO
-    conn = BlitzGateway(username, password, host=host)
-    if conn.connect():
-        print("Connected to OMERO successfully!")
-        return conn
+def export_project_tables(conn, project, cache=None, pool=None, folder_name=None, fmt="xlsx", stream=False,
+                          page_size=ANNOTATION_QUERY_BATCH):
+    """Write one <dataset name>.<fmt> per dataset of a project into folder_name.
+
+    The folder defaults to the project name. With a ConnectionPool the datasets are
+    read concurrently, one per worker connection, and the files are written in
+    dataset order. With stream=True (always for CSV and Parquet) every table is
+    written by stream_image_table. Returns the list of files written.
+    """
+    folder_name = folder_name or project.getName().replace(" ", "_")
+    os.makedirs(folder_name, exist_ok=True)
+    datasets = list(project.listChildren())
+
+    def table_filename(dataset):
+        return os.path.join(folder_name, f"{dataset.getName().replace(' ', '_')}.{fmt}")
+
+    if stream or fmt != "xlsx":
+        def export(worker_conn, dataset):
+            return stream_image_table(worker_conn, dataset.getId(), table_filename(dataset), fmt, cache, page_size)
+        with profiled():
+            if pool is None:
+                for dataset in datasets:
+                    export(conn, dataset)
+            else:
+                for _ in map_ordered(export, datasets, pool):
+                    pass
+        return [table_filename(dataset) for dataset in datasets]
+
+    if pool is None:
+        tables = ((dataset, extract_image_table(conn, dataset.getId(), cache)) for dataset in datasets)
     else:
-        print("Failed to connect to OMERO. Check your credentials.")
+        tables = map_ordered(lambda worker_conn, dataset: extract_image_table(worker_conn, dataset.getId(), cache),
+                             datasets, pool)
+    files = []
+    with profiled():
+        for dataset, df in tables:
+            excel_filename = table_filename(dataset)
+            save_table(df, excel_filename)
+            files.append(excel_filename)
+    return files
 
-    # Get dataset ID.
-    dataset_id = input("Enter Dataset ID: ")
-    
-    # Extract the Image metatadata
-    data = extract_image_metadata(conn, dataset_id)
-    
-    # Save to excel
-    df = pd.DataFrame(data)
-    dataset = conn.getObject("Dataset", dataset_id)
-    dataset_name = dataset.getName().replace(" ","_")   # OMERO dataset name. spaces replaced by underscore.
-    excel_filename = f"{dataset_name}.xlsx"
-    df.to_excel(excel_filename, index=False)
+
+def save_table(df, excel_filename):
+    """Write the image table to an Excel file."""
+    with phase("write"):
+        df.to_excel(excel_filename, index=False)
+    written(excel_filename)
     print(f"Excel file saved successfully: {excel_filename}")
-    conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the image metadata of an OMERO dataset to Excel.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="read all annotations from the server, bypassing the local cache")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH, help="location of the annotation cache")
+    parser.add_argument("--project", type=int, help="export every dataset of this Project ID")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent server connections (default: 1, sequential)")
+    parser.add_argument("--format", choices=TABLE_FORMATS, default="xlsx",
+                        help="output format; csv and parquet are for tables beyond Excel's row limit")
+    parser.add_argument("--stream", action="store_true",
+                        help="write the table page by page in constant memory (always on for csv and parquet)")
+    parser.add_argument("--page-size", type=int, default=ANNOTATION_QUERY_BATCH,
+                        help=f"images read per request when streaming (default: {ANNOTATION_QUERY_BATCH})")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrumentation.start(args)
+    cache = None if args.no_cache else AnnotationCache(args.cache_path)
+
+    # Connect to OMERO, reusing the session of the previous run when possible.
+    conn = open_connection()
+    if conn is None:
+        return
+    pool = ConnectionPool(conn, args.workers) if args.workers > 1 else None
+
+    if args.project is not None:
+        project = conn.getObject("Project", args.project)
+        if project:
+            export_project_tables(conn, project, cache, pool, fmt=args.format, stream=args.stream,
+                                  page_size=args.page_size)
+        else:
+            print(f"Project with ID {args.project} not found.")
+    else:
+        # Get dataset ID.
+        dataset_id = input("Enter Dataset ID: ")
+        dataset = conn.getObject("Dataset", dataset_id)
+        if dataset is None:
+            print(f"Dataset with ID {dataset_id} not found.")
+        elif args.stream or args.format != "xlsx":
+            with profiled():
+                stream_image_table(conn, dataset_id, f"{dataset.getName().replace(' ', '_')}.{args.format}",
+                                   args.format, cache, args.page_size)
+        else:
+            # Extract the Image metatadata
+            with profiled():
+                df = extract_image_table(conn, dataset_id, cache=cache, pool=pool)
+
+            # Save to excel
+            dataset_name = dataset.getName().replace(" ","_")   # OMERO dataset name. spaces replaced by underscore.
+            save_table(df, f"{dataset_name}.xlsx")
+    if pool is not None:
+        pool.close()
+    if cache is not None:
+        cache.close()
+    close_connection(conn)
+    instrumentation.finish(args)
 
 
 if __name__ == "__main__":
@@ -1,139 +1,475 @@
 import omero
 import omero.gateway
 import omero.model
-import getpass
+import omero.sys
+import argparse
+import base64
+import gzip
 import json
 import os
+import sys
+import time
+import numpy as np
+from shape_codecs import shape_to_dict
+from roi_measurements import ShapeColumns, measure_shapes, measurements_filename, parse_points, write_measurements
 
-def export_rois_as_json(image_id, conn):
-    """Export ROIs from the given OMERO image as a JSON string."""
-    roi_service = conn.getRoiService()
-    result = roi_service.findByImage(image_id, None)
-    roi_list = []
-    
-    for roi in result.rois:
-        shapes = []
-        for s in roi.copyShapes():
-            shape = {
-                "id": s.getId().getValue(),
-                "theT": s.getTheT().getValue() if s.getTheT() else None,
-                "theZ": s.getTheZ().getValue() if s.getTheZ() else None,
-                "fillColor": s.getFillColor().getValue() if s.getFillColor() else None,
-                "strokeColor": s.getStrokeColor().getValue() if s.getStrokeColor() else None,
-                "strokeWidth": s.getStrokeWidth().getValue() if s.getStrokeWidth() else None,
-                "fontFamily": s.getFontFamily().getValue() if s.getFontFamily() else None,
-                "fontSize": s.getFontSize().getValue() if s.getFontSize() else None,
-                "fontStyle": s.getFontStyle().getValue() if s.getFontStyle() else None,
-                "textValue": s.getTextValue().getValue() if s.getTextValue() else None
-            }
-            
-            if type(s) == omero.model.RectangleI:
-                shape.update({
-                    "type": "Rectangle",
-                    "x": s.getX().getValue(),
-                    "y": s.getY().getValue(),
-                    "width": s.getWidth().getValue(),
-                    "height": s.getHeight().getValue()
-                })
-            elif type(s) == omero.model.EllipseI:
-                shape.update({
-                    "type": "Ellipse",
-                    "x": s.getX().getValue(),
-                    "y": s.getY().getValue(),
-                    "radiusX": s.getRadiusX().getValue(),
-                    "radiusY": s.getRadiusY().getValue()
-                })
-            elif type(s) == omero.model.PointI:
-                shape.update({
-                    "type": "Point",
-                    "x": s.getX().getValue(),
-                    "y": s.getY().getValue()
-                })
-            elif type(s) == omero.model.LineI:
-                shape.update({
-                    "type": "Line",
-                    "x1": s.getX1().getValue(),
-                    "x2": s.getX2().getValue(),
-                    "y1": s.getY1().getValue(),
-                    "y2": s.getY2().getValue(),
-                    "markerStart": s.getMarkerStart().getValue() if s.getMarkerStart() is not None else None,
-                    "markerEnd": s.getMarkerEnd().getValue() if s.getMarkerEnd() is not None else None
-                })
-            elif type(s) == omero.model.MaskI:
-                shape.update({
-                    "type": "Mask",
-                    "x": s.getX().getValue(),
-                    "y": s.getY().getValue(),
-                    "width": s.getWidth().getValue(),
-                    "height": s.getHeight().getValue()
-                })
-            elif type(s) == omero.model.PolygonI:
-                shape.update({
-                    "type": "Polygon",
-                    "points": s.getPoints().getValue()
-                })
-            elif type(s) == omero.model.PolylineI:
-                shape.update({
-                    "type": "Polyline",                    
-                    "points": s.getPoints().getValue()
-                })
-            elif type(s) == omero.model.LabelI:
-                shape.update({
-                    "type": "Label",
-                    "text": s.getTextValue().getValue(),
-                    "x": s.getX().getValue() if s.getX() else 0,
-                    "y": s.getY().getValue() if s.getY() else 0,
-                })
-            shapes.append(shape)
-        
-        roi_list.append({
-            "ROI_ID": roi.getId().getValue(),
-            "Shapes": shapes
-        })
-        print(roi_list)
-    
-    return json.dumps({"Image_ID": image_id, "ROIs": roi_list}, indent=4)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.concurrency import chunked, map_ordered
+from shared.connection import ConnectionPool, open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import phase, profiled, written
+from shared.paging import DEFAULT_PAGE_SIZE, fetch_roi_counts, find_filtered_rois, iter_children, iter_rois
+from shared import roi_filters
+
+# ROIs of many images with all their shapes, loaded in one query per batch of images.
+ROIS_FOR_IMAGES_QUERY = (
+    "select distinct r from Roi r "
+    "left outer join fetch r.shapes "
+    "where r.image.id in (:ids) "
+    "order by r.id"
+)
+
+# Columns of the .npz export. Numeric values are stored as float64 with NaN for None,
+# text values as unicode with "" for None. Polygon/Polyline vertices go in points_xy.
+NPZ_NUMERIC_COLUMNS = ["id", "theT", "theZ", "fillColor", "strokeColor", "strokeWidth", "fontSize",
+                       "x", "y", "width", "height", "radiusX", "radiusY", "x1", "y1", "x2", "y2"]
+NPZ_TEXT_COLUMNS = ["fontFamily", "fontStyle", "textValue", "text", "markerStart", "markerEnd"]
+
+def roi_to_dict(roi):
+    """Convert an OMERO ROI and its shapes to the exported dictionary."""
+    return {
+        "ROI_ID": roi.getId().getValue(),
+        "Shapes": [shape_to_dict(s) for s in roi.copyShapes()]
+    }
+
+def iter_roi_dicts(image_id, conn, page_size=DEFAULT_PAGE_SIZE, roi_filter=None):
+    """Yield the exported dictionary of every ROI of the given OMERO image, page_size ROIs per request.
+
+    With a RoiFilter only the matching ROIs and shapes are fetched.
+    """
+    yield from transform_rois(iter_rois(conn, image_id, page_size, roi_filter))
+
+def transform_rois(rois):
+    """Yield the exported dictionary of every loaded ROI."""
+    for roi in rois:
+        with phase("transform"):
+            roi_dict = roi_to_dict(roi)
+        yield roi_dict
+
+def export_rois_as_json(image_id, conn, roi_filter=None):
+    """Export ROIs from the given OMERO image as a JSON string, only those passing roi_filter if given."""
+    roi_list = list(iter_roi_dicts(image_id, conn, roi_filter=roi_filter))
+    print(f"{len(roi_list)} ROIs read from Image ID {image_id}")
+    return rois_to_json(image_id, roi_list)
+
+class MaskSidecar:
+    """Raw file of mask bytes next to a JSON export, created when the first bytes are written.
+
+    If no mask has bytes the file is never created, and close() removes one left over
+    from an earlier export under the same name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._file = None
+
+    def write(self, mask_bytes):
+        """Append mask bytes and return their offset in the file."""
+        if self._file is None:
+            self._file = open(self.path, "wb")
+        offset = self.size
+        self._file.write(mask_bytes)
+        self.size += len(mask_bytes)
+        return offset
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+def encode_mask_bytes(roi_dict, sidecar=None):
+    """Replace the raw bytes of Mask shapes by a JSON-serializable form.
+
+    With a MaskSidecar the bytes are appended to it and the shape keeps
+    maskOffset/maskLength, otherwise (or if there are no bytes) they are stored
+    inline as base64.
+    """
+    for shape in roi_dict["Shapes"]:
+        mask_bytes = shape.get("bytes")
+        if not isinstance(mask_bytes, bytes):
+            continue
+        if sidecar is None or not mask_bytes:
+            shape["bytes"] = base64.b64encode(mask_bytes).decode("ascii")
+        else:
+            del shape["bytes"]
+            shape["maskOffset"] = sidecar.write(mask_bytes)
+            shape["maskLength"] = len(mask_bytes)
+    return roi_dict
+
+def write_rois_ndjson(image_id, roi_dicts, filename):
+    """Stream ROI dictionaries to an NDJSON file, one ROI per line.
+
+    The first line holds {"Image_ID": ...}. A filename ending in .gz is gzip-compressed.
+    Only one ROI is held in memory at a time. Returns the number of ROIs written.
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    roi_count = 0
+    with opener(filename, "wt", encoding="utf-8") as ndjson_file:
+        ndjson_file.write(json.dumps({"Image_ID": image_id}) + "\n")
+        for roi_dict in roi_dicts:
+            with phase("serialize"):
+                line = json.dumps(encode_mask_bytes(roi_dict), separators=(",", ":")) + "\n"
+            with phase("write"):
+                ndjson_file.write(line)
+            roi_count += 1
+    return roi_count
+
+def write_rois_npz(image_id, roi_dicts, filename):
+    """Write ROI dictionaries to a compressed columnar .npz file.
+
+    Every shape is one row: its ROI ID, a type code and one column per attribute.
+    Polygon and Polyline vertices are stored in one flat float64 array with per-shape
+    offsets instead of as points strings, so they read back exactly as exported; the
+    packed bytes of masks likewise go in one flat uint8 array. Returns the number of
+    ROIs written.
+    """
+    roi_ids, shape_roi_ids, shape_types, points_strings, mask_chunks = [], [], [], [], []
+    numeric = {column: [] for column in NPZ_NUMERIC_COLUMNS}
+    text = {column: [] for column in NPZ_TEXT_COLUMNS}
+    for roi_dict in roi_dicts:
+        roi_ids.append(roi_dict["ROI_ID"])
+        for shape in roi_dict["Shapes"]:
+            shape_roi_ids.append(roi_dict["ROI_ID"])
+            shape_types.append(shape.get("type", ""))
+            points_strings.append(shape.get("points") or "")
+            mask_chunks.append(np.frombuffer(shape.get("bytes") or b"", dtype=np.uint8))
+            for column, values in numeric.items():
+                value = shape.get(column)
+                values.append(np.nan if value is None else value)
+            for column, values in text.items():
+                values.append(shape.get(column) or "")
+
+    with phase("serialize"):
+        type_names, type_codes = np.unique(np.array(shape_types, dtype=str), return_inverse=True)
+        points_xy, points_offsets = parse_points(points_strings)
+        mask_offsets = np.zeros(len(mask_chunks) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in mask_chunks], out=mask_offsets[1:])
+        mask_bytes = np.concatenate(mask_chunks) if mask_chunks else np.zeros(0, dtype=np.uint8)
+        columns = {f"num_{column}": np.array(values, dtype=np.float64) for column, values in numeric.items()}
+        columns.update({f"text_{column}": np.array(values, dtype=str) for column, values in text.items()})
+    with phase("write"):
+        np.savez_compressed(
+            filename,
+            image_id=np.array(image_id, dtype=np.int64),
+            roi_ids=np.array(roi_ids, dtype=np.int64),
+            shape_roi_ids=np.array(shape_roi_ids, dtype=np.int64),
+            type_names=type_names,
+            type_codes=type_codes.astype(np.uint8),
+            points_xy=points_xy,
+            points_offsets=points_offsets,
+            mask_bytes=mask_bytes,
+            mask_offsets=mask_offsets,
+            **columns
+        )
+    return len(roi_ids)
+
+def rois_to_json(image_id, roi_list, sidecar=None):
+    """Serialize the ROI dictionaries of one image as the exported JSON string.
+
+    Mask bytes go to the MaskSidecar if one is given, otherwise inline as base64. The
+    document only names the sidecar if bytes were written to it.
+    """
+    roi_list = [encode_mask_bytes(roi_dict, sidecar) for roi_dict in roi_list]
+    document = {"Image_ID": image_id}
+    if sidecar is not None and sidecar.size:
+        document["Mask_File"] = os.path.basename(sidecar.path)
+    document["ROIs"] = roi_list
+    return json.dumps(document, indent=4)
+
+def fetch_rois_for_images(conn, image_ids, batch_size, page_size=DEFAULT_PAGE_SIZE, roi_filter=None):
+    """Fetch the ROIs and shapes of many images, batch_size images per query.
+
+    Yields (image_id, rois) for every image, in the order of image_ids. The ROIs of
+    each batch are counted first so that no query loads more than page_size ROIs:
+    the batch is split where needed, and images with more ROIs than that are paged
+    through findByImage and yielded as a lazy iterator. With a RoiFilter only the
+    matching ROIs and shapes are counted and fetched.
+    """
+    for batch in chunked(image_ids, batch_size):
+        counts = fetch_roi_counts(conn, batch, roi_filter)
+        group, group_rois = [], 0
+        for image_id in batch:
+            count = counts.get(image_id, 0)
+            if count > page_size:
+                yield from fetch_roi_group(conn, group, roi_filter)
+                group, group_rois = [], 0
+                yield image_id, iter_rois(conn, image_id, page_size, roi_filter)
+                continue
+            if group and group_rois + count > page_size:
+                yield from fetch_roi_group(conn, group, roi_filter)
+                group, group_rois = [], 0
+            group.append(image_id)
+            group_rois += count
+        yield from fetch_roi_group(conn, group, roi_filter)
+
+def fetch_roi_group(conn, image_ids, roi_filter=None):
+    """Fetch the ROIs and shapes of a few images with one query; yields (image_id, rois)."""
+    if not image_ids:
+        return
+    if roi_filter:
+        rois = find_filtered_rois(conn, "image.id", image_ids, roi_filter)
+    else:
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids)
+        with phase("fetch"):
+            rois = conn.getQueryService().findAllByQuery(ROIS_FOR_IMAGES_QUERY, params, conn.SERVICE_OPTS)
+    rois_by_image = {image_id: [] for image_id in image_ids}
+    for roi in rois:
+        rois_by_image[roi.getImage().getId().getValue()].append(roi)
+    for image_id in image_ids:
+        yield image_id, rois_by_image[image_id]
+
+def fetch_roi_dicts(conn, image_ids, page_size=DEFAULT_PAGE_SIZE, roi_filter=None):
+    """Fetch the ROI dictionaries of a few images, in one query unless they have more than page_size ROIs.
+
+    Returns [(image_id, [roi dicts])] in the order of image_ids.
+    """
+    return [(image_id, list(transform_rois(rois)))
+            for image_id, rois in fetch_rois_for_images(conn, image_ids, len(image_ids), page_size, roi_filter)]
+
+def export_rois_concurrent(pool, jobs, batch_size=None, fmt="json", page_size=DEFAULT_PAGE_SIZE, measurements=None,
+                           roi_filter=None):
+    """Export the ROIs of many images with the worker connections of pool.
+
+    jobs is a list of (folder_name, {image_id: image_name}). The images are fetched in
+    batches of batch_size (default 1) on the workers while the files are written here,
+    in the same order as the sequential export. Each worker holds the ROIs of its batch
+    in memory, so images with very many ROIs are better exported without workers.
+    """
+    batch_size = batch_size or 1
+    batches = []
+    for folder_name, image_names in jobs:
+        os.makedirs(folder_name, exist_ok=True)
+        image_ids = list(image_names)
+        for start in range(0, len(image_ids), batch_size):
+            batches.append((folder_name, image_names, image_ids[start:start + batch_size]))
+
+    with profiled():
+        for (folder_name, image_names, _), image_rois in map_ordered(
+                lambda conn, batch: fetch_roi_dicts(conn, batch[2], page_size, roi_filter), batches, pool):
+            for image_id, roi_dicts in image_rois:
+                filename = os.path.join(folder_name, f"{image_names[image_id]}_ID{image_id}_rois.{fmt}")
+                write_roi_file(image_id, roi_dicts, filename, fmt, measurements)
+
+def dataset_image_names(conn, dataset, page_size=DEFAULT_PAGE_SIZE):
+    """Return {image_id: image name with spaces replaced} of the dataset's images."""
+    return {image_id: name.replace(" ", "_")
+            for image_id, name in iter_children(conn, "Dataset", dataset.getId(), page_size)}
+
+def iter_dataset_rois(conn, dataset, batch_size=None, page_size=DEFAULT_PAGE_SIZE, roi_filter=None):
+    """Yield (image_id, image name, ROI dictionaries) for every image of the dataset.
+
+    The images are listed page_size at a time and every ROI iterator is lazy, so only
+    one page of images and one page of ROIs are held in memory.
+    """
+    for page in chunked(iter_children(conn, "Dataset", dataset.getId(), page_size), batch_size or page_size):
+        names = {image_id: name.replace(" ", "_") for image_id, name in page}
+        if batch_size:
+            for image_id, rois in fetch_rois_for_images(conn, list(names), batch_size, page_size, roi_filter):
+                yield image_id, names[image_id], transform_rois(rois)
+        else:
+            for image_id, name in names.items():
+                yield image_id, name, iter_roi_dicts(image_id, conn, page_size, roi_filter)
+
+def export_dataset_rois(conn, dataset, folder_name, batch_size=None, fmt="json", pool=None,
+                        page_size=DEFAULT_PAGE_SIZE, measurements=None, roi_filter=None):
+    """Write one *_ID{id}_rois.<fmt> file per image of the dataset into folder_name.
+
+    Without batch_size every image is fetched with its own findByImage calls. With a
+    batch_size the ROIs of that many images are fetched per request and split per image.
+    Images and ROIs are read page_size at a time. fmt "ndjson" or "ndjson.gz" streams
+    the ROIs of each image instead of building one JSON document, "npz" writes the
+    columnar binary format. With a ConnectionPool the images are fetched concurrently on
+    its connections. With measurements ("csv" or "parquet") the geometry table of each
+    image is written next to its ROI file. With a RoiFilter only the matching ROIs and
+    shapes are fetched from the server. Returns the elapsed wall-clock time in seconds.
+    """
+    start_time = time.perf_counter()
+    if pool is not None:
+        export_rois_concurrent(pool, [(folder_name, dataset_image_names(conn, dataset, page_size))],
+                               batch_size, fmt, page_size, measurements, roi_filter)
+        return time.perf_counter() - start_time
+
+    os.makedirs(folder_name, exist_ok=True)
+    with profiled():
+        for image_id, image_name, roi_dicts in iter_dataset_rois(conn, dataset, batch_size, page_size, roi_filter):
+            filename = os.path.join(folder_name, f"{image_name}_ID{image_id}_rois.{fmt}")
+            write_roi_file(image_id, roi_dicts, filename, fmt, measurements)
+
+    return time.perf_counter() - start_time
+
+def export_project_rois(conn, project, folder_name, batch_size=None, fmt="json", pool=None,
+                        page_size=DEFAULT_PAGE_SIZE, measurements=None, roi_filter=None):
+    """Export the ROIs of every dataset of a project into folder_name/<dataset name>.
+
+    With a ConnectionPool the images of all datasets share one queue of work, so the
+    workers stay busy across dataset boundaries. Returns the elapsed wall-clock time in seconds.
+    """
+    start_time = time.perf_counter()
+    datasets = list(project.listChildren())
+    if pool is not None:
+        jobs = [(os.path.join(folder_name, dataset.getName().replace(" ", "_")),
+                 dataset_image_names(conn, dataset, page_size))
+                for dataset in datasets]
+        export_rois_concurrent(pool, jobs, batch_size, fmt, page_size, measurements, roi_filter)
+    else:
+        for dataset in datasets:
+            export_dataset_rois(conn, dataset, os.path.join(folder_name, dataset.getName().replace(" ", "_")),
+                                batch_size, fmt, page_size=page_size, measurements=measurements,
+                                roi_filter=roi_filter)
+    print(f"{len(datasets)} datasets of Project {project.getId()} exported.")
+    return time.perf_counter() - start_time
+
+def write_roi_file(image_id, roi_dicts, filename, fmt="json", measurements=None):
+    """Write the ROIs of one image in the given format and report the file name.
+
+    With measurements ("csv" or "parquet") the shapes are also gathered as they are
+    written and their geometry table is saved as <name>_ID<id>_measurements.<format>.
+    """
+    if measurements:
+        columns = ShapeColumns()
+        roi_dicts = columns.collect(roi_dicts)
+    if fmt == "json":
+        roi_list = list(roi_dicts)
+        # Mask bytes are kept out of the JSON in a raw sidecar file next to it.
+        sidecar = MaskSidecar(f"{filename}.masks.bin")
+        try:
+            with phase("serialize"):
+                json_output = rois_to_json(image_id, roi_list, sidecar)
+        finally:
+            sidecar.close()
+        with phase("write"), open(filename, "w") as json_file:
+            json_file.write(json_output)
+    elif fmt == "npz":
+        write_rois_npz(image_id, roi_dicts, filename)
+    else:
+        write_rois_ndjson(image_id, roi_dicts, filename)
+    written(filename, f"{filename}.masks.bin")
+    print(f"ROIs exported to {filename}")
+    if measurements:
+        table_file = measurements_filename(filename, measurements)
+        with phase("transform"):
+            table = measure_shapes(image_id, columns)
+        with phase("write"):
+            write_measurements(table, table_file)
+        written(table_file)
+        print(f"{len(table)} shape measurements written to {table_file}")
+
+def compare_export_timing(conn, dataset, folder_name, batch_size, fmt="json", pool=None, page_size=DEFAULT_PAGE_SIZE,
+                          measurements=None, roi_filter=None, repeats=3):
+    """Export the dataset with the per-image and the batched path and print both timings.
+
+    The two paths take turns going first, repeats times each, and the best time of each
+    is reported, so neither profits alone from the server and disk caches the other warmed.
+    """
+    per_image_times, batched_times = [], []
+    for repeat in range(repeats):
+        runs = [(per_image_times, None), (batched_times, batch_size)]
+        for times, run_batch_size in runs if repeat % 2 == 0 else reversed(runs):
+            times.append(export_dataset_rois(conn, dataset, folder_name, run_batch_size, fmt, pool, page_size,
+                                             measurements, roi_filter))
+    per_image, batched = min(per_image_times), min(batched_times)
+    print(f"Per-image export: {per_image:.2f} s (best of {repeats})")
+    print(f"Batched export ({batch_size} images per request): {batched:.2f} s (best of {repeats})")
+    if batched > 0:
+        print(f"Speed-up: {per_image / batched:.1f}x")
+
+def prompt_format():
+    """Ask for the output format of the ROI files."""
+    fmt = ""
+    while fmt not in ["json", "ndjson", "ndjson.gz", "npz"]:
+        fmt = input("Output format (json, ndjson, ndjson.gz, npz) [json]: ").strip().lower() or "json"
+    return fmt
+
+def prompt_batch_size():
+    """Ask how many images to fetch per request, None for one request per image."""
+    batch_size = input("Images per request (Enter for one request per image): ").strip()
+    return int(batch_size) if batch_size.isdigit() else None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the ROIs of an OMERO image, dataset or project.")
+    parser.add_argument("--project", type=int, help="export every dataset of this Project ID")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent server connections (default: 1, sequential)")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f"images and ROIs read per request, bounds memory (default: {DEFAULT_PAGE_SIZE})")
+    parser.add_argument("--measurements", choices=["csv", "parquet"],
+                        help="also write the area, perimeter, centroid and bounding box of every shape")
+    roi_filters.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
 
 def main():
-    host = input("Enter OMERO host: ")
-    username = input("Enter OMERO username: ")
-    password = getpass.getpass("Enter OMERO password: ")
-    
-    conn = omero.gateway.BlitzGateway(username, password, host=host)
-    conn.connect()
-    
-    user_input = input("Enter OMERO Dataset ID or Image ID: ")
+    args = parse_args()
+    instrumentation.start(args)
+    conn = open_connection()
+    if conn is None:
+        return
+    pool = ConnectionPool(conn, args.workers) if args.workers > 1 else None
+    roi_filter = roi_filters.from_args(args)
+    if roi_filter:
+        print(f"Exporting {roi_filter.describe()}.")
+
+    user_input = input("Enter OMERO Dataset ID or Image ID: ") if args.project is None else ""
     
-    if user_input.isdigit():
+    if args.project is not None:
+        project = conn.getObject("Project", args.project)
+        if project:
+            fmt = prompt_format()
+            batch_size = prompt_batch_size()
+            elapsed = export_project_rois(conn, project, project.getName().replace(" ", "_"), batch_size, fmt, pool,
+                                          args.page_size, args.measurements, roi_filter)
+            print(f"Project exported in {elapsed:.2f} s")
+        else:
+            print("Invalid ID. No Project found.")
+    elif user_input.isdigit():
         dataset = conn.getObject("Dataset", int(user_input))
         if dataset:
             folder_name = dataset.getName().replace(" ", "_")
-            os.makedirs(folder_name, exist_ok=True)
-            
-            for image in dataset.listChildren():
-                image_id = image.getId()
-                image_name = image.getName().replace(" ", "_")
-                json_output = export_rois_as_json(image_id, conn)
-                filename = os.path.join(folder_name, f"{image_name}_ID{image_id}_rois.json")
-                with open(filename, "w") as json_file:
-                    json_file.write(json_output)
-                print(f"ROIs exported to {filename}")
+            fmt = prompt_format()
+            batch_size = prompt_batch_size()
+            compare = batch_size and input("Compare timing with the per-image export? (y/N): ").strip().lower() == "y"
+
+            if compare:
+                compare_export_timing(conn, dataset, folder_name, batch_size, fmt, pool, args.page_size,
+                                      args.measurements, roi_filter)
+            else:
+                elapsed = export_dataset_rois(conn, dataset, folder_name, batch_size, fmt, pool, args.page_size,
+                                              args.measurements, roi_filter)
+                print(f"Dataset exported in {elapsed:.2f} s")
         else:
             image = conn.getObject("Image", int(user_input))
-            if image:
+            if image and pool is not None:
+                print("--workers applies to Dataset and Project exports; export a single Image without it.")
+            elif image:
                 image_id = image.getId()
                 image_name = image.getName().replace(" ", "_")
-                json_output = export_rois_as_json(image_id, conn)
-                filename = f"{image_name}_ID{image_id}_rois.json"
-                with open(filename, "w") as json_file:
-                    json_file.write(json_output)
-                print(f"ROIs exported to {filename}")
+                fmt = prompt_format()
+                filename = f"{image_name}_ID{image_id}_rois.{fmt}"
+                with profiled():
+                    write_roi_file(image_id, iter_roi_dicts(image_id, conn, args.page_size, roi_filter), filename, fmt,
+                                   args.measurements)
             else:
                 print("Invalid ID. No Dataset or Image found.")
     else:
         print("Invalid input. Please enter a numeric Dataset or Image ID.")
     
-    conn.close()
+    if pool is not None:
+        pool.close()
+    close_connection(conn)
+    instrumentation.finish(args)
 
 if __name__ == "__main__":
     main()
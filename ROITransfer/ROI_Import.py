@@ -2,98 +2,390 @@ import omero
 import omero.gateway
 import omero.model
 import omero.rtypes
+import omero.sys
+import argparse
+import collections
+import gzip
 import json
-import getpass
+import os
+import re
+import sys
+import threading
+import time
+import numpy as np
+from shape_codecs import decode_shape, shape_key, shape_to_dict
 
-def import_rois_from_json(json_file, conn):
-    """Import ROIs from a JSON file into OMERO if the Image ID matches."""
-    with open(json_file, 'r') as file:
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.concurrency import chunked, map_ordered
+from shared.connection import ConnectionPool, open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import iter_phase, phase, profiled
+from shared.paging import DEFAULT_PAGE_SIZE, iter_rois
+
+# Files written by ROI_Export, named <image name>_ID<image id>_rois.<format>.
+ROI_FILE_PATTERN = re.compile(r"_ID(\d+)_rois\.(json|ndjson|ndjson\.gz|npz)$")
+# Which of a set of image IDs exist, checked for a whole folder in a few queries.
+EXISTING_IMAGES_QUERY = "select i.id from Image i where i.id in (:ids)"
+QUERY_BATCH = 1000
+# Checkpoint journal of a folder import, one JSON line per started, finished or failed file.
+JOURNAL_NAME = ".roi_import_journal.ndjson"
+
+def roi_from_dict(roi_data, image):
+    """Build an unsaved OMERO ROI with its shapes from an exported ROI dictionary.
+
+    image is the omero.model.ImageI the ROI is attached to; an unloaded one will do.
+    """
+    roi = omero.model.RoiI()
+    roi.setImage(image)
+
+    for shape_data in roi_data["Shapes"]:
+        shape = decode_shape(shape_data)
+        if shape:
+            roi.addShape(shape)
+
+    return roi
+
+def iter_rois_from_ndjson(ndjson_file):
+    """Stream an NDJSON ROI export, one ROI per line, optionally gzip-compressed.
+
+    Returns the Image ID from the header line and a generator over the ROI dictionaries,
+    so the file is never loaded into memory as a whole. The generator opens the file
+    again, so nothing is left open if it is never iterated.
+    """
+    opener = gzip.open if ndjson_file.endswith(".gz") else open
+    with opener(ndjson_file, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+
+    def roi_dicts():
+        with opener(ndjson_file, "rt", encoding="utf-8") as file:
+            file.readline()  # the header
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header["Image_ID"], roi_dicts()
+
+def format_points(points_xy, points_offsets):
+    """Rebuild the OMERO points string of every shape from flat vertex arrays."""
+    xy = points_xy.astype(str)
+    vertices = np.char.add(np.char.add(xy[:, 0], ","), xy[:, 1]).tolist()
+    return [" ".join(vertices[start:end]) for start, end in zip(points_offsets[:-1], points_offsets[1:])]
+
+def iter_rois_from_npz(npz_file):
+    """Read a columnar .npz ROI export written by ROI_Export.write_rois_npz.
+
+    Returns the Image ID and a generator over ROI dictionaries in the JSON layout.
+    Points strings are rebuilt for all shapes at once from the vertex arrays.
+    """
+    with np.load(npz_file) as data:
+        image_id = int(data["image_id"])
+        roi_ids = data["roi_ids"].tolist()
+        shape_roi_ids = data["shape_roi_ids"].tolist()
+        type_names = data["type_names"].tolist()
+        shape_types = [type_names[code] for code in data["type_codes"].tolist()]
+        points = format_points(data["points_xy"], data["points_offsets"])
+        mask_bytes = data["mask_bytes"]
+        mask_offsets = data["mask_offsets"].tolist()
+        numeric = {key[4:]: data[key].tolist() for key in data.files if key.startswith("num_")}
+        text = {key[5:]: data[key].tolist() for key in data.files if key.startswith("text_")}
+    # Attributes every exported shape carries, even when they are None.
+    common = ["id", "theT", "theZ", "fillColor", "strokeColor", "strokeWidth",
+              "fontFamily", "fontSize", "fontStyle", "textValue"]
+    integer_columns = {"id", "theT", "theZ", "fillColor", "strokeColor"}
+
+    shapes_by_roi = {}
+    for row, (roi_id, shape_type) in enumerate(zip(shape_roi_ids, shape_types)):
+        shape = {"type": shape_type}
+        for column, values in numeric.items():
+            value = values[row]
+            if value != value:  # NaN marks None
+                value = None
+            elif column in integer_columns:
+                value = int(value)
+            if value is not None or column in common:
+                shape[column] = value
+        for column, values in text.items():
+            if values[row] or column in common:
+                shape[column] = values[row] or None
+        if shape_type in ("Polygon", "Polyline"):
+            shape["points"] = points[row]
+        elif shape_type == "Mask" and mask_offsets[row] < mask_offsets[row + 1]:
+            shape["bytes"] = mask_bytes[mask_offsets[row]:mask_offsets[row + 1]]
+        shapes_by_roi.setdefault(roi_id, []).append(shape)
+
+    def roi_dicts():
+        for roi_id in roi_ids:
+            yield {"ROI_ID": roi_id, "Shapes": shapes_by_roi.get(roi_id, [])}
+
+    return image_id, roi_dicts()
+
+def read_roi_file(roi_file):
+    """Return the Image ID and an iterable of ROI dictionaries of an exported ROI file."""
+    if roi_file.endswith((".ndjson", ".ndjson.gz")):
+        return iter_rois_from_ndjson(roi_file)
+    if roi_file.endswith(".npz"):
+        return iter_rois_from_npz(roi_file)
+    with open(roi_file, 'r') as file:
         data = json.load(file)
-    
-    image_id = data["Image_ID"]
+    mask_file = os.path.join(os.path.dirname(roi_file), data.get("Mask_File", ""))
+    if "Mask_File" in data and os.path.isfile(mask_file) and os.path.getsize(mask_file) > 0:
+        return data["Image_ID"], iter_rois_with_mask_file(data["ROIs"], mask_file)
+    return data["Image_ID"], data["ROIs"]
+
+def iter_rois_with_mask_file(roi_list, mask_file):
+    """Attach the bytes of each mask from the memory-mapped sidecar file to its shape.
+
+    Shapes get views into the mapping; the bytes are only copied when the mask is built.
+    """
+    masks = np.memmap(mask_file, dtype=np.uint8, mode="r")
+    for roi_data in roi_list:
+        for shape_data in roi_data["Shapes"]:
+            if "maskOffset" in shape_data:
+                start = shape_data["maskOffset"]
+                shape_data["bytes"] = masks[start:start + shape_data["maskLength"]]
+        yield roi_data
+
+def fetch_shape_index(conn, image_id, page_size=DEFAULT_PAGE_SIZE):
+    """Count the shapes already on an image by shape_key, reading its ROIs once, page by page."""
+    index = collections.Counter()
+    for roi in iter_rois(conn, image_id, page_size):
+        with phase("transform"):
+            index.update(key for key in (shape_key(shape_to_dict(s)) for s in roi.copyShapes()) if key is not None)
+    return index
+
+def iter_new_rois(roi_dicts, index, counts):
+    """Yield the ROIs that are not already on the image according to the shape index.
+
+    A ROI is already there when every one of its shapes is in the index; those shapes
+    are then taken out of the index, so a ROI repeated in the file is only skipped as
+    often as it exists on the server. ROIs without importable shapes are skipped too.
+    The number of skipped ROIs is added up in counts["skipped"].
+    """
+    for roi_data in roi_dicts:
+        keys = collections.Counter(key for key in map(shape_key, roi_data["Shapes"]) if key is not None)
+        if all(index[key] >= count for key, count in keys.items()):
+            index.subtract(keys)
+            counts["skipped"] += 1
+            continue
+        yield roi_data
+
+def save_rois(conn, image_id, roi_dicts, batch_size=None, dedup=False, page_size=DEFAULT_PAGE_SIZE):
+    """Save ROI dictionaries on an image; see import_rois_from_json for batch_size and dedup.
+
+    The image is not looked up, it must exist. Returns the number of ROIs saved and the
+    number skipped by dedup.
+    """
+    image = omero.model.ImageI(image_id, False)
+    counts = {"skipped": 0}
+    if dedup:
+        roi_dicts = iter_new_rois(roi_dicts, fetch_shape_index(conn, image_id, page_size), counts)
+    roi_service = conn.getUpdateService()
+    roi_count = 0
+    if batch_size:
+        for chunk in chunked(roi_dicts, batch_size):
+            with phase("transform"):
+                rois = [roi_from_dict(roi_data, image) for roi_data in chunk]
+            with phase("save"):
+                roi_service.saveArray(rois, conn.SERVICE_OPTS)
+            roi_count += len(chunk)
+    else:
+        for roi_data in roi_dicts:
+            with phase("transform"):
+                roi = roi_from_dict(roi_data, image)
+            with phase("save"):
+                roi_service.saveAndReturnObject(roi)
+            roi_count += 1
+    return roi_count, counts["skipped"]
+
+def import_rois_from_json(json_file, conn, batch_size=None, dedup=False, page_size=DEFAULT_PAGE_SIZE):
+    """Import ROIs from a JSON, NDJSON or .npz file into OMERO if the Image ID matches.
+
+    Without batch_size every ROI is saved with its own saveAndReturnObject call. With a
+    batch_size the ROIs are saved in chunks of that size, one saveArray call per chunk,
+    which commits each chunk in one transaction and does not send the saved graph back.
+    With dedup the shapes already on the image are read first and ROIs whose shapes
+    are all there are not uploaded again, so re-importing an unchanged file writes
+    nothing. Returns the number of ROIs imported, or None if the image is not in OMERO.
+    """
+    with phase("read"):
+        image_id, roi_dicts = read_roi_file(json_file)
+    roi_dicts = iter_phase(roi_dicts, "read")
     image = conn.getObject("Image", image_id)
     
     if not image:
         print(f"Image with ID {image_id} not found in OMERO.")
-        return
+        return None
     
-    roi_service = conn.getUpdateService()
-    for roi_data in data["ROIs"]:
-        roi = omero.model.RoiI()
-        roi.setImage(image._obj)
-        
-        for shape_data in roi_data["Shapes"]:
-            shape = None
-            if shape_data["type"] == "Ellipse":
-                shape = omero.model.EllipseI()
-                shape.setX(omero.rtypes.rdouble(shape_data["x"]))
-                shape.setY(omero.rtypes.rdouble(shape_data["y"]))
-                shape.setRadiusX(omero.rtypes.rdouble(shape_data["radiusX"]))
-                shape.setRadiusY(omero.rtypes.rdouble(shape_data["radiusY"]))
-            elif shape_data["type"] == "Polygon":
-                shape = omero.model.PolygonI()
-                shape.setPoints(omero.rtypes.rstring(shape_data["points"]))
-            elif shape_data["type"] == "Polyline":
-                shape = omero.model.PolylineI()
-                shape.setPoints(omero.rtypes.rstring(shape_data["points"]))
-            elif shape_data["type"] == "Label":
-                shape = omero.model.LabelI()
-                shape.setTextValue(omero.rtypes.rstring(shape_data["text"]))
-                shape.setX(omero.rtypes.rdouble(shape_data["x"]))
-                shape.setY(omero.rtypes.rdouble(shape_data["y"]))
-            elif shape_data["type"] == "Rectangle":
-                shape = omero.model.RectangleI()
-                shape.setX(omero.rtypes.rdouble(shape_data["x"]))
-                shape.setY(omero.rtypes.rdouble(shape_data["y"]))
-                shape.setWidth(omero.rtypes.rdouble(shape_data["width"]))
-                shape.setHeight(omero.rtypes.rdouble(shape_data["height"]))
-            elif shape_data["type"] == "Line":
-                shape = omero.model.LineI()
-                shape.setX1(omero.rtypes.rdouble(shape_data["x1"]))
-                shape.setY1(omero.rtypes.rdouble(shape_data["y1"]))
-                shape.setX2(omero.rtypes.rdouble(shape_data["x2"]))
-                shape.setY2(omero.rtypes.rdouble(shape_data["y2"]))
-            elif shape_data["type"] == "Mask":
-                shape = omero.model.MaskI()
-                shape.setX(omero.rtypes.rdouble(shape_data["x"]))
-                shape.setY(omero.rtypes.rdouble(shape_data["y"]))
-                shape.setWidth(omero.rtypes.rdouble(shape_data["width"]))
-                shape.setHeight(omero.rtypes.rdouble(shape_data["height"]))
-            
-            if shape:
-                shape.setTheZ(omero.rtypes.rint(shape_data["theZ"]))
-                shape.setTheT(omero.rtypes.rint(shape_data["theT"]))
-                
-                if "fillColor" in shape_data and shape_data["fillColor"] is not None:
-                    shape.setFillColor(omero.rtypes.rint(shape_data["fillColor"]))
-                if "strokeColor" in shape_data and shape_data["strokeColor"] is not None:
-                    shape.setStrokeColor(omero.rtypes.rint(shape_data["strokeColor"]))
-                if "strokeWidth" in shape_data and shape_data["strokeWidth"] is not None:
-                    shape.setStrokeWidth(omero.model.LengthI(shape_data["strokeWidth"], omero.model.enums.UnitsLength.PIXEL))
-                if "fontFamily" in shape_data:
-                    shape.setFontFamily(omero.rtypes.rstring(shape_data["fontFamily"]))
-                if "fontSize" in shape_data and shape_data["fontSize"] is not None:
-                    shape.setFontSize(omero.model.LengthI(shape_data["fontSize"], omero.model.enums.UnitsLength.POINT))
-                if "fontStyle" in shape_data:
-                    shape.setFontStyle(omero.rtypes.rstring(shape_data["fontStyle"]))
-                
-                roi.addShape(shape)
-        
-        roi_service.saveAndReturnObject(roi)
+    start_time = time.perf_counter()
+    with profiled():
+        roi_count, skipped = save_rois(conn, image_id, roi_dicts, batch_size, dedup, page_size)
+
+    elapsed = time.perf_counter() - start_time
     print(f"ROIs successfully imported for Image ID {image_id}.")
+    if dedup:
+        print(f"{skipped} ROIs already on the image were skipped.")
+    if elapsed > 0:
+        print(f"{roi_count} ROIs in {elapsed:.2f} s ({roi_count / elapsed:.1f} ROIs/s)")
+    return roi_count
+
+def find_roi_files(folder):
+    """Return [(path, image ID)] of the ROI files in folder and its subfolders, sorted by path."""
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            match = ROI_FILE_PATTERN.search(name)
+            if match:
+                files.append((os.path.join(root, name), int(match.group(1))))
+    return sorted(files)
+
+def fetch_existing_image_ids(conn, image_ids):
+    """Return the set of the given image IDs that exist in OMERO."""
+    image_ids = sorted(image_ids)
+    existing = set()
+    for chunk in chunked(image_ids, QUERY_BATCH):
+        params = omero.sys.ParametersI()
+        params.addIds(chunk)
+        with phase("fetch"):
+            rows = conn.getQueryService().projection(EXISTING_IMAGES_QUERY, params, conn.SERVICE_OPTS)
+        existing.update(row[0].getValue() for row in rows)
+    return existing
+
+def file_signature(path):
+    """Size and modification time of a file, to notice files changed since they were imported."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class ImportJournal:
+    """Append-only JSON-lines journal of a folder import, safe to write from worker threads.
+
+    Every line is flushed to disk before the call returns, so after an interruption the
+    journal tells which files were imported completely and which were only started.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.entries = {}   # file -> last entry
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line cut short by the interruption
+                    self.entries[entry["file"]] = entry
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, file, status, **fields):
+        entry = dict(file=file, status=status, **fields)
+        with self._lock:
+            self.entries[file] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def import_roi_folder(conn, folder, batch_size=None, dedup=False, pool=None, journal_path=None, restart=False,
+                      page_size=DEFAULT_PAGE_SIZE):
+    """Import every ROI file of a folder written by ROI_Export, resuming an interrupted run.
+
+    The image IDs are taken from the file names and checked in bulk; a file whose
+    Image_ID differs from the ID in its name is recorded as failed. Files whose import
+    finished according to the journal (default folder/.roi_import_journal.ndjson) and
+    that have not changed since are skipped. Files that were started but not finished,
+    or changed, are imported with dedup so that ROIs already saved are not duplicated.
+    With a ConnectionPool the files are imported concurrently, one per worker
+    connection. Returns the counts printed in the summary line.
+    """
+    files = find_roi_files(folder)
+    existing = fetch_existing_image_ids(conn, {image_id for _, image_id in files})
+    journal = ImportJournal(journal_path or os.path.join(folder, JOURNAL_NAME), restart)
+    counts = collections.Counter()
+    jobs = []
+    for path, image_id in files:
+        key = os.path.relpath(path, folder)
+        entry = journal.entries.get(key)
+        if image_id not in existing:
+            print(f"Image with ID {image_id} of {key} not found in OMERO.")
+            counts["missing"] += 1
+        elif entry and entry["status"] == "done" and entry.get("signature") == file_signature(path):
+            counts["resumed"] += 1
+        else:
+            jobs.append((path, key, image_id, dedup or entry is not None))
+
+    def run(worker_conn, job):
+        path, key, image_id, job_dedup = job
+        journal.record(key, "started")
+        try:
+            with phase("read"):
+                file_image_id, roi_dicts = read_roi_file(path)
+            if file_image_id != image_id:
+                raise ValueError(f"Image_ID {file_image_id} in the file does not match ID {image_id} in its name")
+            roi_count, skipped = save_rois(worker_conn, image_id, iter_phase(roi_dicts, "read"),
+                                           batch_size, job_dedup, page_size)
+        except Exception as error:
+            journal.record(key, "failed", error=f"{type(error).__name__}: {error}")
+            return None
+        journal.record(key, "done", signature=file_signature(path), rois=roi_count, skipped=skipped)
+        return roi_count
+
+    start_time = time.perf_counter()
+    results = map_ordered(run, jobs, pool) if pool is not None else ((job, run(conn, job)) for job in jobs)
+    try:
+        with profiled():
+            for index, (job, roi_count) in enumerate(results):
+                if roi_count is None:
+                    counts["failed"] += 1
+                    print(f"[{index + 1}/{len(jobs)}] {job[1]}: {journal.entries[job[1]]['error']}")
+                else:
+                    counts["imported"] += 1
+                    counts["rois"] += roi_count
+                    print(f"[{index + 1}/{len(jobs)}] {job[1]}: {roi_count} ROIs")
+    finally:
+        journal.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{counts['imported']} files imported ({counts['rois']} ROIs), {counts['resumed']} already imported, "
+          f"{counts['failed']} failed, {counts['missing']} without an image in {elapsed:.2f} s.")
+    return {key: counts[key] for key in ("imported", "rois", "resumed", "failed", "missing")}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import ROIs from a JSON, NDJSON or .npz file, or a folder of them, into OMERO.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="skip ROIs whose shapes are already on the image, e.g. when re-running an import")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent server connections for a folder (default: 1, sequential)")
+    parser.add_argument("--journal", help=f"checkpoint journal of a folder import (default: <folder>/{JOURNAL_NAME})")
+    parser.add_argument("--restart", action="store_true", help="ignore the journal and import the whole folder again")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
 
 def main():
-    host = input("Enter OMERO server hostname: ")
-    username = input("Enter OMERO username: ")
-    password = getpass.getpass("Enter OMERO password: ")
-    json_file = input("Enter path to JSON file: ")
-    
-    conn = omero.gateway.BlitzGateway(username, password, host=host)
-    conn.connect()
+    args = parse_args()
+    instrumentation.start(args)
+    conn = open_connection()
+    if conn is None:
+        return
+    json_file = input("Enter path to JSON, NDJSON or .npz file, or a folder of them: ")
+    batch_size = input("ROIs per save call (Enter to save one by one): ").strip()
+    batch_size = int(batch_size) if batch_size.isdigit() else None
     
-    import_rois_from_json(json_file, conn)
+    if os.path.isdir(json_file):
+        pool = ConnectionPool(conn, args.workers) if args.workers > 1 else None
+        try:
+            import_roi_folder(conn, json_file, batch_size, args.dedup, pool, args.journal, args.restart)
+        finally:
+            if pool is not None:
+                pool.close()
+    else:
+        import_rois_from_json(json_file, conn, batch_size, args.dedup)
     
-    conn.close()
+    close_connection(conn)
+    instrumentation.finish(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,124 @@
+"""
+Micro-benchmark of the per-shape export overhead.
+
+Builds synthetic OMERO shapes in memory (no server needed) and converts them to the
+exported dictionaries, once with the previous chain of type() comparisons and once
+with the shape codecs, and decodes the dictionaries back into shapes. omero-py must be installed.
+
+    python bench_shape_codecs.py --count 1000000
+"""
+
+import argparse
+import time
+import omero
+import omero.model
+from omero.rtypes import rdouble, rint, rstring
+from shape_codecs import shape_to_dict, decode_shape
+
+
+def make_shapes(count):
+    """Create count shapes cycling through Rectangle, Ellipse, Point, Line and Polygon."""
+    shapes = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            s = omero.model.RectangleI()
+            s.setX(rdouble(i)); s.setY(rdouble(i)); s.setWidth(rdouble(10)); s.setHeight(rdouble(5))
+        elif kind == 1:
+            s = omero.model.EllipseI()
+            s.setX(rdouble(i)); s.setY(rdouble(i)); s.setRadiusX(rdouble(3)); s.setRadiusY(rdouble(4))
+        elif kind == 2:
+            s = omero.model.PointI()
+            s.setX(rdouble(i)); s.setY(rdouble(i))
+        elif kind == 3:
+            s = omero.model.LineI()
+            s.setX1(rdouble(0)); s.setX2(rdouble(i)); s.setY1(rdouble(0)); s.setY2(rdouble(i))
+        else:
+            s = omero.model.PolygonI()
+            s.setPoints(rstring("1,1 10,1 10,10 1,10"))
+        s.setId(omero.rtypes.rlong(i))
+        s.setTheZ(rint(0))
+        s.setTheT(rint(0))
+        s.setStrokeColor(rint(-1))
+        shapes.append(s)
+    return shapes
+
+
+def legacy_shape_to_dict(s):
+    """The type() comparison chain ROI_Export used before the codecs, kept for comparison."""
+    shape = {
+        "id": s.getId().getValue(),
+        "theT": s.getTheT().getValue() if s.getTheT() else None,
+        "theZ": s.getTheZ().getValue() if s.getTheZ() else None,
+        "fillColor": s.getFillColor().getValue() if s.getFillColor() else None,
+        "strokeColor": s.getStrokeColor().getValue() if s.getStrokeColor() else None,
+        "strokeWidth": s.getStrokeWidth().getValue() if s.getStrokeWidth() else None,
+        "fontFamily": s.getFontFamily().getValue() if s.getFontFamily() else None,
+        "fontSize": s.getFontSize().getValue() if s.getFontSize() else None,
+        "fontStyle": s.getFontStyle().getValue() if s.getFontStyle() else None,
+        "textValue": s.getTextValue().getValue() if s.getTextValue() else None
+    }
+    if type(s) == omero.model.RectangleI:
+        shape.update({"type": "Rectangle", "x": s.getX().getValue(), "y": s.getY().getValue(),
+                      "width": s.getWidth().getValue(), "height": s.getHeight().getValue()})
+    elif type(s) == omero.model.EllipseI:
+        shape.update({"type": "Ellipse", "x": s.getX().getValue(), "y": s.getY().getValue(),
+                      "radiusX": s.getRadiusX().getValue(), "radiusY": s.getRadiusY().getValue()})
+    elif type(s) == omero.model.PointI:
+        shape.update({"type": "Point", "x": s.getX().getValue(), "y": s.getY().getValue()})
+    elif type(s) == omero.model.LineI:
+        shape.update({"type": "Line", "x1": s.getX1().getValue(), "x2": s.getX2().getValue(),
+                      "y1": s.getY1().getValue(), "y2": s.getY2().getValue(),
+                      "markerStart": s.getMarkerStart().getValue() if s.getMarkerStart() is not None else None,
+                      "markerEnd": s.getMarkerEnd().getValue() if s.getMarkerEnd() is not None else None})
+    elif type(s) == omero.model.MaskI:
+        shape.update({"type": "Mask", "x": s.getX().getValue(), "y": s.getY().getValue(),
+                      "width": s.getWidth().getValue(), "height": s.getHeight().getValue()})
+    elif type(s) == omero.model.PolygonI:
+        shape.update({"type": "Polygon", "points": s.getPoints().getValue()})
+    elif type(s) == omero.model.PolylineI:
+        shape.update({"type": "Polyline", "points": s.getPoints().getValue()})
+    elif type(s) == omero.model.LabelI:
+        shape.update({"type": "Label", "text": s.getTextValue().getValue(),
+                      "x": s.getX().getValue() if s.getX() else 0,
+                      "y": s.getY().getValue() if s.getY() else 0})
+    return shape
+
+
+def timed(func, items):
+    """Apply func to every item; return the results and the elapsed time."""
+    start = time.perf_counter()
+    results = [func(item) for item in items]
+    return results, time.perf_counter() - start
+
+
+def report(label, times, count):
+    """Print the best of the timings of one conversion."""
+    best = min(times)
+    print(f"{label:<24} {best:8.2f} s  {best / count * 1e6:6.2f} us/shape  (best of {len(times)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000000, help="number of synthetic shapes")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="runs of each conversion, the best is reported (default: 5)")
+    args = parser.parse_args()
+
+    print(f"Building {args.count} synthetic shapes...")
+    shapes = make_shapes(args.count)
+    # The two encoders take turns going first so neither always runs on a warmer heap.
+    legacy_times, codec_times, decode_times = [], [], []
+    for repeat in range(args.repeats):
+        runs = [(legacy_times, legacy_shape_to_dict), (codec_times, shape_to_dict)]
+        for times, func in runs if repeat % 2 == 0 else reversed(runs):
+            dicts, elapsed = timed(func, shapes)
+            times.append(elapsed)
+        decode_times.append(timed(decode_shape, dicts)[1])
+    report("Legacy type() chain", legacy_times, args.count)
+    report("Codec shape_to_dict", codec_times, args.count)
+    report("Codec decode", decode_times, args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Per-shape geometry table of exported ROIs: area, perimeter, centroid and bounding box.
+
+The shapes of an image are gathered into columns once and measured with whole-array
+NumPy operations per shape type; the vertices of all Polygons and Polylines are
+decoded from their points strings in one pass. Rectangle, Ellipse, Point, Line,
+Polygon and Polyline shapes are measured, in pixels; other types are left out.
+Shape transforms are not applied.
+
+ROI_Export writes the table next to each ROI file with --measurements csv|parquet.
+For files that were already exported:
+
+    python roi_measurements.py dataset/*_rois.npz --format parquet
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+MEASURED_TYPES = ("Rectangle", "Ellipse", "Point", "Line", "Polygon", "Polyline")
+GEOMETRY_COLUMNS = ("x", "y", "width", "height", "radiusX", "radiusY", "x1", "y1", "x2", "y2", "theZ", "theT")
+MEASUREMENT_COLUMNS = ["image_id", "roi_id", "shape_id", "type", "theZ", "theT", "area", "perimeter",
+                       "centroid_x", "centroid_y", "bbox_x_min", "bbox_y_min", "bbox_x_max", "bbox_y_max"]
+
+
+def parse_points(points_strings):
+    """Decode OMERO points strings ("x1,y1 x2,y2 ...") in one pass.
+
+    Returns the vertices as a (N, 2) float64 array and the int64 offsets of each
+    shape's first vertex, with a final entry equal to N.
+    """
+    counts = np.fromiter((points.count(",") for points in points_strings), dtype=np.int64,
+                         count=len(points_strings))
+    offsets = np.zeros(len(points_strings) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    values = np.array(" ".join(points_strings).replace(",", " ").split(), dtype=np.float64)
+    if len(values) != 2 * offsets[-1]:
+        raise ValueError("Unsupported points format, expected 'x1,y1 x2,y2 ...'.")
+    return values.reshape(-1, 2), offsets
+
+
+class ShapeColumns:
+    """The measured shapes of one image as columns, gathered while the ROIs stream past."""
+
+    def __init__(self):
+        self.roi_ids = []
+        self.shape_ids = []
+        self.types = []
+        self.points = []    # points strings of the Polygons and Polylines, in shape order
+        self.geometry = {column: [] for column in GEOMETRY_COLUMNS}
+
+    def __len__(self):
+        return len(self.types)
+
+    def add(self, roi_id, shape):
+        shape_type = shape.get("type")
+        if shape_type not in MEASURED_TYPES:
+            return
+        self.roi_ids.append(roi_id)
+        self.shape_ids.append(shape.get("id"))
+        self.types.append(shape_type)
+        if shape_type in ("Polygon", "Polyline"):
+            self.points.append(shape.get("points") or "")
+        for column, values in self.geometry.items():
+            value = shape.get(column)
+            values.append(np.nan if value is None else value)
+
+    def collect(self, roi_dicts):
+        """Yield the ROI dictionaries unchanged, adding their shapes to the columns."""
+        for roi_dict in roi_dicts:
+            for shape in roi_dict["Shapes"]:
+                self.add(roi_dict["ROI_ID"], shape)
+            yield roi_dict
+
+
+def measure_polygons(points, closed):
+    """Measure Polygons (closed) and Polylines (open) given their points strings.
+
+    Returns area, perimeter, centroid x/y and bounding box arrays, one entry per shape.
+    Polygon centroids are area centroids, Polyline centroids the length-weighted
+    centre of their segments; degenerate shapes fall back to the mean of the vertices.
+    """
+    count = len(points)
+    xy, offsets = parse_points(points)
+    x, y = xy[:, 0], xy[:, 1]
+    vertices = np.diff(offsets)
+    owner = np.repeat(np.arange(count), vertices)
+    nonempty = vertices > 0
+    starts, lasts = offsets[:-1][nonempty], offsets[1:][nonempty] - 1
+
+    # Every vertex is joined to the next one, the last to the first of its shape.
+    following = np.arange(len(x)) + 1
+    following[lasts] = starts
+    next_x, next_y = x[following], y[following]
+    closing = np.zeros(len(x), dtype=bool)
+    closing[lasts] = True
+    in_outline = closed[owner] | ~closing
+    segment = np.hypot(next_x - x, next_y - y) * in_outline
+    cross = (x * next_y - next_x * y) * closed[owner]
+
+    twice_area = np.bincount(owner, cross, count)
+    length = np.bincount(owner, segment, count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.bincount(owner, x, count) / vertices
+        mean_y = np.bincount(owner, y, count) / vertices
+        area_x = np.bincount(owner, (x + next_x) * cross, count) / (3 * twice_area)
+        area_y = np.bincount(owner, (y + next_y) * cross, count) / (3 * twice_area)
+        line_x = np.bincount(owner, (x + next_x) / 2 * segment, count) / length
+        line_y = np.bincount(owner, (y + next_y) / 2 * segment, count) / length
+    centroid_x = np.where(closed & (twice_area != 0), area_x, np.where(~closed & (length > 0), line_x, mean_x))
+    centroid_y = np.where(closed & (twice_area != 0), area_y, np.where(~closed & (length > 0), line_y, mean_y))
+
+    bbox = [np.full(count, np.nan) for _ in range(4)]
+    if nonempty.any():
+        bbox[0][nonempty] = np.minimum.reduceat(x, starts)
+        bbox[1][nonempty] = np.minimum.reduceat(y, starts)
+        bbox[2][nonempty] = np.maximum.reduceat(x, starts)
+        bbox[3][nonempty] = np.maximum.reduceat(y, starts)
+    return np.abs(twice_area) / 2, length, centroid_x, centroid_y, bbox
+
+
+def measure_shapes(image_id, columns):
+    """Return the measurement table of the shapes gathered in a ShapeColumns, in shape order."""
+    count = len(columns)
+    types = np.array(columns.types, dtype=str)
+    g = {column: np.array(values, dtype=np.float64) for column, values in columns.geometry.items()}
+    area, perimeter = np.zeros(count), np.zeros(count)
+    centroid_x, centroid_y = np.full(count, np.nan), np.full(count, np.nan)
+    x_min, y_min, x_max, y_max = (np.full(count, np.nan) for _ in range(4))
+
+    def assign(mask, shape_area, shape_perimeter, cx, cy, bbox):
+        area[mask], perimeter[mask] = shape_area, shape_perimeter
+        centroid_x[mask], centroid_y[mask] = cx, cy
+        x_min[mask], y_min[mask], x_max[mask], y_max[mask] = bbox
+
+    m = types == "Rectangle"
+    x, y, w, h = g["x"][m], g["y"][m], g["width"][m], g["height"][m]
+    assign(m, w * h, 2 * (w + h), x + w / 2, y + h / 2, (x, y, x + w, y + h))
+
+    m = types == "Ellipse"
+    x, y, a, b = g["x"][m], g["y"][m], g["radiusX"][m], g["radiusY"][m]
+    # Ramanujan's second approximation of the circumference.
+    ratio = np.divide((a - b) ** 2, (a + b) ** 2, out=np.zeros_like(a), where=(a + b) > 0)
+    circumference = np.pi * (a + b) * (1 + 3 * ratio / (10 + np.sqrt(4 - 3 * ratio)))
+    assign(m, np.pi * a * b, circumference, x, y, (x - a, y - b, x + a, y + b))
+
+    m = types == "Point"
+    x, y = g["x"][m], g["y"][m]
+    assign(m, 0.0, 0.0, x, y, (x, y, x, y))
+
+    m = types == "Line"
+    x1, y1, x2, y2 = g["x1"][m], g["y1"][m], g["x2"][m], g["y2"][m]
+    assign(m, 0.0, np.hypot(x2 - x1, y2 - y1), (x1 + x2) / 2, (y1 + y2) / 2,
+           (np.minimum(x1, x2), np.minimum(y1, y2), np.maximum(x1, x2), np.maximum(y1, y2)))
+
+    m = (types == "Polygon") | (types == "Polyline")
+    if m.any():
+        shape_area, shape_perimeter, cx, cy, bbox = measure_polygons(columns.points, types[m] == "Polygon")
+        assign(m, shape_area, shape_perimeter, cx, cy, bbox)
+
+    return pd.DataFrame({
+        "image_id": np.full(count, image_id, dtype=np.int64),
+        "roi_id": np.array(columns.roi_ids, dtype=np.int64),
+        "shape_id": pd.array([None if s is None else int(s) for s in columns.shape_ids], dtype="Int64"),
+        "type": types,
+        "theZ": pd.array(g["theZ"], dtype="Float64").astype("Int64"),
+        "theT": pd.array(g["theT"], dtype="Float64").astype("Int64"),
+        "area": area,
+        "perimeter": perimeter,
+        "centroid_x": centroid_x,
+        "centroid_y": centroid_y,
+        "bbox_x_min": x_min,
+        "bbox_y_min": y_min,
+        "bbox_x_max": x_max,
+        "bbox_y_max": y_max,
+    }, columns=MEASUREMENT_COLUMNS)
+
+
+def measurements_filename(roi_filename, fmt):
+    """<name>_ID<id>_rois.<format> -> <name>_ID<id>_measurements.<fmt>"""
+    base = roi_filename
+    for extension in (".ndjson.gz", ".ndjson", ".json", ".npz"):
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+            break
+    if base.endswith("_rois"):
+        base = base[:-len("_rois")]
+    return f"{base}_measurements.{fmt}"
+
+
+def write_measurements(table, filename):
+    """Write a measurement table as CSV, or as Parquet (pyarrow needed) for a .parquet filename."""
+    if filename.endswith(".parquet"):
+        table.to_parquet(filename, index=False)
+    else:
+        table.to_csv(filename, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the per-shape geometry table of exported ROI files.")
+    parser.add_argument("files", nargs="+", help="JSON, NDJSON or .npz files written by ROI_Export")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv", help="table format (default: csv)")
+    args = parser.parse_args()
+    from ROI_Import import read_roi_file
+    for roi_file in args.files:
+        image_id, roi_dicts = read_roi_file(roi_file)
+        columns = ShapeColumns()
+        for _ in columns.collect(roi_dicts):
+            pass
+        filename = measurements_filename(roi_file, args.format)
+        write_measurements(measure_shapes(image_id, columns), filename)
+        print(f"{len(columns)} shapes measured: {filename}")
+
+
+if __name__ == "__main__":
+    main()
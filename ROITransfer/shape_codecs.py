@@ -0,0 +1,237 @@
+"""
+Encoders and decoders between OMERO shapes and the exported shape dictionaries.
+
+There is one codec per shape type, looked up by model class on export and by the
+"type" name on import. Each codec reads its shape with a hand-written reader that
+calls the getters directly, and writes it with setters prepared when the module is
+loaded.
+"""
+
+import base64
+import hashlib
+import struct
+import omero
+import omero.model
+import omero.rtypes
+from omero.model.enums import UnitsLength
+
+# Attributes every exported shape carries, in output order. None when unset.
+COMMON_ATTRIBUTES = ("id", "theT", "theZ", "fillColor", "strokeColor", "strokeWidth",
+                     "fontFamily", "fontSize", "fontStyle", "textValue")
+_COMMON_ACCESSORS = tuple(key[0].upper() + key[1:] for key in COMMON_ATTRIBUTES)
+# How each common attribute is wrapped on import; "id" is assigned by the server.
+_COMMON_WRAPPERS = {
+    "theZ": omero.rtypes.rint,
+    "theT": omero.rtypes.rint,
+    "fillColor": omero.rtypes.rint,
+    "strokeColor": omero.rtypes.rint,
+    "strokeWidth": lambda value: omero.model.LengthI(value, UnitsLength.PIXEL),
+    "fontFamily": omero.rtypes.rstring,
+    "fontSize": lambda value: omero.model.LengthI(value, UnitsLength.POINT),
+    "fontStyle": omero.rtypes.rstring,
+    "textValue": omero.rtypes.rstring,
+}
+
+
+def _read_common(s):
+    """Return the dictionary of the attributes every shape carries; unset ones are None."""
+    return {
+        "id": None if (value := s.getId()) is None else value.getValue(),
+        "theT": None if (value := s.getTheT()) is None else value.getValue(),
+        "theZ": None if (value := s.getTheZ()) is None else value.getValue(),
+        "fillColor": None if (value := s.getFillColor()) is None else value.getValue(),
+        "strokeColor": None if (value := s.getStrokeColor()) is None else value.getValue(),
+        "strokeWidth": None if (value := s.getStrokeWidth()) is None else value.getValue(),
+        "fontFamily": None if (value := s.getFontFamily()) is None else value.getValue(),
+        "fontSize": None if (value := s.getFontSize()) is None else value.getValue(),
+        "fontStyle": None if (value := s.getFontStyle()) is None else value.getValue(),
+        "textValue": None if (value := s.getTextValue()) is None else value.getValue(),
+    }
+
+
+# Readers add the type-specific fields to the shape dictionary, in the order of the codec fields.
+
+def _read_box(s, shape):
+    shape["x"] = None if (value := s.getX()) is None else value.getValue()
+    shape["y"] = None if (value := s.getY()) is None else value.getValue()
+    shape["width"] = None if (value := s.getWidth()) is None else value.getValue()
+    shape["height"] = None if (value := s.getHeight()) is None else value.getValue()
+
+
+def _read_ellipse(s, shape):
+    shape["x"] = None if (value := s.getX()) is None else value.getValue()
+    shape["y"] = None if (value := s.getY()) is None else value.getValue()
+    shape["radiusX"] = None if (value := s.getRadiusX()) is None else value.getValue()
+    shape["radiusY"] = None if (value := s.getRadiusY()) is None else value.getValue()
+
+
+def _read_point(s, shape):
+    shape["x"] = None if (value := s.getX()) is None else value.getValue()
+    shape["y"] = None if (value := s.getY()) is None else value.getValue()
+
+
+def _read_line(s, shape):
+    shape["x1"] = None if (value := s.getX1()) is None else value.getValue()
+    shape["x2"] = None if (value := s.getX2()) is None else value.getValue()
+    shape["y1"] = None if (value := s.getY1()) is None else value.getValue()
+    shape["y2"] = None if (value := s.getY2()) is None else value.getValue()
+    shape["markerStart"] = None if (value := s.getMarkerStart()) is None else value.getValue()
+    shape["markerEnd"] = None if (value := s.getMarkerEnd()) is None else value.getValue()
+
+
+def _read_mask(s, shape):
+    _read_box(s, shape)
+    # getBytes() returns the raw buffer, not an rtype.
+    if (mask_bytes := s.getBytes()) is not None:
+        shape["bytes"] = mask_bytes
+
+
+def _read_points(s, shape):
+    shape["points"] = None if (value := s.getPoints()) is None else value.getValue()
+
+
+def _read_label(s, shape):
+    # The label text is the textValue already read with the common attributes.
+    shape["text"] = shape["textValue"]
+    shape["x"] = 0 if (value := s.getX()) is None else value.getValue()
+    shape["y"] = 0 if (value := s.getY()) is None else value.getValue()
+
+
+def _read_nothing(s, shape):
+    pass
+
+
+class ShapeCodec:
+    """Encoder/decoder for one OMERO shape type.
+
+    fields are the type-specific keys in output order, added to the exported dictionary
+    by read(s, shape) and written with set<Accessor>() where the accessor defaults to
+    the capitalized key.
+    Values are wrapped as rdouble, or as rstring for keys in text_fields.
+    extra_fields are left out of the output by read() when None and decoded by subclasses.
+    """
+    extra_fields = ()
+
+    def __init__(self, name, model_class, fields, read, text_fields=(), accessors=None):
+        accessors = accessors or {}
+        self.name = name
+        self.model_class = model_class
+        self.fields = tuple(fields)
+        self.read = read
+        names = [accessors.get(key, key[0].upper() + key[1:]) for key in self.fields]
+        if model_class is None:
+            return
+        self.setters = tuple(
+            (key, getattr(model_class, "set" + name),
+             omero.rtypes.rstring if key in text_fields else omero.rtypes.rdouble)
+            for key, name in zip(self.fields, names)
+        )
+        self.common_setters = tuple(
+            (key, getattr(model_class, "set" + name), _COMMON_WRAPPERS[key])
+            for key, name in zip(COMMON_ATTRIBUTES, _COMMON_ACCESSORS) if key in _COMMON_WRAPPERS
+        )
+
+    def to_dict(self, s):
+        """Read an OMERO shape into the exported dictionary: common attributes, "type", then the fields."""
+        shape = _read_common(s)
+        if self.name is not None:
+            shape["type"] = self.name
+        self.read(s, shape)
+        return shape
+
+    def decode(self, shape_data):
+        """Build an unsaved OMERO shape from an exported shape dictionary."""
+        shape = self.model_class()
+        for key, setter, wrap in self.setters:
+            value = shape_data.get(key)
+            if value is not None:
+                setter(shape, wrap(value))
+        self.decode_extra(shape, shape_data)
+        for key, setter, wrap in self.common_setters:
+            value = shape_data.get(key)
+            if value is not None:
+                setter(shape, wrap(value))
+        return shape
+
+    def decode_extra(self, shape, shape_data):
+        """Set the attributes listed in extra_fields."""
+
+
+class MaskCodec(ShapeCodec):
+    """Masks keep their bit-packed bytes (one bit per pixel) next to the bounding box."""
+    extra_fields = ("bytes",)
+
+    def decode_extra(self, shape, shape_data):
+        mask_bytes = raw_mask_bytes(shape_data.get("bytes"))
+        if mask_bytes is not None:
+            shape.setBytes(mask_bytes)
+
+
+def raw_mask_bytes(mask_bytes):
+    """Return exported mask bytes (raw, base64 text or an array view) as bytes, or None."""
+    if isinstance(mask_bytes, str):
+        return base64.b64decode(mask_bytes)
+    if mask_bytes is not None and not isinstance(mask_bytes, bytes):
+        return mask_bytes.tobytes()  # view into a .npz array or sidecar mapping
+    return mask_bytes
+
+
+CODECS = (
+    ShapeCodec("Rectangle", omero.model.RectangleI, ("x", "y", "width", "height"), _read_box),
+    ShapeCodec("Ellipse", omero.model.EllipseI, ("x", "y", "radiusX", "radiusY"), _read_ellipse),
+    ShapeCodec("Point", omero.model.PointI, ("x", "y"), _read_point),
+    ShapeCodec("Line", omero.model.LineI, ("x1", "x2", "y1", "y2", "markerStart", "markerEnd"), _read_line,
+               text_fields=("markerStart", "markerEnd")),
+    MaskCodec("Mask", omero.model.MaskI, ("x", "y", "width", "height"), _read_mask),
+    ShapeCodec("Polygon", omero.model.PolygonI, ("points",), _read_points, text_fields=("points",)),
+    ShapeCodec("Polyline", omero.model.PolylineI, ("points",), _read_points, text_fields=("points",)),
+    ShapeCodec("Label", omero.model.LabelI, ("text", "x", "y"), _read_label, text_fields=("text",),
+               accessors={"text": "TextValue"}),
+)
+
+ENCODERS = {codec.model_class: codec for codec in CODECS}
+DECODERS = {codec.name: codec for codec in CODECS}
+
+
+# Shapes of an unknown type keep only the common attributes.
+_GENERIC = ShapeCodec(None, None, (), _read_nothing)
+
+
+def shape_to_dict(s):
+    """Convert an OMERO shape to the exported dictionary with the codec of its class."""
+    return ENCODERS.get(type(s), _GENERIC).to_dict(s)
+
+
+def decode_shape(shape_data):
+    """Build an OMERO shape from an exported dictionary, or None for unknown types."""
+    codec = DECODERS.get(shape_data.get("type"))
+    return codec.decode(shape_data) if codec else None
+
+
+def shape_key(shape_data):
+    """Return a canonical hash of the type, geometry and Z/T of an exported shape dictionary.
+
+    Shapes that are the same on the server and in an export file get the same key
+    whichever format the file has: numbers are compared as float64 and mask bytes in
+    any encoding as raw bytes. Styling attributes
+    are ignored. Returns None for shape types that are not imported.
+    """
+    codec = DECODERS.get(shape_data.get("type"))
+    if codec is None:
+        return None
+    digest = hashlib.sha1(codec.name.encode())
+    for key in ("theZ", "theT") + codec.fields:
+        value = shape_data.get(key)
+        if value is None:
+            digest.update(b"\0N")
+        elif key == "points":
+            numbers = [float(number) for number in value.replace(",", " ").split()]
+            digest.update(b"\0P" + struct.pack(f"<{len(numbers)}d", *numbers))
+        elif isinstance(value, str):
+            digest.update(b"\0S" + value.encode())
+        else:
+            digest.update(b"\0F" + struct.pack("<d", value))
+    mask_bytes = raw_mask_bytes(shape_data.get("bytes"))
+    if mask_bytes is not None:
+        digest.update(b"\0M" + mask_bytes)
+    return digest.digest()
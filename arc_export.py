@@ -0,0 +1,311 @@
+"""
+Export a whole OMERO Project into an ARC in one pass: ISA workbooks, image tables and ROI files.
+
+The Project is walked once: its datasets are listed page by page, the images of each
+dataset are read once for the image table and the same list is used to fetch their
+ROIs in batches. Files are laid out as
+
+    <arc>/isa.investigation.xlsx
+    <arc>/studies/<project>/isa.study.xlsx
+    <arc>/assays/<dataset>/isa.assay.xlsx
+    <arc>/assays/<dataset>/dataset/<dataset>.<table format>
+    <arc>/assays/<dataset>/dataset/rois/<image>_ID<id>_rois.<roi format>
+
+Datasets of the same name get _ID<dataset id> appended to the folder name of all
+but the first, so they do not overwrite each other.
+
+The ISA workbooks come from the Project's annotations; every dataset is an assay and
+gets the Project's assay workbook. Every file is hashed (SHA-256) over the content it
+is made from, the metadata, rows or ROIs, not over its bytes, which for xlsx, npz and
+gzip carry timestamps. A file whose hash equals the one recorded in
+<arc>/.omero_export.json by the last export is left untouched, so re-exporting an
+unchanged Project changes nothing in the ARC's git. Content held in memory anyway is
+hashed before writing and unchanged files are not serialized at all; streamed content
+is written to a staging folder and only moved into the ARC when its hash changed.
+
+    python arc_export.py --project 51 --arc ../my-arc --roi-format npz
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for folder in ("ISATransfer", "ImageToFile", "ROITransfer"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+import ISA_Export
+import Images_to_Excel
+import ROI_Export
+from shared.annotation_cache import AnnotationCache, DEFAULT_CACHE_PATH
+from shared.connection import open_connection, close_connection
+from shared import instrumentation
+from shared.instrumentation import profiled
+from shared.paging import DEFAULT_PAGE_SIZE, iter_children
+from shared.table_writer import TABLE_FORMATS, write_table
+
+MANIFEST_NAME = ".omero_export.json"
+STAGING_NAME = ".omero_export_staging"
+ROI_FORMATS = ("json", "ndjson", "ndjson.gz", "npz")
+# Images whose ROIs are counted and fetched per request.
+ROI_BATCH = 100
+
+
+def content_digest(*parts):
+    """Return a SHA-256 hash started with the settings that shape a file, e.g. its format."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(parts, default=str).encode())
+    return digest
+
+
+def update_digest(digest, item):
+    """Add a JSON-serializable item (raw bytes allowed) to digest."""
+    digest.update(json.dumps(item, default=lambda value: value.hex() if isinstance(value, bytes) else str(value))
+                  .encode())
+    digest.update(b"\n")
+
+
+def hashed(items, digest):
+    """Yield items unchanged, adding each one to digest first."""
+    for item in items:
+        update_digest(digest, item)
+        yield item
+
+
+class ArcWriter:
+    """Writes files into an ARC folder, replacing only those whose content hash changed.
+
+    The hashes of the last export are read from MANIFEST_NAME in the ARC folder and
+    the new ones are written back by save_manifest(). With force every file is rewritten.
+    """
+
+    def __init__(self, root, force=False):
+        self.root = root
+        self.force = force
+        self.staging = os.path.join(root, STAGING_NAME)
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        self.previous = manifest.get("files", {})
+        self.previous_companions = manifest.get("companions", {})
+        self.hashes = {}
+        self.companions = {}    # relpath -> names of the files written next to it
+        self.changed = 0
+        self.unchanged = 0
+        shutil.rmtree(self.staging, ignore_errors=True)  # left over by an interrupted export
+        os.makedirs(self.staging)
+
+    def skip(self, relpath, digest):
+        """Return True, and keep relpath, if its content was hashed before writing and is unchanged."""
+        folder = os.path.dirname(os.path.join(self.root, relpath))
+        names = [os.path.basename(relpath)] + self.previous_companions.get(relpath, [])
+        if self.force or self.previous.get(relpath) != digest.hexdigest() \
+                or not all(os.path.exists(os.path.join(folder, name)) for name in names):
+            return False
+        self.hashes[relpath] = digest.hexdigest()
+        if relpath in self.previous_companions:
+            self.companions[relpath] = self.previous_companions[relpath]
+        self.unchanged += 1
+        return True
+
+    @contextlib.contextmanager
+    def staged(self, relpath, digest):
+        """Yield the path to write relpath to; afterwards move it into the ARC unless its digest is unchanged.
+
+        Files written next to it (mask sidecars, measurement tables) are handled with it.
+        The messages of the writers, which name the staging path, are replaced by one
+        line per file moved into the ARC.
+        """
+        target = os.path.join(self.root, relpath)
+        stage = tempfile.mkdtemp(dir=self.staging)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield os.path.join(stage, os.path.basename(target))
+            self.hashes[relpath] = digest.hexdigest()
+            unchanged = not self.force and self.previous.get(relpath) == self.hashes[relpath]
+            moved = False
+            names = sorted(os.listdir(stage))
+            if names != [os.path.basename(target)]:
+                self.companions[relpath] = [name for name in names if name != os.path.basename(target)]
+            for name in names:
+                destination = os.path.join(os.path.dirname(target), name)
+                if unchanged and os.path.exists(destination):
+                    continue
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(os.path.join(stage, name), destination)
+                print(f"Written {destination}")
+                moved = True
+            if moved:
+                self.changed += 1
+            else:
+                self.unchanged += 1
+        finally:
+            shutil.rmtree(stage, ignore_errors=True)
+
+    def save_manifest(self):
+        """Record the hashes of this export and return the files of the last one that were not exported again."""
+        shutil.rmtree(self.staging, ignore_errors=True)
+        if self.hashes != self.previous or self.companions != self.previous_companions:
+            with open(f"{self.manifest_path}.tmp", "w") as f:
+                json.dump({"files": dict(sorted(self.hashes.items())),
+                           "companions": dict(sorted(self.companions.items()))}, f, indent=1)
+            os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+        return sorted(set(self.previous) - set(self.hashes))
+
+
+def assay_names(datasets):
+    """Return [(dataset_id, folder name)] of [(dataset_id, name)], with spaces replaced.
+
+    The first dataset of a name keeps it, later ones get _ID<dataset id> appended.
+    """
+    names, used = [], set()
+    for dataset_id, name in datasets:
+        name = name.replace(" ", "_")
+        if name in used:
+            name = f"{name}_ID{dataset_id}"
+        used.add(name)
+        names.append((dataset_id, name))
+    return names
+
+
+def export_isa(conn, writer, project_id, project_name, dataset_names, cache=None):
+    """Write the ISA workbooks of the Project to the ARC root, its study and every assay folder."""
+    investigation, study, assay, other = ISA_Export.fetch_metadata_from_project(conn, "Project", project_id, cache)
+    assay_folders = [f"assays/{name}" for name in dataset_names] or [f"assays/{project_name}"]
+    files = [("isa.investigation.xlsx", investigation), (f"studies/{project_name}/isa.study.xlsx", study)]
+    files += [(f"{folder}/isa.assay.xlsx", assay) for folder in assay_folders]
+    tables = {}
+    for relpath, metadata in files:
+        if not metadata:
+            print(f"No relevant metadata found for {relpath}")
+            continue
+        if id(metadata) not in tables:
+            tables[id(metadata)] = ISA_Export.isa_table(metadata)
+        df = tables[id(metadata)]
+        digest = content_digest("isa", os.path.basename(relpath))
+        for row in df.values.tolist():
+            update_digest(digest, row)
+        if not writer.skip(relpath, digest):
+            with writer.staged(relpath, digest) as path:
+                ISA_Export.write_isa_workbook(df, path)
+    if other:
+        digest = content_digest("extra")
+        update_digest(digest, other)
+        if not writer.skip("ExtraMetadata.xlsx", digest):
+            with writer.staged("ExtraMetadata.xlsx", digest) as path:
+                ISA_Export.write_extra_metadata(other, path)
+
+
+def export_dataset(conn, writer, dataset_id, dataset_name, table_format="xlsx", roi_format="npz", measurements=None,
+                   batch_size=ROI_BATCH, page_size=DEFAULT_PAGE_SIZE, cache=None):
+    """Write the image table and the ROI files of one dataset to assays/<dataset>/dataset.
+
+    The images are listed once, by the paged image table query, and their ROIs are
+    then fetched batch_size images per request. The ROIs of batch-fetched images are
+    hashed before their file is written, so unchanged files are not even serialized;
+    images paged on their own stream through the staging folder. Returns the number
+    of images.
+    """
+    folder = f"assays/{dataset_name}/dataset"
+    image_names = {}
+    digest = content_digest("images", table_format)
+    with writer.staged(f"{folder}/{dataset_name}.{table_format}", digest) as path:
+        rows = Images_to_Excel.iter_image_rows(conn, dataset_id, cache, page_size, image_names)
+        write_table(hashed(rows, digest), path, table_format)
+
+    for image_id, rois in ROI_Export.fetch_rois_for_images(conn, list(image_names), batch_size, page_size):
+        image_name = image_names[image_id].replace(" ", "_")
+        relpath = f"{folder}/rois/{image_name}_ID{image_id}_rois.{roi_format}"
+        digest = content_digest("rois", image_id, roi_format, measurements)
+        if isinstance(rois, list):
+            roi_dicts = list(hashed(ROI_Export.transform_rois(rois), digest))
+            if writer.skip(relpath, digest):
+                continue
+        else:
+            roi_dicts = hashed(ROI_Export.transform_rois(rois), digest)
+        with writer.staged(relpath, digest) as path:
+            ROI_Export.write_roi_file(image_id, roi_dicts, path, roi_format, measurements)
+    return len(image_names)
+
+
+def export_arc(conn, project, arc_folder, table_format="xlsx", roi_format="npz", measurements=None,
+               batch_size=ROI_BATCH, page_size=DEFAULT_PAGE_SIZE, cache=None, force=False):
+    """Export the ISA metadata, image tables and ROIs of a Project into the ARC at arc_folder.
+
+    Only files whose content changed since the last export into the same folder are
+    rewritten, all of them with force. Returns the counts printed in the summary line.
+    """
+    os.makedirs(arc_folder, exist_ok=True)
+    writer = ArcWriter(arc_folder, force)
+    project_name = project.getName().replace(" ", "_")
+    datasets = assay_names(iter_children(conn, "Project", project.getId(), page_size))
+    images = 0
+    with profiled():
+        export_isa(conn, writer, project.getId(), project_name, [name for _, name in datasets], cache)
+        for dataset_id, dataset_name in datasets:
+            images += export_dataset(conn, writer, dataset_id, dataset_name, table_format, roi_format,
+                                     measurements, batch_size, page_size, cache)
+    stale = writer.save_manifest()
+
+    print(f"Project {project.getId()} exported to {arc_folder}: {len(datasets)} datasets, {images} images, "
+          f"{writer.changed} files written, {writer.unchanged} unchanged.")
+    if stale:
+        print(f"{len(stale)} files of the previous export were not exported again and can be removed, "
+              f"e.g. {stale[0]}")
+    return {"datasets": len(datasets), "images": images, "written": writer.changed,
+            "unchanged": writer.unchanged, "stale": len(stale)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export an OMERO Project into an ARC, rewriting only changed files.")
+    parser.add_argument("--project", type=int, help="Project ID (asked for when omitted)")
+    parser.add_argument("--arc", help="ARC folder (default: the project name)")
+    parser.add_argument("--table-format", choices=TABLE_FORMATS, default="xlsx",
+                        help="format of the image tables (default: xlsx)")
+    parser.add_argument("--roi-format", choices=ROI_FORMATS, default="npz", help="format of the ROI files (default: npz)")
+    parser.add_argument("--measurements", choices=["csv", "parquet"],
+                        help="also write the geometry table of the shapes of every image")
+    parser.add_argument("--batch-size", type=int, default=ROI_BATCH,
+                        help=f"images whose ROIs are fetched per request (default: {ROI_BATCH})")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f"datasets, images and ROIs read per request (default: {DEFAULT_PAGE_SIZE})")
+    parser.add_argument("--force", action="store_true", help="rewrite every file, even if unchanged")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="read all annotations from the server, bypassing the local cache")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH, help="location of the annotation cache")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrumentation.start(args)
+    conn = open_connection()
+    if conn is None:
+        return
+    cache = None if args.no_cache else AnnotationCache(args.cache_path)
+
+    project_id = args.project if args.project is not None else input("Enter OMERO Project ID: ")
+    project = conn.getObject("Project", project_id)
+    if project is None:
+        print(f"Project with ID {project_id} not found.")
+    else:
+        export_arc(conn, project, args.arc or project.getName().replace(" ", "_"), args.table_format, args.roi_format,
+                   args.measurements, args.batch_size, args.page_size, cache, args.force)
+
+    if cache is not None:
+        cache.close()
+    close_connection(conn)
+    instrumentation.finish(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Run many transfer operations from a manifest in one process, over one OMERO session.
+
+The manifest is a JSON or YAML file with a list of operations (or {"connection":
+{...}, "operations": [...]}), or a CSV file with one operation per row and a header
+naming the fields. Every operation has an "op" and the fields listed in OPERATIONS:
+
+    op,project,dataset,image,file,type,format,output
+    isa_export,51,,,,,,arc/isa
+    isa_import,51,,,isa.study.xlsx,Study,,
+    roi_export,,101,,,,npz,rois
+    roi_import,,,,rois/img_ID7_rois.npz,,,
+    roi_import,,,,rois,,,
+    images_to_excel,,101,,,,,tables/dataset_101.xlsx
+    excel_to_images,,101,,tables/dataset_101.xlsx,,,
+    arc_export,51,,,,,npz,../my-arc
+
+The password is read from OMERO_PASSWORD when no open session can be reused; nothing
+is prompted for. Progress goes to stderr and a JSON summary to stdout (or --summary).
+The exit status is 0 when every operation succeeded.
+
+    python batch_transfer.py manifest.yaml --host omero.example.org --user alice
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for folder in ("ISATransfer", "ImageToFile", "ROITransfer"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+import arc_export
+import Excel_to_Images
+import ISA_Export
+import ISA_Import
+import Images_to_Excel
+import ROI_Export
+import ROI_Import
+from shared.annotation_cache import AnnotationCache, DEFAULT_CACHE_PATH
+from shared.connection import ConnectionPool, open_connection, close_connection
+from shared import instrumentation
+from shared.roi_filters import RoiFilter
+
+
+def get_object(conn, object_type, object_id):
+    """Return the OMERO object or raise ValueError when it does not exist."""
+    obj = conn.getObject(object_type, int(object_id))
+    if obj is None:
+        raise ValueError(f"{object_type} with ID {object_id} not found.")
+    return obj
+
+
+def run_isa_export(conn, op, context):
+    project = get_object(conn, "Project", op["project"])
+    metadata = ISA_Export.fetch_metadata_from_project(conn, "Project", project.getId(), context["cache"])
+    output = op.get("output") or "."
+    ISA_Export.save_metadata_to_excel(*metadata, output_dir=output)
+    return {"output": output, "namespaces": sum(len(m) for m in metadata)}
+
+
+def run_isa_import(conn, op, context):
+    project = get_object(conn, "Project", op["project"])
+    file_type = op["type"].capitalize()
+    if file_type not in ("Investigation", "Study", "Assay"):
+        raise ValueError(f"Unknown ISA file type {op['type']!r}.")
+    if not os.path.exists(op["file"]):
+        raise ValueError(f"File {op['file']} not found.")
+    metadata = ISA_Import.extract_metadata_from_xlsx(op["file"], file_type)
+    if op.get("sync", True):
+        return ISA_Import.sync_metadata(project, metadata, conn, file_type, op.get("delete_removed", False))
+    ISA_Import.apply_metadata(project, metadata, conn)
+    return {"created": len(metadata)}
+
+
+def run_roi_export(conn, op, context):
+    fmt = op.get("format") or "json"
+    batch_size = op.get("batch_size")
+    page_size = op.get("page_size") or ROI_Export.DEFAULT_PAGE_SIZE
+    measurements = op.get("measurements")
+    # Optional server-side selection; lists may be given as comma separated strings.
+    roi_filter = RoiFilter.from_fields(op.get("shape_types"), op.get("z"), op.get("t"), op.get("roi_ids"))
+    if op.get("project"):
+        project = get_object(conn, "Project", op["project"])
+        output = op.get("output") or project.getName().replace(" ", "_")
+        elapsed = ROI_Export.export_project_rois(conn, project, output, batch_size, fmt, context["pool"], page_size,
+                                                 measurements, roi_filter)
+    elif op.get("dataset"):
+        dataset = get_object(conn, "Dataset", op["dataset"])
+        output = op.get("output") or dataset.getName().replace(" ", "_")
+        elapsed = ROI_Export.export_dataset_rois(conn, dataset, output, batch_size, fmt, context["pool"], page_size,
+                                                 measurements, roi_filter)
+    else:
+        image = get_object(conn, "Image", op["image"])
+        output = op.get("output") or f"{image.getName().replace(' ', '_')}_ID{image.getId()}_rois.{fmt}"
+        start_time = time.perf_counter()
+        roi_dicts = ROI_Export.iter_roi_dicts(image.getId(), conn, page_size, roi_filter)
+        ROI_Export.write_roi_file(image.getId(), roi_dicts, output, fmt, measurements)
+        elapsed = time.perf_counter() - start_time
+    return {"output": output, "export_seconds": round(elapsed, 3)}
+
+
+def run_roi_import(conn, op, context):
+    if not os.path.exists(op["file"]):
+        raise ValueError(f"File {op['file']} not found.")
+    page_size = op.get("page_size") or ROI_Import.DEFAULT_PAGE_SIZE
+    if os.path.isdir(op["file"]):
+        return ROI_Import.import_roi_folder(conn, op["file"], op.get("batch_size"), op.get("dedup", False),
+                                           context["pool"], restart=op.get("restart", False), page_size=page_size)
+    roi_count = ROI_Import.import_rois_from_json(op["file"], conn, op.get("batch_size"), op.get("dedup", False),
+                                                 page_size)
+    if roi_count is None:
+        raise ValueError(f"The image of {op['file']} is not in OMERO.")
+    return {"rois": roi_count}
+
+
+def run_images_to_excel(conn, op, context):
+    fmt = op.get("format") or "xlsx"
+    stream = op.get("stream", False) or fmt != "xlsx"
+    if op.get("project"):
+        project = get_object(conn, "Project", op["project"])
+        files = Images_to_Excel.export_project_tables(conn, project, context["cache"], context["pool"],
+                                                      op.get("output"), fmt, stream)
+        return {"output": files}
+    dataset = get_object(conn, "Dataset", op["dataset"])
+    output = op.get("output") or f"{dataset.getName().replace(' ', '_')}.{fmt}"
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    if stream:
+        count = Images_to_Excel.stream_image_table(conn, dataset.getId(), output, fmt, context["cache"])
+        return {"output": output, "images": count}
+    df = Images_to_Excel.extract_image_table(conn, dataset.getId(), context["cache"], context["pool"])
+    Images_to_Excel.save_table(df, output)
+    return {"output": output, "images": len(df)}
+
+
+def run_arc_export(conn, op, context):
+    project = get_object(conn, "Project", op["project"])
+    output = op.get("output") or project.getName().replace(" ", "_")
+    result = arc_export.export_arc(conn, project, output, op.get("table_format") or "xlsx", op.get("format") or "npz",
+                                   op.get("measurements"), op.get("batch_size") or arc_export.ROI_BATCH,
+                                   op.get("page_size") or arc_export.DEFAULT_PAGE_SIZE, context["cache"],
+                                   op.get("force", False))
+    return {"output": output, **result}
+
+
+def run_excel_to_images(conn, op, context):
+    dataset = get_object(conn, "Dataset", op["dataset"])
+    if not os.path.exists(op["file"]):
+        raise ValueError(f"File {op['file']} not found.")
+    return Excel_to_Images.import_sheet(conn, dataset.getId(), op["file"], op.get("dry_run", False))
+
+
+# op name -> (runner, required fields); a tuple of alternatives needs one of them.
+OPERATIONS = {
+    "isa_export": (run_isa_export, ["project"]),
+    "isa_import": (run_isa_import, ["project", "file", "type"]),
+    "roi_export": (run_roi_export, [("project", "dataset", "image")]),
+    "roi_import": (run_roi_import, ["file"]),
+    "images_to_excel": (run_images_to_excel, [("project", "dataset")]),
+    "excel_to_images": (run_excel_to_images, ["dataset", "file"]),
+    "arc_export": (run_arc_export, ["project"]),
+}
+INTEGER_FIELDS = ("project", "dataset", "image", "batch_size", "page_size")
+BOOLEAN_FIELDS = ("sync", "delete_removed", "stream", "dry_run", "dedup", "restart", "force")
+
+
+def normalize_operation(op):
+    """Drop empty fields, convert CSV strings to ints and booleans, and check required fields."""
+    op = {key: value for key, value in op.items() if value not in (None, "")}
+    for key in INTEGER_FIELDS:
+        if key in op:
+            op[key] = int(op[key])
+    for key in BOOLEAN_FIELDS:
+        if isinstance(op.get(key), str):
+            op[key] = op[key].strip().lower() in ("1", "true", "yes", "y")
+    if op.get("op") not in OPERATIONS:
+        raise ValueError(f"Unknown op {op.get('op')!r}, expected one of {', '.join(OPERATIONS)}.")
+    for required in OPERATIONS[op["op"]][1]:
+        alternatives = required if isinstance(required, tuple) else (required,)
+        if not any(key in op for key in alternatives):
+            raise ValueError(f"{op['op']} needs {' or '.join(alternatives)}.")
+    return op
+
+
+def load_manifest(path):
+    """Return (connection settings, list of operations) from a JSON, YAML or CSV manifest."""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="") as f:
+        if extension == ".csv":
+            return {}, list(csv.DictReader(f))
+        if extension in (".yaml", ".yml"):
+            import yaml  # PyYAML is only needed for YAML manifests.
+            document = yaml.safe_load(f)
+        else:
+            document = json.load(f)
+    if isinstance(document, list):
+        return {}, document
+    return document.get("connection", {}), document.get("operations", [])
+
+
+def run_manifest(conn, operations, context, stop_on_error=False):
+    """Run the operations in order and return one result record per operation."""
+    records = []
+    for index, op in enumerate(operations):
+        record = {"index": index, "op": op.get("op")}
+        start_time = time.perf_counter()
+        try:
+            op = normalize_operation(op)
+            record["result"] = OPERATIONS[op["op"]][0](conn, op, context)
+            record["status"] = "ok"
+        except Exception as error:
+            record["status"] = "error"
+            record["error"] = f"{type(error).__name__}: {error}"
+        record["seconds"] = round(time.perf_counter() - start_time, 3)
+        records.append(record)
+        print(f"[{index + 1}/{len(operations)}] {record['op']}: {record['status']}", file=sys.stderr)
+        if stop_on_error and record["status"] == "error":
+            break
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the transfer operations of a manifest in one OMERO session.")
+    parser.add_argument("manifest", help="JSON, YAML or CSV file listing the operations")
+    parser.add_argument("--host", help="OMERO host, overrides the manifest")
+    parser.add_argument("--user", help="OMERO username, overrides the manifest")
+    parser.add_argument("--port", type=int, help="OMERO port, overrides the manifest")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent connections for exports that support it")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the local annotation cache")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH, help="location of the annotation cache")
+    parser.add_argument("--stop-on-error", action="store_true", help="stop at the first failed operation")
+    parser.add_argument("--summary", default="-", help="file for the JSON summary (default: stdout)")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrumentation.start(args)
+    start_time = time.perf_counter()
+    settings, operations = load_manifest(args.manifest)
+
+    # Everything the scripts print is progress, the summary alone goes to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        conn = open_connection(
+            host=args.host or settings.get("host"),
+            username=args.user or settings.get("username"),
+            password=os.environ.get("OMERO_PASSWORD"),
+            port=args.port or settings.get("port") or 4064,
+            interactive=False,
+        )
+        if conn is None:
+            records = []
+        else:
+            context = {
+                "cache": None if args.no_cache else AnnotationCache(args.cache_path),
+                "pool": ConnectionPool(conn, args.workers) if args.workers > 1 else None,
+            }
+            with instrumentation.profiled():
+                records = run_manifest(conn, operations, context, args.stop_on_error)
+            if context["pool"] is not None:
+                context["pool"].close()
+            if context["cache"] is not None:
+                context["cache"].close()
+            close_connection(conn)
+        profile = instrumentation.finish(args)
+
+    summary = {
+        "connected": conn is not None,
+        "operations": len(operations),
+        "succeeded": sum(record["status"] == "ok" for record in records),
+        "failed": sum(record["status"] == "error" for record in records),
+        "skipped": len(operations) - len(records),
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "results": records,
+    }
+    if profile is not None:
+        summary["profile"] = profile
+    output = json.dumps(summary, indent=2, default=str)
+    if args.summary == "-":
+        print(output)
+    else:
+        with open(args.summary, "w") as f:
+            f.write(output + "\n")
+    sys.exit(0 if conn is not None and summary["succeeded"] == len(operations) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Scale benchmark of the export and import paths against the in-memory FakeGateway.
+
+Every case runs at each size (number of images, ROIs or ISA keys) on a fresh fake
+server and reports the wall time, the number of server calls and the peak Python
+memory (tracemalloc, measured in a second run so it does not slow the timed one).
+No OMERO server is needed, omero-py must be installed.
+
+    python bench_transfer.py --sizes 10 1000 100000 --latency 0.001
+    python bench_transfer.py --cases roi_export_batched roi_import_batched --json results.json
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for folder in ("ISATransfer", "ImageToFile", "ROITransfer"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from shared import fake_gateway, instrumentation
+from shared.roi_filters import RoiFilter
+fake_gateway.install()  # before the scripts import MapAnnotationWrapper
+
+import arc_export
+import Excel_to_Images
+import ISA_Export
+import ISA_Import
+import Images_to_Excel
+import ROI_Export
+import ROI_Import
+from bench_isa_parser import write_synthetic_sheet
+
+ROIS_PER_IMAGE = 10
+EXPORT_BATCH = 100
+SAVE_BATCH = 500
+
+
+def images_gateway(n, latency):
+    return fake_gateway.FakeGateway(latency, images_per_dataset=n)
+
+
+def small_gateway(n, latency):
+    return fake_gateway.FakeGateway(latency, images_per_dataset=1)
+
+
+def roi_heavy_gateway(n, latency):
+    return fake_gateway.FakeGateway(latency, images_per_dataset=1, rois_per_image=n)
+
+
+def isa_gateway(n, latency):
+    return fake_gateway.FakeGateway(latency, images_per_dataset=1, isa_keys=n)
+
+
+def rois_gateway(n, latency):
+    return fake_gateway.FakeGateway(latency, images_per_dataset=math.ceil(n / ROIS_PER_IMAGE),
+                                    rois_per_image=ROIS_PER_IMAGE)
+
+
+def case_image_table(conn, folder, prepared, pool):
+    df = Images_to_Excel.extract_image_table(conn, 1, pool=pool)
+    Images_to_Excel.save_table(df, os.path.join(folder, "images.xlsx"))
+
+
+def case_image_table_stream(conn, folder, prepared, pool):
+    Images_to_Excel.stream_image_table(conn, 1, os.path.join(folder, "images.xlsx"))
+
+
+def case_image_table_csv(conn, folder, prepared, pool):
+    Images_to_Excel.stream_image_table(conn, 1, os.path.join(folder, "images.csv"))
+
+
+def case_image_rows_per_image(conn, folder, prepared, pool):
+    Images_to_Excel.extract_image_metadata(conn, 1, bulk=False)
+
+
+def case_roi_export_per_image(conn, folder, prepared, pool):
+    ROI_Export.export_dataset_rois(conn, conn.getObject("Dataset", 1), os.path.join(folder, "rois"))
+
+
+def case_roi_export_batched(conn, folder, prepared, pool):
+    ROI_Export.export_dataset_rois(conn, conn.getObject("Dataset", 1), os.path.join(folder, "rois"),
+                                   EXPORT_BATCH, "npz", pool)
+
+
+def case_roi_export_one_image(conn, folder, prepared, pool):
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn), os.path.join(folder, "rois.ndjson"), "ndjson")
+
+
+def case_roi_export_filtered(conn, folder, prepared, pool):
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn, roi_filter=RoiFilter(["Polygon"], (0, 0))),
+                              os.path.join(folder, "rois.ndjson"), "ndjson")
+
+
+def case_roi_measurements(conn, folder, prepared, pool):
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn), os.path.join(folder, "rois.npz"), "npz", "csv")
+
+
+def prepare_roi_file(conn, n, folder):
+    """Write one .npz file with n ROIs on image 1."""
+    per_image = conn.store.rois_per_image
+    conn.store.rois_per_image = n
+    path = os.path.join(folder, "rois.npz")
+    ROI_Export.write_roi_file(1, ROI_Export.transform_rois(conn.store.rois(1)), path, "npz")
+    conn.store.rois_per_image = per_image
+    return path
+
+
+def case_roi_import_per_roi(conn, folder, roi_file, pool):
+    ROI_Import.import_rois_from_json(roi_file, conn)
+
+
+def case_roi_import_batched(conn, folder, roi_file, pool):
+    ROI_Import.import_rois_from_json(roi_file, conn, SAVE_BATCH)
+
+
+def prepare_image_sheet(conn, n, folder):
+    """Write the image table of the dataset with every tenth image's first key edited."""
+    path = os.path.join(folder, "images.csv")
+    Images_to_Excel.stream_image_table(conn, 1, path)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.loc[::10, "Key0_0"] = "edited"
+    df.to_csv(path, index=False)
+    return path
+
+
+def case_excel_to_images(conn, folder, sheet, pool):
+    Excel_to_Images.import_sheet(conn, 1, sheet)
+
+
+def case_roi_reimport_dedup(conn, folder, roi_file, pool):
+    ROI_Import.import_rois_from_json(roi_file, conn, SAVE_BATCH, dedup=True)
+
+
+def case_arc_export(conn, folder, prepared, pool):
+    arc_export.export_arc(conn, conn.getObject("Project", 1), os.path.join(folder, "arc"))
+
+
+def prepare_arc(conn, n, folder):
+    """Export the project once, so that the measured export finds every file unchanged."""
+    arc_export.export_arc(conn, conn.getObject("Project", 1), os.path.join(folder, "arc"))
+
+
+def case_isa_export(conn, folder, prepared, pool):
+    metadata = ISA_Export.fetch_metadata_from_project(conn, "Project", 1)
+    ISA_Export.save_metadata_to_excel(*metadata, output_dir=folder)
+
+
+def prepare_isa_sheet(conn, n, folder):
+    """Write an assay sheet with n keys."""
+    path = os.path.join(folder, "isa.assay.xlsx")
+    write_synthetic_sheet(path, n, 8)
+    return path
+
+
+def case_isa_import_sync(conn, folder, sheet, pool):
+    metadata = ISA_Import.extract_metadata_from_xlsx(sheet, "Assay")
+    ISA_Import.sync_metadata(conn.getObject("Project", 1), metadata, conn, "Assay")
+
+
+# name -> (gateway for size n, preparation outside the measurement or None, case)
+CASES = {
+    "image_table": (images_gateway, None, case_image_table),
+    "image_table_stream": (images_gateway, None, case_image_table_stream),
+    "image_table_csv": (images_gateway, None, case_image_table_csv),
+    "image_rows_per_image": (images_gateway, None, case_image_rows_per_image),
+    "roi_export_per_image": (rois_gateway, None, case_roi_export_per_image),
+    "roi_export_batched": (rois_gateway, None, case_roi_export_batched),
+    "roi_export_one_image": (roi_heavy_gateway, None, case_roi_export_one_image),
+    "roi_export_filtered": (roi_heavy_gateway, None, case_roi_export_filtered),
+    "roi_measurements": (roi_heavy_gateway, None, case_roi_measurements),
+    "roi_import_per_roi": (small_gateway, prepare_roi_file, case_roi_import_per_roi),
+    "roi_import_batched": (small_gateway, prepare_roi_file, case_roi_import_batched),
+    "roi_reimport_dedup": (roi_heavy_gateway, prepare_roi_file, case_roi_reimport_dedup),
+    "excel_to_images": (images_gateway, prepare_image_sheet, case_excel_to_images),
+    "arc_export": (rois_gateway, None, case_arc_export),
+    "arc_export_unchanged": (rois_gateway, prepare_arc, case_arc_export),
+    "isa_export": (isa_gateway, None, case_isa_export),
+    "isa_import_sync": (small_gateway, prepare_isa_sheet, case_isa_import_sync),
+}
+
+
+def run_case(name, n, latency, workers=1, trace_memory=False):
+    """Run one case at size n on a fresh fake server and return its measurements."""
+    make_gateway, prepare, case = CASES[name]
+    with tempfile.TemporaryDirectory() as folder, open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        conn = make_gateway(n, latency)
+        prepared = prepare(conn, n, folder) if prepare is not None else None
+        instrumentation.enable()
+        conn = instrumentation.instrument(conn)
+        pool = fake_gateway.FakeConnectionPool(conn, workers) if workers > 1 else None
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        case(conn, folder, prepared, pool)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        report = instrumentation.active().report()
+    return {"case": name, "size": n, "seconds": round(elapsed, 6), "server_calls": report["server_calls"],
+            "calls": {call: counts["count"] for call, counts in report["calls"].items()},
+            "peak_mib": round(peak / 2 ** 20, 3) if peak is not None else None}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000], help="object counts to run")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="cases to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per server call")
+    parser.add_argument("--workers", type=int, default=1, help="pooled connections for the cases that use them")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    print(f"{'case':<24} {'size':>8} {'seconds':>10} {'calls':>8} {'peak MiB':>10}")
+    for name in args.cases:
+        for n in args.sizes:
+            result = run_case(name, n, args.latency, args.workers)
+            if not args.no_memory:
+                result["peak_mib"] = run_case(name, n, args.latency, args.workers, trace_memory=True)["peak_mib"]
+            results.append(result)
+            peak = f"{result['peak_mib']:10.1f}" if result["peak_mib"] is not None else f"{'-':>10}"
+            print(f"{name:<24} {n:>8} {result['seconds']:10.3f} {result['server_calls']:>8} {peak}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency": args.latency, "workers": args.workers, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Helpers shared by the transfer scripts in ISATransfer, ImageToFile and ROITransfer."""
@@ -0,0 +1,180 @@
+"""
+Bulk MapAnnotation fetching with an optional local SQLite cache.
+
+Repeated exports of the same objects mostly see unchanged annotations. With a cache,
+only the link list with each annotation's update event is read from the server; the
+key-value pairs are fetched for annotations that are new or changed since they were
+cached and served locally for all others. Annotation IDs are only unique on one
+server, so entries are kept per server and user, and one cache file can serve
+exports from several servers.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import omero
+import omero.sys
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".omero_arc", "annotation_cache.sqlite")
+# Cached annotations kept at most; the least recently used ones are evicted first.
+DEFAULT_MAX_ENTRIES = 500000
+# Number of IDs sent in one "in (:ids)" query.
+QUERY_BATCH = 1000
+
+# All MapAnnotations linked to a set of objects, with their key-value pairs, in link order.
+LINKED_ANNOTATIONS_QUERY = (
+    "select distinct l from {link} l "
+    "join fetch l.child a "
+    "left outer join fetch a.mapValue "
+    "where l.parent.id in (:ids) and a.class = MapAnnotation "
+    "order by l.id"
+)
+
+# Object ID, annotation ID and update event of the same links, without the values.
+LINK_VERSIONS_QUERY = (
+    "select l.parent.id, a.id, a.details.updateEvent.id from {link} l "
+    "join l.child a "
+    "where l.parent.id in (:ids) and a.class = MapAnnotation "
+    "order by l.id"
+)
+
+ANNOTATIONS_BY_ID_QUERY = (
+    "select distinct a from MapAnnotation a "
+    "left outer join fetch a.mapValue "
+    "where a.id in (:ids)"
+)
+
+
+def server_key(conn):
+    """Return "user@host:port" of a connection, the scope in which annotation IDs are cached."""
+    return f"{conn.getUser().getName()}@{conn.host}:{conn.port}"
+
+
+class AnnotationCache:
+    """SQLite store of MapAnnotation namespaces and key-value pairs by server and annotation ID.
+
+    Each entry remembers the annotation's update event, so a changed annotation is
+    detected without reading its values. The store is bounded to max_entries.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "create table if not exists server_annotations ("
+            "server text, ann_id integer, update_id integer, ns text, kv text, last_used real, "
+            "primary key (server, ann_id))"
+        )
+        self._db.execute(
+            "create index if not exists server_annotations_last_used on server_annotations (last_used)")
+        self._db.commit()
+
+    def get(self, server, versions):
+        """Return {ann_id: (ns, kv_pairs)} for the annotations of server cached at the given update event.
+
+        server is the server_key of the connection, versions maps annotation ID to its
+        current update event ID.
+        """
+        found = {}
+        now = time.time()
+        ids = list(versions)
+        with self._lock:
+            for start in range(0, len(ids), QUERY_BATCH):
+                batch = ids[start:start + QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"select ann_id, update_id, ns, kv from server_annotations "
+                    f"where server = ? and ann_id in ({placeholders})", [server] + batch
+                ).fetchall()
+                for ann_id, update_id, ns, kv in rows:
+                    if update_id == versions[ann_id]:
+                        found[ann_id] = (ns, [tuple(pair) for pair in json.loads(kv)])
+            self._db.executemany("update server_annotations set last_used = ? where server = ? and ann_id = ?",
+                                 [(now, server, ann_id) for ann_id in found])
+            self._db.commit()
+        return found
+
+    def put(self, server, entries):
+        """Store entries of (ann_id, update_id, ns, kv_pairs) of server and evict if over the bound."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "insert or replace into server_annotations (server, ann_id, update_id, ns, kv, last_used) "
+                "values (?, ?, ?, ?, ?, ?)",
+                [(server, ann_id, update_id, ns, json.dumps(kv_pairs), now)
+                 for ann_id, update_id, ns, kv_pairs in entries]
+            )
+            count = self._db.execute("select count(*) from server_annotations").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    "delete from server_annotations where rowid in "
+                    "(select rowid from server_annotations order by last_used limit ?)", (count - self.max_entries,)
+                )
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def _link_class(object_type):
+    return f"{object_type}AnnotationLink"
+
+
+def _kv_pairs(ann):
+    return [(nv.name, nv.value) for nv in ann.getMapValue()]
+
+
+def _ns(ann):
+    return ann.getNs().getValue() if ann.getNs() is not None else None
+
+
+def fetch_map_annotations(conn, object_type, object_ids, cache=None, batch_size=QUERY_BATCH):
+    """Fetch the MapAnnotations of many objects of one type in bulk.
+
+    Returns {object_id: [(namespace, [(key, value), ...]), ...]} in link order for every
+    requested object, and the number of server round trips. Without a cache the
+    annotations are read with their values in one query per batch of objects. With a
+    cache only new or changed annotations are read from the server.
+    """
+    query_service = conn.getQueryService()
+    link = _link_class(object_type)
+    server = server_key(conn) if cache is not None else None
+    annotations = {object_id: [] for object_id in object_ids}
+    round_trips = 0
+    for start in range(0, len(object_ids), batch_size):
+        params = omero.sys.ParametersI()
+        params.addIds(object_ids[start:start + batch_size])
+        if cache is None:
+            links = query_service.findAllByQuery(LINKED_ANNOTATIONS_QUERY.format(link=link), params, conn.SERVICE_OPTS)
+            round_trips += 1
+            for link_obj in links:
+                ann = link_obj.getChild()
+                annotations[link_obj.getParent().getId().getValue()].append((_ns(ann), _kv_pairs(ann)))
+            continue
+
+        rows = query_service.projection(LINK_VERSIONS_QUERY.format(link=link), params, conn.SERVICE_OPTS)
+        round_trips += 1
+        linked = [(row[0].getValue(), row[1].getValue(), row[2].getValue()) for row in rows]
+        versions = {ann_id: update_id for _, ann_id, update_id in linked}
+        values = cache.get(server, versions)
+        stale = [ann_id for ann_id in versions if ann_id not in values]
+        for stale_start in range(0, len(stale), batch_size):
+            ann_params = omero.sys.ParametersI()
+            ann_params.addIds(stale[stale_start:stale_start + batch_size])
+            fetched = query_service.findAllByQuery(ANNOTATIONS_BY_ID_QUERY, ann_params, conn.SERVICE_OPTS)
+            round_trips += 1
+            entries = []
+            for ann in fetched:
+                ann_id = ann.getId().getValue()
+                values[ann_id] = (_ns(ann), _kv_pairs(ann))
+                entries.append((ann_id, versions[ann_id]) + values[ann_id])
+            cache.put(server, entries)
+        for object_id, ann_id, _ in linked:
+            if ann_id in values:  # Skips annotations deleted since the link query.
+                annotations[object_id].append(values[ann_id])
+    return annotations, round_trips
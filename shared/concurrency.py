@@ -0,0 +1,48 @@
+"""
+Fan-out of per-object server work across the worker connections of a ConnectionPool,
+and the chunking of work into batches.
+"""
+
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def map_ordered(func, items, pool, max_pending=None):
+    """Run func(worker_conn, item) for every item on the connections of pool.
+
+    Yields (item, result) in the order of items, whatever order the calls finish in.
+    At most max_pending items (default twice the pool size) are running or waiting to
+    be consumed; a slow consumer holds back new submissions instead of letting the
+    results pile up in memory. An exception in func is raised when its item is reached.
+    """
+    max_pending = max_pending or 2 * pool.size
+
+    def run(item):
+        with pool.connection() as conn:
+            return func(conn, item)
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        try:
+            for item in items:
+                if len(pending) >= max_pending:
+                    done_item, future = pending.popleft()
+                    yield done_item, future.result()
+                pending.append((item, executor.submit(run, item)))
+            while pending:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
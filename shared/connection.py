@@ -0,0 +1,161 @@
+"""
+OMERO connections shared by the transfer scripts.
+
+open_connection() joins the session stored by the previous run when it is still
+alive and only asks for credentials otherwise, so repeated runs log in once. Closing
+with close_connection() detaches from the session instead of ending it. A
+ConnectionPool hands out a bounded number of extra connections joined to the same
+session for calls made from worker threads.
+"""
+
+import getpass
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from omero.gateway import BlitzGateway
+from shared.instrumentation import instrument
+
+SESSION_PATH = os.path.join(os.path.expanduser("~"), ".omero_arc", "session.json")
+DEFAULT_PORT = 4064
+# Interval of the keep-alive pings that stop an idle session from timing out.
+KEEP_ALIVE_SECONDS = 60
+
+
+def load_session(path=SESSION_PATH):
+    """Return the stored {"host", "port", "username", "key"} or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_session(conn, host, port, path=SESSION_PATH):
+    """Store the session key of conn, readable by the current user only."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    session = {
+        "host": host,
+        "port": port,
+        "username": conn.getUser().getName(),
+        "key": conn.getSession().getUuid().getValue(),
+    }
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(session, f)
+
+
+def forget_session(path=SESSION_PATH):
+    """Remove the stored session key."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def join_session(host, port, key, keep_alive=KEEP_ALIVE_SECONDS):
+    """Connect to an existing session by its key. Returns the connection or None."""
+    conn = BlitzGateway(host=host, port=port)
+    try:
+        if not conn.connect(sUuid=key):
+            return None
+    except Exception:
+        return None
+    if keep_alive:
+        conn.c.enableKeepAlive(keep_alive)
+    return instrument(conn)
+
+
+def open_connection(host=None, username=None, password=None, port=DEFAULT_PORT,
+                    reuse=True, session_path=SESSION_PATH, keep_alive=KEEP_ALIVE_SECONDS, interactive=True):
+    """Return a connected BlitzGateway, or None when the login fails.
+
+    With reuse=True the session stored by an earlier run is joined if it is still
+    alive on the requested host. Otherwise missing credentials are prompted for, or
+    with interactive=False the login fails, and the new session key is stored for the
+    next run.
+    """
+    stored = load_session(session_path) if reuse else None
+    if stored and host in (None, "", stored["host"]) and username in (None, "", stored["username"]):
+        conn = join_session(stored["host"], stored.get("port", port), stored["key"], keep_alive)
+        if conn is not None:
+            print(f"Reusing OMERO session of {stored['username']} on {stored['host']}.")
+            return conn
+
+    if not interactive and not (host and username and password):
+        print("No open session to reuse and no host, username and password given.")
+        return None
+    host = host or input("Enter OMERO host: ")
+    username = username or input("Enter OMERO username: ")
+    password = password or getpass.getpass("Enter OMERO password: ")
+    conn = BlitzGateway(username, password, host=host, port=port)
+    if not conn.connect():
+        print("Failed to connect to OMERO. Check your credentials.")
+        return None
+    print("Connected to OMERO successfully!")
+    if keep_alive:
+        conn.c.enableKeepAlive(keep_alive)
+    if reuse:
+        save_session(conn, host, port, session_path)
+    return instrument(conn)
+
+
+def close_connection(conn, keep_session=True):
+    """Close conn. With keep_session the session stays open for the next run."""
+    conn.close(hard=not keep_session)
+
+
+class ConnectionPool:
+    """At most size worker connections joined to the session of conn.
+
+    Connections are opened when first needed and reused afterwards. Use
+    `with pool.connection() as worker_conn:` from any thread; it blocks while all
+    connections are in use.
+    """
+
+    def __init__(self, conn, size, keep_alive=KEEP_ALIVE_SECONDS):
+        self.size = size
+        self.keep_alive = keep_alive
+        self._host = conn.host
+        self._port = conn.port
+        self._key = conn.getSession().getUuid().getValue()
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        conn = join_session(self._host, self._port, self._key, self.keep_alive)
+        if conn is None:
+            raise RuntimeError("Could not open a worker connection to the OMERO session.")
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close the worker connections; the shared session itself is left open."""
+        with self._lock:
+            for conn in self._all:
+                conn.close(hard=False)
+            self._all = []
+        self._idle = queue.LifoQueue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
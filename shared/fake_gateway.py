@@ -0,0 +1,580 @@
+"""
+In-memory stand-in for the parts of BlitzGateway the transfer scripts use.
+
+FakeGateway serves a synthetic hierarchy of projects, datasets and images with
+MapAnnotations and ROIs, generated on demand from the object IDs, so even 10^5
+images take no memory until they are read. The services answer the queries the
+scripts send (matched by their text) and getRoiService().findByImage, and the
+update service and deleteObjects store what is written so it is read back later.
+Every server call sleeps for the configured latency.
+
+    conn = FakeGateway(images_per_dataset=1000, latency=0.002)
+    install()  # before importing ISA_Import, makes MapAnnotationWrapper the fake one
+
+Object IDs are numbered per type from 1: project p has datasets
+(p - 1) * datasets_per_project + 1 ..., likewise for images, ROIs and shapes.
+omero-py is needed for the model classes and rtypes.
+"""
+
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+import omero
+import omero.gateway
+import omero.model
+from omero.rtypes import rdouble, rint, rlong, rstring, unwrap
+from shared.instrumentation import instrument
+
+# Namespaces of the synthetic ISA annotations on every project.
+ISA_NAMESPACES = (
+    "ARC:ISA:INVESTIGATION:INVESTIGATION",
+    "ARC:ISA:STUDY:STUDY",
+    "ARC:ISA:ASSAY:ASSAY DATA FILES",
+)
+IMAGE_NAMESPACE = "openmicroscopy.org/omero/client/mapAnnotation"
+SHAPE_TYPES = ("Rectangle", "Ellipse", "Point", "Polygon", "Line")
+
+_LINKED_ANNOTATIONS = re.compile(r"from (\w+)AnnotationLink l join fetch l\.child")
+_LINK_VERSIONS = re.compile(r"select l\.parent\.id, a\.id, a\.details\.updateEvent\.id from (\w+)AnnotationLink")
+_CHILDREN = re.compile(r"select l\.child from (\w+)Link l")
+_CHILD_NAMES = re.compile(r"select c\.id, c\.name from (\w+)Link l")
+_SHAPE_CLASSES = re.compile(r"s\.class in \(([^)]*)\)")
+# Synthetic shapes are spread over this many Z planes.
+SIZE_Z_SHAPES = 3
+
+
+class _Record:
+    """A project, dataset or image of the synthetic hierarchy."""
+    __slots__ = ("type", "id", "name")
+
+    def __init__(self, object_type, object_id, name):
+        self.type = object_type
+        self.id = object_id
+        self.name = name
+
+
+class FakeBlitzObject:
+    """Wrapper of a project, dataset or image, like BlitzObjectWrapper."""
+
+    def __init__(self, conn, record):
+        self._conn = conn
+        self.OMERO_CLASS = record.type
+        self._id = record.id
+        self._name = record.name
+        self._obj = getattr(omero.model, f"{record.type}I")(record.id, False)
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._name
+
+    def listChildren(self):
+        child_link = {"Project": "ProjectDataset", "Dataset": "DatasetImage"}[self.OMERO_CLASS]
+        params = omero.sys.ParametersI()
+        params.addId(self._id)
+        records = self._conn.getQueryService().findAllByQuery(
+            f"select l.child from {child_link}Link l where l.parent.id = :id order by l.id", params, None)
+        return (FakeBlitzObject(self._conn, record) for record in records)
+
+    def listAnnotations(self):
+        params = omero.sys.ParametersI()
+        params.addIds([self._id])
+        links = self._conn.getQueryService().findAllByQuery(
+            f"select distinct l from {self.OMERO_CLASS}AnnotationLink l join fetch l.child a "
+            "left outer join fetch a.mapValue where l.parent.id in (:ids) order by l.id", params, None)
+        return (FakeMapAnnotationWrapper(self._conn, link.getChild()) for link in links)
+
+    def linkAnnotation(self, ann):
+        link = getattr(omero.model, f"{self.OMERO_CLASS}AnnotationLinkI")()
+        link.setParent(self._obj)
+        link.setChild(ann._obj)
+        self._conn.getUpdateService().saveObject(link, None)
+        return ann
+
+    # Image dimensions, as ImageWrapper reports them.
+    def getSizeX(self):
+        return self._conn.store.image_size(self._id)[0]
+
+    def getSizeY(self):
+        return self._conn.store.image_size(self._id)[1]
+
+    def getSizeZ(self):
+        return self._conn.store.image_size(self._id)[2]
+
+    def getSizeC(self):
+        return self._conn.store.image_size(self._id)[3]
+
+    def getSizeT(self):
+        return self._conn.store.image_size(self._id)[4]
+
+
+class FakeMapAnnotationWrapper:
+    """MapAnnotationWrapper over an omero.model.MapAnnotationI."""
+    OMERO_CLASS = "MapAnnotation"
+
+    def __init__(self, conn=None, obj=None):
+        self._conn = conn
+        self._obj = obj if obj is not None else omero.model.MapAnnotationI()
+
+    def getId(self):
+        return self._obj.getId().getValue()
+
+    def getNs(self):
+        ns = self._obj.getNs()
+        return ns.getValue() if ns is not None else None
+
+    def setNs(self, ns):
+        self._obj.setNs(rstring(ns))
+
+    def getValue(self):
+        return [(nv.name, nv.value) for nv in self._obj.getMapValue() or []]
+
+    def setValue(self, kv_pairs):
+        self._obj.setMapValue([omero.model.NamedValue(key, value) for key, value in kv_pairs])
+
+    def save(self):
+        self._obj = self._conn.getUpdateService().saveAndReturnObject(self._obj, None)
+
+
+class FakeStore:
+    """The synthetic hierarchy plus everything saved or deleted since it was created."""
+
+    def __init__(self, projects=1, datasets_per_project=1, images_per_dataset=10, annotations_per_image=2,
+                 keys_per_annotation=5, rois_per_image=3, shapes_per_roi=2, isa_keys=10):
+        self.projects = projects
+        self.datasets_per_project = datasets_per_project
+        self.images_per_dataset = images_per_dataset
+        self.annotations_per_image = annotations_per_image
+        self.keys_per_annotation = keys_per_annotation
+        self.rois_per_image = rois_per_image
+        self.shapes_per_roi = shapes_per_roi
+        self.isa_keys = isa_keys
+        n_images = projects * datasets_per_project * images_per_dataset
+        # Annotation IDs: image annotations first, then project annotations, then saved ones.
+        self._project_annotation_base = n_images * annotations_per_image
+        self._next_annotation = itertools.count(self._project_annotation_base + projects * len(ISA_NAMESPACES) + 1)
+        self._next_roi = itertools.count(n_images * rois_per_image + 1)
+        self._next_shape = itertools.count(n_images * rois_per_image * shapes_per_roi + 1)
+        self._next_link = itertools.count(1)
+        self._next_event = itertools.count(2)
+        self.annotations = {}      # ann_id -> (ns, kv_pairs, update_id), overrides the synthetic values
+        self.deleted = set()
+        self.extra_links = {}      # (type, parent_id) -> [ann_id]
+        self.saved_rois = {}       # image_id -> [RoiI]
+        self._lock = threading.Lock()
+
+    # Hierarchy
+    def exists(self, object_type, object_id):
+        count = {"Project": self.projects,
+                 "Dataset": self.projects * self.datasets_per_project,
+                 "Image": self.projects * self.datasets_per_project * self.images_per_dataset}.get(object_type, 0)
+        return 1 <= object_id <= count
+
+    def record(self, object_type, object_id):
+        return _Record(object_type, object_id, f"{object_type.lower()} {object_id}")
+
+    def children(self, parent_type, parent_id, offset=0, limit=None):
+        per_parent = self.datasets_per_project if parent_type == "Project" else self.images_per_dataset
+        child_type = "Dataset" if parent_type == "Project" else "Image"
+        first = (parent_id - 1) * per_parent + 1
+        count = per_parent - offset if limit is None else min(limit, per_parent - offset)
+        return [self.record(child_type, child_id) for child_id in range(first + offset, first + offset + count)]
+
+    def image_size(self, image_id):
+        return 512 + 256 * (image_id % 3), 512, 1 + image_id % 5, 1 + image_id % 4, 1
+
+    # Annotations
+    def linked_annotation_ids(self, object_type, object_id):
+        if object_type == "Image":
+            first = (object_id - 1) * self.annotations_per_image + 1
+            ids = list(range(first, first + self.annotations_per_image))
+        elif object_type == "Project":
+            first = self._project_annotation_base + (object_id - 1) * len(ISA_NAMESPACES) + 1
+            ids = list(range(first, first + len(ISA_NAMESPACES)))
+        else:
+            ids = []
+        ids += self.extra_links.get((object_type, object_id), [])
+        return [ann_id for ann_id in ids if ann_id not in self.deleted]
+
+    def annotation(self, ann_id):
+        """Return (ns, kv_pairs, update_id) of an annotation."""
+        if ann_id in self.annotations:
+            return self.annotations[ann_id]
+        if ann_id > self._project_annotation_base:
+            index = ann_id - self._project_annotation_base - 1
+            ns = ISA_NAMESPACES[index % len(ISA_NAMESPACES)]
+            kv_pairs = [(f"{ns.split(':')[-1].title()} Key {k}", f"'value {k}', 'value {k + 1}'")
+                        for k in range(self.isa_keys)]
+        else:
+            image_id, j = divmod(ann_id - 1, self.annotations_per_image)
+            ns = IMAGE_NAMESPACE if j == 0 else f"bench/ns{j}"
+            kv_pairs = [(f"Key{j}_{k}", f"value {image_id + 1}.{k}") for k in range(self.keys_per_annotation)]
+        return ns, kv_pairs, 1
+
+    def annotation_object(self, ann_id):
+        ns, kv_pairs, _ = self.annotation(ann_id)
+        ann = omero.model.MapAnnotationI()
+        ann.setId(rlong(ann_id))
+        ann.setNs(rstring(ns) if ns is not None else None)
+        ann.setMapValue([omero.model.NamedValue(key, value) for key, value in kv_pairs])
+        return ann
+
+    def link_object(self, object_type, object_id, ann_id):
+        link = getattr(omero.model, f"{object_type}AnnotationLinkI")()
+        link.setParent(getattr(omero.model, f"{object_type}I")(object_id, False))
+        link.setChild(self.annotation_object(ann_id))
+        return link
+
+    def save_annotation(self, ann):
+        """Store a new or changed MapAnnotationI and return its ID."""
+        with self._lock:
+            if ann.getId() is None:
+                ann.setId(rlong(next(self._next_annotation)))
+            ns = ann.getNs().getValue() if ann.getNs() is not None else None
+            kv_pairs = [(nv.name, nv.value) for nv in ann.getMapValue() or []]
+            self.annotations[ann.getId().getValue()] = (ns, kv_pairs, next(self._next_event))
+        return ann.getId().getValue()
+
+    def save_link(self, link):
+        ann_id = self.save_annotation(link.getChild())
+        parent = link.getParent()
+        object_type = type(parent).__name__[:-1]
+        with self._lock:
+            link.setId(rlong(next(self._next_link)))
+            self.extra_links.setdefault((object_type, parent.getId().getValue()), []).append(ann_id)
+
+    # ROIs
+    def rois(self, image_id, offset=0, limit=None):
+        first = (image_id - 1) * self.rois_per_image + 1
+        end = self.rois_per_image if limit is None else min(self.rois_per_image, offset + limit)
+        rois = [self.roi_object(image_id, roi_id) for roi_id in range(first + offset, first + end)]
+        saved = self.saved_rois.get(image_id, [])
+        saved_offset = max(0, offset - self.rois_per_image)
+        saved_limit = None if limit is None else limit - len(rois)
+        return rois + saved[saved_offset:None if saved_limit is None else saved_offset + saved_limit]
+
+    def roi_by_id(self, roi_id):
+        synthetic = self.projects * self.datasets_per_project * self.images_per_dataset * self.rois_per_image
+        if roi_id <= synthetic:
+            return self.roi_object((roi_id - 1) // self.rois_per_image + 1, roi_id)
+        return next((roi for rois in self.saved_rois.values() for roi in rois if roi.getId().getValue() == roi_id),
+                    None)
+
+    def roi_count(self, image_id):
+        return self.rois_per_image + len(self.saved_rois.get(image_id, []))
+
+    def roi_object(self, image_id, roi_id):
+        roi = omero.model.RoiI()
+        roi.setId(rlong(roi_id))
+        roi.setImage(omero.model.ImageI(image_id, False))
+        first = (roi_id - 1) * self.shapes_per_roi + 1
+        for shape_id in range(first, first + self.shapes_per_roi):
+            roi.addShape(make_shape(shape_id))
+        return roi
+
+    def save_roi(self, roi):
+        with self._lock:
+            roi.setId(rlong(next(self._next_roi)))
+            for shape in roi.copyShapes():
+                shape.setId(rlong(next(self._next_shape)))
+            self.saved_rois.setdefault(roi.getImage().getId().getValue(), []).append(roi)
+
+
+def make_shape(shape_id):
+    """Create the synthetic shape with the given ID; the type cycles through SHAPE_TYPES."""
+    kind = SHAPE_TYPES[shape_id % len(SHAPE_TYPES)]
+    x, y = float(shape_id % 500), float(shape_id % 300)
+    if kind == "Rectangle":
+        s = omero.model.RectangleI()
+        s.setX(rdouble(x)); s.setY(rdouble(y)); s.setWidth(rdouble(20)); s.setHeight(rdouble(10))
+    elif kind == "Ellipse":
+        s = omero.model.EllipseI()
+        s.setX(rdouble(x)); s.setY(rdouble(y)); s.setRadiusX(rdouble(6)); s.setRadiusY(rdouble(4))
+    elif kind == "Point":
+        s = omero.model.PointI()
+        s.setX(rdouble(x)); s.setY(rdouble(y))
+    elif kind == "Polygon":
+        s = omero.model.PolygonI()
+        s.setPoints(rstring(f"{x},{y} {x + 10},{y} {x + 10},{y + 10} {x},{y + 10}"))
+    else:
+        s = omero.model.LineI()
+        s.setX1(rdouble(x)); s.setY1(rdouble(y)); s.setX2(rdouble(x + 15)); s.setY2(rdouble(y + 5))
+    s.setId(rlong(shape_id))
+    s.setTheZ(rint(shape_id // len(SHAPE_TYPES) % SIZE_Z_SHAPES))
+    s.setTheT(rint(0))
+    s.setStrokeColor(rint(-16776961))
+    return s
+
+
+class _Service:
+    def __init__(self, conn):
+        self._conn = conn
+        self._store = conn.store
+
+    def _wait(self):
+        if self._conn.latency:
+            time.sleep(self._conn.latency)
+
+
+class FakeQueryService(_Service):
+    """Answers the HQL the scripts send, recognised by the text of the query."""
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._selections = {}   # filtered ROI ID queries -> matching ROI IDs
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self._wait()
+        store = self._store
+        match = _CHILDREN.search(query)
+        if match:
+            parent_type = "Project" if match.group(1) == "ProjectDataset" else "Dataset"
+            return store.children(parent_type, _param(params, "id"), *_page(params))
+        match = _LINKED_ANNOTATIONS.search(query)
+        if match:
+            object_type = match.group(1)
+            return [store.link_object(object_type, object_id, ann_id)
+                    for object_id in _param(params, "ids")
+                    for ann_id in store.linked_annotation_ids(object_type, object_id)]
+        if "from MapAnnotation a" in query:
+            return [store.annotation_object(ann_id) for ann_id in _param(params, "ids")
+                    if ann_id not in store.deleted]
+        if "fetch r.shapes s" in query:
+            select = _roi_selection(query, params)
+            ids = _param(params, "ids")
+            if "r.id in (:ids)" in query:
+                rois = [store.roi_by_id(roi_id) for roi_id in ids]
+            else:
+                rois = [roi for image_id in ids for roi in store.rois(image_id)]
+            return [selected for selected in map(select, rois) if selected is not None]
+        if "from Roi r" in query:
+            return [roi for image_id in _param(params, "ids") for roi in store.rois(image_id)]
+        raise NotImplementedError(f"FakeQueryService does not know this query: {query}")
+
+    def projection(self, query, params, ctx=None):
+        self._wait()
+        store = self._store
+        match = _LINK_VERSIONS.search(query)
+        if match:
+            object_type = match.group(1)
+            return [[rlong(object_id), rlong(ann_id), rlong(store.annotation(ann_id)[2])]
+                    for object_id in _param(params, "ids")
+                    for ann_id in store.linked_annotation_ids(object_type, object_id)]
+        if "from DatasetImageLink l join l.child i join i.pixels p" in query:
+            return [[rlong(record.id), rstring(record.name)] + [rint(size) for size in store.image_size(record.id)]
+                    for record in store.children("Dataset", _param(params, "id"), *_page(params))]
+        match = _CHILD_NAMES.search(query)
+        if match:
+            parent_type = "Project" if match.group(1) == "ProjectDataset" else "Dataset"
+            return [[rlong(record.id), rstring(record.name)]
+                    for record in store.children(parent_type, _param(params, "id"), *_page(params))]
+        if "select i.id from Image i where i.id in (:ids)" in query:
+            return [[rlong(image_id)] for image_id in _param(params, "ids") if store.exists("Image", image_id)]
+        if "select distinct r.id from Roi r" in query:
+            # The matching IDs are kept per image and filter, so paging through them stays linear.
+            key = (query, tuple(sorted((name, repr(unwrap(value))) for name, value in params.map.items())))
+            roi_ids = self._selections.get(key)
+            if roi_ids is None:
+                select = _roi_selection(query, params)
+                image_id = _param(params, "id")
+                roi_ids = self._selections[key] = [
+                    roi.getId().getValue()
+                    for offset in range(0, store.roi_count(image_id), 1000)
+                    for roi in store.rois(image_id, offset, 1000) if select(roi) is not None]
+            offset, limit = _page(params)
+            return [[rlong(roi_id)] for roi_id in roi_ids[offset:None if limit is None else offset + limit]]
+        if "count(distinct r.id) from Roi r" in query:
+            select = _roi_selection(query, params)
+            counts = {image_id: sum(select(roi) is not None for roi in store.rois(image_id))
+                      for image_id in _param(params, "ids")}
+            return [[rlong(image_id), rlong(count)] for image_id, count in counts.items() if count]
+        if "count(r.id) from Roi r" in query:
+            return [[rlong(image_id), rlong(store.roi_count(image_id))] for image_id in _param(params, "ids")
+                    if store.roi_count(image_id)]
+        raise NotImplementedError(f"FakeQueryService does not know this projection: {query}")
+
+    def find(self, object_type, object_id, ctx=None):
+        self._wait()
+        return self._store.record(object_type, object_id) if self._store.exists(object_type, object_id) else None
+
+
+class FakeUpdateService(_Service):
+    """Stores saved ROIs, annotation links and annotations."""
+
+    def _save(self, obj):
+        if isinstance(obj, omero.model.RoiI):
+            self._store.save_roi(obj)
+        elif isinstance(obj, omero.model.MapAnnotationI):
+            self._store.save_annotation(obj)
+        elif type(obj).__name__.endswith("AnnotationLinkI"):
+            self._store.save_link(obj)
+        else:
+            raise NotImplementedError(f"FakeUpdateService cannot save {type(obj).__name__}")
+        return obj
+
+    def saveObject(self, obj, ctx=None):
+        self._wait()
+        self._save(obj)
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._wait()
+        return self._save(obj)
+
+    def saveArray(self, objs, ctx=None):
+        self._wait()
+        for obj in objs:
+            self._save(obj)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._wait()
+        return [self._save(obj) for obj in objs]
+
+
+class _RoiResult:
+    def __init__(self, rois):
+        self.rois = rois
+
+
+class FakeRoiService(_Service):
+
+    def findByImage(self, image_id, options, ctx=None):
+        self._wait()
+        if options is None or options.limit is None:
+            return _RoiResult(self._store.rois(image_id))
+        return _RoiResult(self._store.rois(image_id, unwrap(options.offset) or 0, unwrap(options.limit)))
+
+
+class FakeGateway:
+    """Connected BlitzGateway stand-in over a FakeStore; see the module docstring.
+
+    Keyword arguments other than latency (seconds slept per server call) size the
+    synthetic data and are passed to FakeStore.
+    """
+    host = "fake"
+    port = 4064
+    SERVICE_OPTS = None
+
+    def __init__(self, latency=0.0, store=None, username="fake", **scale):
+        self.latency = latency
+        self.username = username
+        self.store = store or FakeStore(**scale)
+        self._query = FakeQueryService(self)
+        self._update = FakeUpdateService(self)
+        self._roi = FakeRoiService(self)
+
+    def connect(self, sUuid=None):
+        return True
+
+    def close(self, hard=True):
+        pass
+
+    def isConnected(self):
+        return True
+
+    def getQueryService(self):
+        return self._query
+
+    def getUpdateService(self):
+        return self._update
+
+    def getRoiService(self):
+        return self._roi
+
+    def getUser(self):
+        return FakeBlitzObject(self, _Record("Experimenter", 1, self.username))
+
+    def getObject(self, object_type, oid=None):
+        record = self.getQueryService().find(object_type, int(oid))
+        return FakeBlitzObject(self, record) if record is not None else None
+
+    def deleteObjects(self, object_type, ids, wait=False, **kwargs):
+        if object_type != "Annotation":
+            raise NotImplementedError(f"FakeGateway cannot delete {object_type} objects")
+        if self.latency:
+            time.sleep(self.latency)
+        with self.store._lock:
+            self.store.deleted.update(ids)
+
+
+class FakeConnectionPool:
+    """ConnectionPool over FakeGateway connections sharing one store."""
+
+    def __init__(self, conn, size):
+        self.size = size
+        self._conns = [instrument(FakeGateway(conn.latency, conn.store, conn.username)) for _ in range(size)]
+        self._free = list(self._conns)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._free)
+            conn = self._free.pop()
+        try:
+            yield conn
+        finally:
+            with self._condition:
+                self._free.append(conn)
+                self._condition.notify()
+
+    def close(self):
+        pass
+
+
+def install():
+    """Make omero.gateway.MapAnnotationWrapper the fake wrapper, for the scripts' isinstance checks.
+
+    Call it before the scripts are imported.
+    """
+    omero.gateway.MapAnnotationWrapper = FakeMapAnnotationWrapper
+
+
+def _param(params, name):
+    return unwrap(params.map[name])
+
+
+def _roi_selection(query, params):
+    """Return a function applying the RoiFilter conditions of a query to a ROI.
+
+    It returns a copy of the ROI with the matching shapes, or None when the ROI is not selected.
+    """
+    match = _SHAPE_CLASSES.search(query)
+    types = {name.strip() for name in match.group(1).split(",")} if match else None
+    roi_ids = set(_param(params, "roi_ids")) if "roi_ids" in params.map else None
+    ranges = [(getter, _param(params, f"{axis}_first"), _param(params, f"{axis}_last"))
+              for axis, getter in (("z", "getTheZ"), ("t", "getTheT")) if f"{axis}_first" in params.map]
+    inner = "left outer join" not in query
+
+    def on_planes(shape):
+        for getter, first, last in ranges:
+            index = unwrap(getattr(shape, getter)())
+            if index is not None and not first <= index <= last:
+                return False
+        return True
+
+    def select(roi):
+        if roi is None or roi_ids is not None and roi.getId().getValue() not in roi_ids:
+            return None
+        shapes = [shape for shape in roi.copyShapes()
+                  if (types is None or type(shape).__name__[:-1] in types) and on_planes(shape)]
+        if inner and not shapes:
+            return None
+        selected = omero.model.RoiI()
+        selected.setId(roi.getId())
+        selected.setImage(roi.getImage())
+        for shape in shapes:
+            selected.addShape(shape)
+        return selected
+
+    return select
+
+
+def _page(params):
+    """Return (offset, limit) set with ParametersI.page(), or (0, None)."""
+    page = getattr(params, "theFilter", None)
+    if page is None or page.limit is None:
+        return 0, None
+    return unwrap(page.offset) or 0, unwrap(page.limit)
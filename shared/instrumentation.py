@@ -0,0 +1,244 @@
+"""
+Counters and timers for the transfer scripts, switched on with --profile.
+
+While enabled, every connection opened through shared.connection counts its server
+calls by service and method, phase() blocks add up the time spent per phase
+(fetch, transform, serialize, write, ...) and written() adds up the bytes of the
+output files. Phase times are summed over all threads, so with concurrent workers
+they can exceed the wall-clock time. With --cprofile the blocks marked profiled()
+are run under cProfile and the statistics are dumped for pstats/snakeviz.
+
+Everything here is a no-op when instrumentation is not enabled.
+"""
+
+import collections
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Gateway methods returning the services whose calls are counted.
+SERVICE_GETTERS = {
+    "getQueryService": "query",
+    "getUpdateService": "update",
+    "getRoiService": "roi",
+    "getContainerService": "container",
+    "getMetadataService": "metadata",
+    "getAdminService": "admin",
+}
+# Gateway methods that talk to the server without going through a service getter.
+GATEWAY_CALLS = ("deleteObjects",)
+
+_active = None
+
+
+class Instrumentation:
+    """Thread-safe counters of server calls, phase times and bytes written."""
+
+    def __init__(self, cprofile=False):
+        self.started = time.perf_counter()
+        self.calls = collections.Counter()
+        self.call_seconds = collections.Counter()
+        self.phases = collections.Counter()
+        self.phase_counts = collections.Counter()
+        self.bytes_written = 0
+        self.files_written = 0
+        self.profiler = cProfile.Profile() if cprofile else None
+        self._profile_depth = 0
+        self._lock = threading.Lock()
+
+    def record_call(self, name, seconds):
+        with self._lock:
+            self.calls[name] += 1
+            self.call_seconds[name] += seconds
+
+    def record_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] += seconds
+            self.phase_counts[name] += 1
+
+    def record_bytes(self, count, files=1):
+        with self._lock:
+            self.bytes_written += count
+            self.files_written += files
+
+    def report(self):
+        """Return the collected numbers as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "wall_seconds": round(time.perf_counter() - self.started, 6),
+                "server_calls": sum(self.calls.values()),
+                "calls": {name: {"count": self.calls[name], "seconds": round(self.call_seconds[name], 6)}
+                          for name in sorted(self.calls)},
+                "phases": {name: {"count": self.phase_counts[name], "seconds": round(self.phases[name], 6)}
+                           for name in sorted(self.phases)},
+                "bytes_written": self.bytes_written,
+                "files_written": self.files_written,
+            }
+
+
+class _CountingService:
+    """Proxy of an OMERO service that records every method call."""
+
+    def __init__(self, service, name, instrumentation):
+        self._service = service
+        self._name = name
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, attr):
+        method = getattr(self._service, attr)
+        if not callable(method):
+            return method
+        name = f"{self._name}.{attr}"
+        instrumentation = self._instrumentation
+
+        def counted(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                instrumentation.record_call(name, time.perf_counter() - start)
+        return counted
+
+
+def _counting(function, name, instrumentation):
+    def counted(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            instrumentation.record_call(name, time.perf_counter() - start)
+    return counted
+
+
+def enable(cprofile=False):
+    """Start collecting; returns the active Instrumentation."""
+    global _active
+    _active = Instrumentation(cprofile)
+    return _active
+
+
+def active():
+    """Return the active Instrumentation or None."""
+    return _active
+
+
+def instrument(conn):
+    """Count the server calls made through conn, if instrumentation is enabled.
+
+    The service getters are replaced on this gateway instance only. The object
+    wrappers it returns (listAnnotations, listChildren, getValue, ...) fetch their
+    services from the same instance, so their calls are counted too.
+    """
+    instrumentation = _active
+    if instrumentation is None or conn is None:
+        return conn
+    for getter, name in SERVICE_GETTERS.items():
+        original = getattr(conn, getter, None)
+        if original is not None:
+            setattr(conn, getter, lambda *args, _get=original, _name=name, **kwargs:
+                    _CountingService(_get(*args, **kwargs), _name, instrumentation))
+    for method in GATEWAY_CALLS:
+        original = getattr(conn, method, None)
+        if original is not None:
+            setattr(conn, method, _counting(original, f"gateway.{method}", instrumentation))
+    return conn
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to the named phase."""
+    instrumentation = _active
+    if instrumentation is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrumentation.record_phase(name, time.perf_counter() - start)
+
+
+def iter_phase(iterable, name):
+    """Yield from iterable, adding the time spent producing each item to the named phase.
+
+    For lazy readers and generators, whose work happens while they are iterated.
+    """
+    if _active is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def profiled():
+    """Run the block under cProfile when --cprofile is given.
+
+    Only blocks on the main thread are profiled; nested blocks share the outer one.
+    """
+    instrumentation = _active
+    if (instrumentation is None or instrumentation.profiler is None
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+    instrumentation._profile_depth += 1
+    if instrumentation._profile_depth == 1:
+        instrumentation.profiler.enable()
+    try:
+        yield
+    finally:
+        instrumentation._profile_depth -= 1
+        if instrumentation._profile_depth == 0:
+            instrumentation.profiler.disable()
+
+
+def written(*paths):
+    """Record the size of output files that were just written."""
+    instrumentation = _active
+    if instrumentation is None:
+        return
+    existing = [path for path in paths if os.path.exists(path)]
+    instrumentation.record_bytes(sum(os.path.getsize(path) for path in existing), len(existing))
+
+
+def add_arguments(parser):
+    """Add --profile and --cprofile to an argparse parser."""
+    parser.add_argument("--profile", metavar="PATH",
+                        help="write server call counts, phase times and bytes written as JSON (- for stderr)")
+    parser.add_argument("--cprofile", metavar="PATH", help="also run the main loops under cProfile and dump the stats")
+
+
+def start(args):
+    """Enable instrumentation if --profile or --cprofile was given."""
+    if args.profile or args.cprofile:
+        return enable(cprofile=bool(args.cprofile))
+    return None
+
+
+def finish(args):
+    """Write the JSON report and the cProfile stats requested on the command line."""
+    instrumentation = _active
+    if instrumentation is None:
+        return None
+    report = instrumentation.report()
+    if args.cprofile:
+        instrumentation.profiler.dump_stats(args.cprofile)
+        report["cprofile"] = args.cprofile
+    output = json.dumps(report, indent=2)
+    if not args.profile or args.profile == "-":
+        print(output, file=sys.stderr)
+    else:
+        with open(args.profile, "w") as f:
+            f.write(output + "\n")
+        print(f"Profile written to {args.profile}")
+    return report
@@ -0,0 +1,140 @@
+"""
+Paged traversal of large containers and ROI-heavy images.
+
+dataset.listChildren() and findByImage(image_id, None) load the whole result set in
+one call. The generators here fetch it page_size objects at a time with offset/limit
+and are consumed lazily, so memory is bounded by the page size instead of by the
+size of the dataset or image.
+
+The ROI functions take an optional RoiFilter (shared/roi_filters.py) whose conditions
+are added to the queries, so only the selected ROIs and shapes leave the server.
+"""
+
+import omero
+import omero.api
+import omero.sys
+from omero.rtypes import rint, unwrap
+from shared.instrumentation import phase
+
+DEFAULT_PAGE_SIZE = 1000
+
+# Link class from a container type to its children.
+CHILD_LINKS = {"Project": "ProjectDatasetLink", "Dataset": "DatasetImageLink"}
+
+# ID and name of the children of a container, in link order.
+CHILD_NAMES_QUERY = (
+    "select c.id, c.name from {link} l join l.child c "
+    "where l.parent.id = :id "
+    "order by l.id"
+)
+
+# Number of ROIs of each of a set of images.
+ROI_COUNTS_QUERY = (
+    "select r.image.id, count(r.id) from Roi r "
+    "where r.image.id in (:ids) "
+    "group by r.image.id"
+)
+
+# The same with a RoiFilter: {join} and {filters} come from the filter.
+FILTERED_ROI_COUNTS_QUERY = (
+    "select r.image.id, count(distinct r.id) from Roi r {join} r.shapes s "
+    "where r.image.id in (:ids){filters} "
+    "group by r.image.id"
+)
+
+# IDs of the ROIs of an image that pass a RoiFilter, for paging.
+FILTERED_ROI_IDS_QUERY = (
+    "select distinct r.id from Roi r {join} r.shapes s "
+    "where r.image.id = :id{filters} "
+    "order by r.id"
+)
+
+# ROIs of a set of images (key "image.id") or ROI IDs (key "id") that pass a RoiFilter,
+# loaded with their matching shapes only.
+FILTERED_ROIS_QUERY = (
+    "select distinct r from Roi r {join} fetch r.shapes s "
+    "where r.{key} in (:ids){filters} "
+    "order by r.id"
+)
+
+
+def iter_children(conn, parent_type, parent_id, page_size=DEFAULT_PAGE_SIZE):
+    """Yield (ID, name) of every dataset of a project or image of a dataset, one page per query."""
+    query = CHILD_NAMES_QUERY.format(link=CHILD_LINKS[parent_type])
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addId(int(parent_id))
+        params.page(offset, page_size)
+        with phase("fetch"):
+            rows = unwrap(conn.getQueryService().projection(query, params, conn.SERVICE_OPTS))
+        for child_id, name in rows:
+            yield child_id, name
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def iter_rois(conn, image_id, page_size=DEFAULT_PAGE_SIZE, roi_filter=None):
+    """Yield the ROIs of an image, with their shapes, fetching page_size ROIs per findByImage call.
+
+    With a RoiFilter the IDs of the matching ROIs are paged through a projection query
+    and each page is loaded with its matching shapes by find_filtered_rois().
+    """
+    if roi_filter:
+        yield from iter_filtered_rois(conn, image_id, page_size, roi_filter)
+        return
+    roi_service = conn.getRoiService()
+    offset = 0
+    while True:
+        options = omero.api.RoiOptions()
+        options.offset = rint(offset)
+        options.limit = rint(page_size)
+        with phase("fetch"):
+            rois = roi_service.findByImage(int(image_id), options, conn.SERVICE_OPTS).rois
+        yield from rois
+        if len(rois) < page_size:
+            return
+        offset += page_size
+
+
+def iter_filtered_rois(conn, image_id, page_size, roi_filter):
+    """Yield the ROIs of an image that pass roi_filter, page_size per query."""
+    query = FILTERED_ROI_IDS_QUERY.format(join=roi_filter.join(), filters=roi_filter.conditions())
+    offset = 0
+    while True:
+        params = roi_filter.add_parameters(omero.sys.ParametersI())
+        params.addId(int(image_id))
+        params.page(offset, page_size)
+        with phase("fetch"):
+            roi_ids = [row[0] for row in unwrap(conn.getQueryService().projection(query, params, conn.SERVICE_OPTS))]
+        if roi_ids:
+            yield from find_filtered_rois(conn, "id", roi_ids, roi_filter)
+        if len(roi_ids) < page_size:
+            return
+        offset += page_size
+
+
+def find_filtered_rois(conn, key, ids, roi_filter):
+    """Load the ROIs of some images (key "image.id") or ROI IDs (key "id") that pass roi_filter, in ROI order."""
+    query = FILTERED_ROIS_QUERY.format(join=roi_filter.join(), key=key, filters=roi_filter.conditions())
+    params = roi_filter.add_parameters(omero.sys.ParametersI())
+    params.addIds(list(ids))
+    with phase("fetch"):
+        return conn.getQueryService().findAllByQuery(query, params, conn.SERVICE_OPTS)
+
+
+def fetch_roi_counts(conn, image_ids, roi_filter=None):
+    """Return {image ID: number of ROIs} of the given images from one projection query.
+
+    With a RoiFilter only the ROIs that pass it are counted.
+    """
+    params = omero.sys.ParametersI()
+    params.addIds(list(image_ids))
+    query = ROI_COUNTS_QUERY
+    if roi_filter:
+        query = FILTERED_ROI_COUNTS_QUERY.format(join=roi_filter.join(), filters=roi_filter.conditions())
+        roi_filter.add_parameters(params)
+    with phase("fetch"):
+        rows = unwrap(conn.getQueryService().projection(query, params, conn.SERVICE_OPTS))
+    return {image_id: count for image_id, count in rows}
@@ -0,0 +1,134 @@
+"""
+Server-side selection of ROIs and shapes by shape type, Z/T plane and ROI ID.
+
+A RoiFilter adds its conditions to the HQL queries of shared/paging.py, so shapes
+that do not match are never loaded by the server nor sent to the client. ROIs keep
+only their matching shapes and ROIs without any are left out. Shapes without a Z
+(or T) index lie on every plane and match any Z (or T) range.
+
+    roi_filter = RoiFilter(shape_types=["Polygon"], z_range=(3, 3))
+    for roi in iter_rois(conn, image_id, roi_filter=roi_filter): ...
+"""
+
+from omero.rtypes import rint, rlist, rlong
+
+# OMERO shape classes, as named in HQL.
+SHAPE_TYPES = ("Rectangle", "Ellipse", "Point", "Line", "Polyline", "Polygon", "Mask", "Label")
+
+
+def checked_range(first, last, value):
+    """Return (first, last) if it is a valid plane range, else raise ValueError naming value."""
+    if first < 0 or last < first:
+        raise ValueError(f"Invalid plane range {value!r}, expected e.g. 3 or 2-5.")
+    return first, last
+
+
+def parse_range(text):
+    """Parse a plane index "3" or an inclusive range "2-5" into (first, last)."""
+    first, _, last = str(text).partition("-")
+    return checked_range(int(first), int(last or first), text)
+
+
+def plane_range(value):
+    """Return (first, last) from a manifest or CLI value: None, an index, "2-5" or a [first, last] list."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2:
+            raise ValueError(f"Invalid plane range {value!r}, expected [first, last].")
+        return checked_range(int(value[0]), int(value[1]), value)
+    return parse_range(value)
+
+
+def split_list(value):
+    """Return a list from a list or a comma separated string (CSV and YAML manifests)."""
+    if value is None or isinstance(value, (list, tuple)):
+        return value
+    return [item.strip() for item in str(value).split(",") if item.strip()]
+
+
+class RoiFilter:
+    """Conditions on the ROIs and shapes fetched from the server; false when it has none.
+
+    shape_types are shape class names (see SHAPE_TYPES), z_range and t_range inclusive
+    (first, last) plane indices, as theZ/theT in the exported files, and roi_ids ROI IDs.
+    """
+
+    def __init__(self, shape_types=None, z_range=None, t_range=None, roi_ids=None):
+        unknown = set(shape_types or ()) - set(SHAPE_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown shape types {', '.join(sorted(unknown))}, expected {', '.join(SHAPE_TYPES)}.")
+        self.shape_types = list(shape_types or [])
+        self.z_range = z_range
+        self.t_range = t_range
+        self.roi_ids = [int(roi_id) for roi_id in roi_ids or []]
+
+    @classmethod
+    def from_fields(cls, shape_types=None, z=None, t=None, roi_ids=None):
+        """Build a filter from manifest fields or CLI values; strings are split or parsed."""
+        return cls(split_list(shape_types), plane_range(z), plane_range(t), split_list(roi_ids))
+
+    def __bool__(self):
+        return bool(self.shape_types or self.z_range or self.t_range or self.roi_ids)
+
+    def filters_shapes(self):
+        """True when shapes are selected, not only ROI IDs."""
+        return bool(self.shape_types or self.z_range or self.t_range)
+
+    def join(self):
+        """Join of the shapes: inner when shapes are filtered, so ROIs without a matching shape drop out."""
+        return "join" if self.filters_shapes() else "left outer join"
+
+    def conditions(self):
+        """HQL conditions on Roi r and Shape s, each preceded by " and "."""
+        conditions = []
+        if self.roi_ids:
+            conditions.append("r.id in (:roi_ids)")
+        if self.shape_types:
+            # Class names cannot be bound as parameters; they are checked against SHAPE_TYPES.
+            conditions.append(f"s.class in ({', '.join(self.shape_types)})")
+        if self.z_range:
+            conditions.append("(s.theZ is null or s.theZ between :z_first and :z_last)")
+        if self.t_range:
+            conditions.append("(s.theT is null or s.theT between :t_first and :t_last)")
+        return "".join(f" and {condition}" for condition in conditions)
+
+    def add_parameters(self, params):
+        """Bind the values of the conditions on an omero.sys.ParametersI."""
+        if self.roi_ids:
+            params.add("roi_ids", rlist([rlong(roi_id) for roi_id in self.roi_ids]))
+        if self.z_range:
+            params.add("z_first", rint(self.z_range[0]))
+            params.add("z_last", rint(self.z_range[1]))
+        if self.t_range:
+            params.add("t_first", rint(self.t_range[0]))
+            params.add("t_last", rint(self.t_range[1]))
+        return params
+
+    def describe(self):
+        """Short text of the selection for progress messages, e.g. "Polygon, Z=3"."""
+        parts = []
+        if self.shape_types:
+            parts.append("/".join(self.shape_types))
+        for axis, plane_range in (("Z", self.z_range), ("T", self.t_range)):
+            if plane_range:
+                first, last = plane_range
+                parts.append(f"{axis}={first}" if first == last else f"{axis}={first}-{last}")
+        if self.roi_ids:
+            parts.append(f"{len(self.roi_ids)} ROI IDs")
+        return ", ".join(parts) or "all ROIs"
+
+
+def add_arguments(parser):
+    """Add the --shape-types, --z, --t and --roi-ids options to an argparse parser."""
+    group = parser.add_argument_group("ROI selection, applied by the server")
+    group.add_argument("--shape-types", nargs="+", choices=SHAPE_TYPES, metavar="TYPE",
+                       help=f"only shapes of these types ({', '.join(SHAPE_TYPES)})")
+    group.add_argument("--z", type=parse_range, help="only shapes on this Z plane or range, e.g. 3 or 2-5 (0-based)")
+    group.add_argument("--t", type=parse_range, help="only shapes on this timepoint or range, e.g. 0 or 10-19 (0-based)")
+    group.add_argument("--roi-ids", type=int, nargs="+", metavar="ID", help="only these ROIs")
+
+
+def from_args(args):
+    """Return the RoiFilter of the options added by add_arguments()."""
+    return RoiFilter.from_fields(args.shape_types, args.z, args.t, args.roi_ids)
@@ -0,0 +1,141 @@
+"""
+Constant-memory writer of large tables to xlsx, CSV or Parquet.
+
+Rows are dicts whose keys may differ from row to row. write_table() spools them to a
+temporary file while it grows the union of the columns (in order of first
+appearance) and the type of every column, then writes the file from the spool one
+row at a time: xlsx through openpyxl's write-only mode, CSV through the csv module and
+Parquet (pyarrow needed) in row groups. Memory stays flat however many rows there are.
+
+Excel sheets hold at most EXCEL_MAX_ROWS rows; longer tables continue on further
+sheets named <sheet>_2, <sheet>_3, ... with the header repeated. Use CSV or Parquet
+for those.
+"""
+
+import csv
+import json
+import os
+import tempfile
+import openpyxl
+from shared.instrumentation import phase
+
+TABLE_FORMATS = ("xlsx", "csv", "parquet")
+# Rows per sheet in Excel, including the header row.
+EXCEL_MAX_ROWS = 1048576
+# Rows per Parquet row group, and so per batch held in memory.
+PARQUET_ROW_GROUP = 50000
+
+
+class RowSpool:
+    """Temporary JSON-lines file of rows, with the column union and column types."""
+
+    def __init__(self):
+        self.columns = {}   # column -> "int", "float" or "str", in order of first appearance
+        self.count = 0
+        self._file = tempfile.TemporaryFile("w+", encoding="utf-8")
+
+    def append(self, row):
+        for column, value in row.items():
+            if value is None:
+                self.columns.setdefault(column, "int")
+                continue
+            kind = self.columns.get(column, "int")
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                kind = "str"
+            elif isinstance(value, float) and kind == "int":
+                kind = "float"
+            self.columns[column] = kind
+        self._file.write(json.dumps(row, default=str))
+        self._file.write("\n")
+        self.count += 1
+
+    def rows(self):
+        """Yield every row as a list of values in column order, None where it has no value."""
+        self._file.seek(0)
+        columns = list(self.columns)
+        for line in self._file:
+            row = json.loads(line)
+            yield [row.get(column) for column in columns]
+
+    def close(self):
+        self._file.close()
+
+
+def table_format(path, fmt=None):
+    """Return fmt, or the format named by the extension of path."""
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {fmt!r}, expected one of {', '.join(TABLE_FORMATS)}.")
+    return fmt
+
+
+def write_xlsx(spool, path, sheet_name="Sheet1"):
+    workbook = openpyxl.Workbook(write_only=True)
+    header = list(spool.columns)
+    worksheet = None
+    sheets = 0
+    for index, values in enumerate(spool.rows()):
+        if index % (EXCEL_MAX_ROWS - 1) == 0:
+            sheets += 1
+            worksheet = workbook.create_sheet(sheet_name if sheets == 1 else f"{sheet_name}_{sheets}")
+            worksheet.append(header)
+        worksheet.append(values)
+    if worksheet is None:
+        workbook.create_sheet(sheet_name).append(header)
+    workbook.save(path)
+    if sheets > 1:
+        print(f"{spool.count} rows exceed Excel's limit of {EXCEL_MAX_ROWS - 1} per sheet, "
+              f"written to {sheets} sheets. Use CSV or Parquet for tables this large.")
+
+
+def write_csv(spool, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(spool.columns)
+        for values in spool.rows():
+            writer.writerow(["" if value is None else value for value in values])
+
+
+def write_parquet(spool, path):
+    import pyarrow as pa  # pyarrow is only needed for Parquet output.
+    import pyarrow.parquet as pq
+    types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}
+    schema = pa.schema([(column, types[kind]) for column, kind in spool.columns.items()])
+    converters = [str if kind == "str" else None for kind in spool.columns.values()]
+
+    def write_batch(batch):
+        arrays = [[value if value is None or convert is None else convert(value) for value in column]
+                  for column, convert in zip(zip(*batch), converters)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for values in spool.rows():
+            batch.append(values)
+            if len(batch) == PARQUET_ROW_GROUP:
+                write_batch(batch)
+                batch = []
+        if batch:
+            write_batch(batch)
+        elif spool.count == 0:
+            writer.write_table(schema.empty_table())
+
+
+WRITERS = {"xlsx": write_xlsx, "csv": write_csv, "parquet": write_parquet}
+
+
+def write_table(rows, path, fmt=None):
+    """Write an iterable of row dicts to path as xlsx, CSV or Parquet, in constant memory.
+
+    The format defaults to the extension of path. Returns the number of rows written.
+    """
+    fmt = table_format(path, fmt)
+    spool = RowSpool()
+    try:
+        for row in rows:
+            spool.append(row)
+        with phase("write"):
+            WRITERS[fmt](spool, path)
+    finally:
+        spool.close()
+    return spool.count
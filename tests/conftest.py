@@ -0,0 +1,19 @@
+"""
+Fixtures of the regression tests. The scripts run against shared.fake_gateway, so no
+OMERO server is needed; omero-py must be installed for the model classes and rtypes.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("", "ISATransfer", "ImageToFile", "ROITransfer"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from shared import fake_gateway
+
+# Before any script is imported, so their MapAnnotationWrapper checks see the fake one.
+fake_gateway.install()
+
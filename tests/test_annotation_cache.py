@@ -0,0 +1,28 @@
+from shared import fake_gateway
+from shared.annotation_cache import AnnotationCache, fetch_map_annotations
+
+
+def test_cache_serves_unchanged_annotations(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=5)
+    cache = AnnotationCache(str(tmp_path / "cache.sqlite"))
+    expected, _ = fetch_map_annotations(conn, "Image", [1, 2, 3])
+
+    first, _ = fetch_map_annotations(conn, "Image", [1, 2, 3], cache)
+    second, round_trips = fetch_map_annotations(conn, "Image", [1, 2, 3], cache)
+
+    assert first == second == expected
+    assert round_trips == 1  # only the link versions
+
+
+def test_cache_keeps_servers_apart(tmp_path):
+    # Same annotation IDs and update events, different key-value pairs.
+    production = fake_gateway.FakeGateway(images_per_dataset=5, keys_per_annotation=5)
+    test_server = fake_gateway.FakeGateway(images_per_dataset=5, keys_per_annotation=2)
+    test_server.host = "test"
+    other_user = fake_gateway.FakeGateway(images_per_dataset=5, keys_per_annotation=3, username="other")
+    cache = AnnotationCache(str(tmp_path / "cache.sqlite"))
+
+    for conn in (production, test_server, other_user):
+        expected, _ = fetch_map_annotations(conn, "Image", [1, 2])
+        cached, _ = fetch_map_annotations(conn, "Image", [1, 2], cache)
+        assert cached == expected
@@ -0,0 +1,58 @@
+import os
+import arc_export
+from shared.annotation_cache import AnnotationCache
+from shared import fake_gateway
+
+
+def test_datasets_of_the_same_name_get_their_own_assay(tmp_path, monkeypatch):
+    conn = fake_gateway.FakeGateway(datasets_per_project=2, images_per_dataset=2)
+    record = conn.store.record
+    monkeypatch.setattr(conn.store, "record", lambda object_type, object_id: fake_gateway._Record(
+        object_type, object_id, "plate A" if object_type == "Dataset" else record(object_type, object_id).name))
+
+    result = arc_export.export_arc(conn, conn.getObject("Project", 1), str(tmp_path), table_format="csv")
+
+    assert sorted(os.listdir(tmp_path / "assays")) == ["plate_A", "plate_A_ID2"]
+    assert sorted(os.listdir(tmp_path / "assays" / "plate_A_ID2" / "dataset" / "rois")) == [
+        "image_3_ID3_rois.npz", "image_4_ID4_rois.npz"]
+    assert result["written"] == 1 + 1 + 2 * (1 + 1 + 2)  # investigation, study, per dataset: assay, table, ROIs
+
+
+def file_times(folder):
+    return {os.path.join(root, name): os.stat(os.path.join(root, name)).st_mtime_ns
+            for root, _, names in os.walk(folder) for name in names}
+
+
+def test_unchanged_reexport_writes_nothing(tmp_path):
+    conn = fake_gateway.FakeGateway(datasets_per_project=2, images_per_dataset=3)
+    project = conn.getObject("Project", 1)
+    cache = AnnotationCache(str(tmp_path / "cache.sqlite"))
+    arc = str(tmp_path / "arc")
+
+    first = arc_export.export_arc(conn, project, arc, measurements="csv", cache=cache)
+    times = file_times(arc)
+    second = arc_export.export_arc(conn, project, arc, measurements="csv", cache=cache)
+
+    assert second["written"] == 0 and second["unchanged"] == first["written"] > 0
+    assert file_times(arc) == times
+
+    # One edited annotation of image 4 rewrites only the table of its dataset.
+    ns, kv_pairs, _ = conn.store.annotation(7)
+    conn.store.annotations[7] = (ns, kv_pairs[:-1] + [(kv_pairs[-1][0], "edited")], 99)
+    third = arc_export.export_arc(conn, project, arc, measurements="csv", cache=cache)
+    changed = [path for path, mtime in file_times(arc).items() if times.get(path) != mtime]
+    assert third["written"] == 1
+    assert sorted(os.path.relpath(path, arc) for path in changed) == [
+        arc_export.MANIFEST_NAME, os.path.join("assays", "dataset_2", "dataset", "dataset_2.xlsx")]
+
+
+def test_deleted_file_is_written_again(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2)
+    project = conn.getObject("Project", 1)
+    arc_export.export_arc(conn, project, str(tmp_path), roi_format="json")
+    removed = tmp_path / "assays" / "dataset_1" / "dataset" / "rois" / "image_1_ID1_rois.json"
+    os.remove(removed)
+
+    result = arc_export.export_arc(conn, project, str(tmp_path), roi_format="json")
+
+    assert result["written"] == 1 and removed.exists()
@@ -0,0 +1,65 @@
+import json
+import pytest
+import batch_transfer
+from shared import fake_gateway
+
+
+def test_normalize_operation_converts_csv_fields():
+    op = batch_transfer.normalize_operation(
+        {"op": "roi_import", "file": "rois", "image": "", "batch_size": "50", "dedup": "Yes", "restart": "0"})
+    assert op == {"op": "roi_import", "file": "rois", "batch_size": 50, "dedup": True, "restart": False}
+    assert batch_transfer.normalize_operation({"op": "roi_export", "image": 7}) == {"op": "roi_export", "image": 7}
+
+
+@pytest.mark.parametrize("op, message", [
+    ({"op": "copy", "dataset": "1"}, "Unknown op 'copy'"),
+    ({"dataset": "1"}, "Unknown op None"),
+    ({"op": "isa_import", "project": "1", "file": "isa.study.xlsx"}, "isa_import needs type"),
+    ({"op": "roi_export", "format": "npz"}, "roi_export needs project or dataset or image"),
+])
+def test_normalize_operation_rejects_invalid_entries(op, message):
+    with pytest.raises(ValueError, match=message):
+        batch_transfer.normalize_operation(op)
+
+
+def test_run_manifest_records_every_operation(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=3)
+    context = {"cache": None, "pool": None}
+    operations = [
+        {"op": "images_to_excel", "dataset": "1", "format": "csv", "output": str(tmp_path / "dataset_1.csv")},
+        {"op": "roi_export", "dataset": "99"},
+        {"op": "roi_export", "dataset": "1", "format": "npz", "output": str(tmp_path / "rois")},
+    ]
+
+    records = batch_transfer.run_manifest(conn, operations, context)
+    assert [(record["index"], record["op"], record["status"]) for record in records] == [
+        (0, "images_to_excel", "ok"), (1, "roi_export", "error"), (2, "roi_export", "ok")]
+    assert records[0]["result"] == {"output": str(tmp_path / "dataset_1.csv"), "images": 3}
+    assert records[1]["error"] == "ValueError: Dataset with ID 99 not found."
+    assert records[2]["result"]["output"] == str(tmp_path / "rois")
+    assert len(list((tmp_path / "rois").iterdir())) == 3
+    assert all(record["seconds"] >= 0 for record in records)
+
+    assert len(batch_transfer.run_manifest(conn, operations, context, stop_on_error=True)) == 2
+
+
+def test_main_exits_nonzero_with_a_summary_when_an_operation_fails(tmp_path, monkeypatch):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2)
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("op,dataset,file,output\n"
+                        f"images_to_excel,1,,{tmp_path / 'dataset_1.xlsx'}\n"
+                        f"roi_import,,{tmp_path / 'missing_rois'},\n")
+    summary_file = tmp_path / "summary.json"
+    monkeypatch.setattr("sys.argv", ["batch_transfer.py", str(manifest), "--no-cache", "--summary", str(summary_file)])
+    monkeypatch.setattr(batch_transfer, "open_connection", lambda **settings: conn)
+    monkeypatch.setattr(batch_transfer, "close_connection", lambda conn: None)
+
+    with pytest.raises(SystemExit) as exit_info:
+        batch_transfer.main()
+    assert exit_info.value.code == 1
+
+    summary = json.loads(summary_file.read_text())
+    assert (summary["connected"], summary["operations"], summary["succeeded"], summary["failed"],
+            summary["skipped"]) == (True, 2, 1, 1, 0)
+    assert summary["results"][1]["error"] == f"ValueError: File {tmp_path / 'missing_rois'} not found."
+    assert (tmp_path / "dataset_1.xlsx").exists()
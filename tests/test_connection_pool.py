@@ -0,0 +1,64 @@
+import threading
+import time
+from omero.rtypes import rstring
+from shared import connection, fake_gateway
+from shared.concurrency import map_ordered
+
+
+class SessionGateway(fake_gateway.FakeGateway):
+    """FakeGateway with a session key that remembers how it was closed."""
+    closed = None
+
+    def getSession(self):
+        session = type("Session", (), {})()
+        session.getUuid = lambda: rstring("session-key")
+        return session
+
+    def close(self, hard=True):
+        self.closed = "hard" if hard else "detached"
+
+
+def make_pool(monkeypatch, size):
+    """Return the main connection, a pool of size workers on it and the list of joined connections."""
+    conn = SessionGateway()
+    joined = []
+
+    def join_session(host, port, key, keep_alive):
+        assert (host, port, key) == (conn.host, conn.port, "session-key")
+        worker = SessionGateway(store=conn.store)
+        joined.append(worker)
+        return worker
+
+    monkeypatch.setattr(connection, "join_session", join_session)
+    return conn, connection.ConnectionPool(conn, size), joined
+
+
+def test_map_ordered_keeps_input_order(monkeypatch):
+    conn, pool, joined = make_pool(monkeypatch, 3)
+
+    def name(worker_conn, image_id):
+        # Later images finish first.
+        time.sleep(0.002 * (10 - image_id))
+        assert worker_conn in joined
+        return worker_conn.getObject("Image", image_id).getName()
+
+    results = list(map_ordered(name, range(1, 10), pool))
+    assert results == [(image_id, f"image {image_id}") for image_id in range(1, 10)]
+    assert 1 < len(joined) <= 3
+
+
+def test_close_detaches_every_worker_connection(monkeypatch):
+    conn, pool, joined = make_pool(monkeypatch, 2)
+    barrier = threading.Barrier(2)
+
+    def wait(worker_conn, item):
+        barrier.wait(timeout=5)  # both connections are in use at the same time
+        return item
+
+    assert [item for item, _ in map_ordered(wait, [1, 2], pool)] == [1, 2]
+    assert len(joined) == 2
+    with pool:
+        list(map_ordered(lambda worker_conn, item: item, range(5), pool))
+    assert len(joined) == 2  # idle connections are reused
+    assert [worker.closed for worker in joined] == ["detached", "detached"]
+    assert conn.closed is None
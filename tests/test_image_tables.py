@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+import Excel_to_Images
+import Images_to_Excel
+from shared import fake_gateway, instrumentation
+
+
+def test_missing_dataset_raises():
+    conn = fake_gateway.FakeGateway()
+    with pytest.raises(ValueError, match="Dataset with ID 99 not found"):
+        Images_to_Excel.extract_image_table(conn, 99)
+    with pytest.raises(ValueError, match="Dataset with ID 99 not found"):
+        Images_to_Excel.extract_image_metadata(conn, 99)
+
+
+def server_calls(monkeypatch, images, **kwargs):
+    """Return the metadata rows of dataset 1 and the number of server calls made to read them."""
+    monkeypatch.setattr(instrumentation, "_active", None)
+    counters = instrumentation.enable()
+    conn = instrumentation.instrument(fake_gateway.FakeGateway(images_per_dataset=images))
+    rows = Images_to_Excel.extract_image_metadata(conn, 1, **kwargs)
+    return rows, counters.report()["server_calls"]
+
+
+def test_bulk_and_per_image_rows_match(monkeypatch):
+    bulk_rows, bulk_calls = server_calls(monkeypatch, 5, bulk=True)
+    per_image_rows, per_image_calls = server_calls(monkeypatch, 5, bulk=False)
+    assert bulk_rows == per_image_rows
+    assert per_image_calls > bulk_calls
+
+    # The bulk fetch does not make more round trips for more images.
+    assert server_calls(monkeypatch, 50, bulk=True)[1] == bulk_calls
+    assert server_calls(monkeypatch, 50, bulk=False)[1] > per_image_calls
+
+    # The one-query table has the same rows and dtypes as the per-image rows.
+    table = Images_to_Excel.extract_image_table(fake_gateway.FakeGateway(images_per_dataset=5), 1)
+    pd.testing.assert_frame_equal(table, pd.DataFrame(per_image_rows))
+
+
+@pytest.mark.parametrize("fmt", ["xlsx", "csv", "parquet"])
+def test_table_round_trip(tmp_path, fmt):
+    conn = fake_gateway.FakeGateway(images_per_dataset=4)
+    filename = str(tmp_path / f"dataset_1.{fmt}")
+    if fmt == "xlsx":
+        Images_to_Excel.save_table(Images_to_Excel.extract_image_table(conn, 1), filename)
+    else:
+        Images_to_Excel.stream_image_table(conn, 1, filename, page_size=3)
+
+    # An unchanged sheet writes nothing back.
+    assert Excel_to_Images.import_sheet(conn, 1, filename)["changed_pairs"] == 0
+
+    table = pd.DataFrame(Excel_to_Images.read_sheet(filename))
+    assert len(table) == 4 and table.loc[0, "Key0_0"] == "value 1.0"
+    table.loc[0, "Key0_0"] = "edited"
+    table["Stain"] = ["", "DAPI", "", ""]
+    getattr(table, "to_excel" if fmt == "xlsx" else f"to_{fmt}")(filename, index=False)
+
+    result = Excel_to_Images.import_sheet(conn, 1, filename)
+    assert (result["matched"], result["changed_images"], result["changed_pairs"]) == (4, 2, 2)
+
+    exported = Images_to_Excel.extract_image_table(conn, 1)
+    assert exported.loc[0, "Key0_0"] == "edited"
+    assert exported.loc[1, "Stain"] == "DAPI"
+    assert Excel_to_Images.import_sheet(conn, 1, filename)["changed_pairs"] == 0
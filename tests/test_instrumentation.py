@@ -0,0 +1,62 @@
+import argparse
+import time
+from shared import fake_gateway, instrumentation
+
+
+def parse(monkeypatch, *argv):
+    """Parse the instrumentation flags and start instrumentation as the scripts do."""
+    monkeypatch.setattr(instrumentation, "_active", None)
+    parser = argparse.ArgumentParser()
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    return args, instrumentation.start(args)
+
+
+def test_calls_are_counted_per_service(monkeypatch):
+    _, counters = parse(monkeypatch, "--profile", "-")
+    conn = instrumentation.instrument(fake_gateway.FakeGateway())
+    dataset = conn.getObject("Dataset", 1)
+    list(dataset.listChildren())
+    list(conn.getObject("Image", 1).listAnnotations())
+    conn.getRoiService().findByImage(1, None)
+    conn.deleteObjects("Annotation", [1])
+
+    calls = counters.report()["calls"]
+    assert {name: call["count"] for name, call in calls.items()} == {
+        "query.find": 2, "query.findAllByQuery": 2, "roi.findByImage": 1, "gateway.deleteObjects": 1}
+    assert counters.report()["server_calls"] == 6
+
+
+def test_phases_and_written_bytes_are_recorded(monkeypatch, tmp_path, capsys):
+    args, _ = parse(monkeypatch, "--profile", str(tmp_path / "profile.json"))
+    for _ in range(2):
+        with instrumentation.phase("fetch"):
+            time.sleep(0.01)
+    with instrumentation.phase("write"):
+        pass
+    first, second = tmp_path / "a.txt", tmp_path / "b.txt"
+    first.write_bytes(b"x" * 10)
+    second.write_bytes(b"y" * 32)
+    instrumentation.written(str(first), str(second), str(tmp_path / "missing.txt"))
+
+    report = instrumentation.finish(args)
+    assert report["phases"]["fetch"]["count"] == 2 and report["phases"]["fetch"]["seconds"] >= 0.02
+    assert report["phases"]["write"]["count"] == 1
+    assert (report["bytes_written"], report["files_written"]) == (42, 2)
+    assert "Profile written to" in capsys.readouterr().out
+    assert (tmp_path / "profile.json").exists()
+
+
+def test_without_profile_nothing_is_wrapped(monkeypatch, tmp_path):
+    args, counters = parse(monkeypatch)
+    assert counters is None and instrumentation.active() is None
+    conn = fake_gateway.FakeGateway()
+    assert instrumentation.instrument(conn) is conn
+    assert "getQueryService" not in vars(conn) and "deleteObjects" not in vars(conn)
+    assert conn.getQueryService() is conn._query
+
+    with instrumentation.phase("fetch"):
+        pass
+    (tmp_path / "a.txt").write_bytes(b"x")
+    instrumentation.written(str(tmp_path / "a.txt"))
+    assert instrumentation.finish(args) is None
@@ -0,0 +1,50 @@
+import omero.model
+from omero.rtypes import rstring
+import ISA_Export
+from shared import fake_gateway
+
+
+def link_annotation(conn, ns, kv_pairs):
+    """Save a MapAnnotation with ns and kv_pairs on project 1."""
+    ann = omero.model.MapAnnotationI()
+    ann.setNs(rstring(ns))
+    ann.setMapValue([omero.model.NamedValue(key, value) for key, value in kv_pairs])
+    link = omero.model.ProjectAnnotationLinkI()
+    link.setParent(omero.model.ProjectI(1, False))
+    link.setChild(ann)
+    conn.getUpdateService().saveObject(link)
+
+
+def test_fetch_metadata_orders_namespaces_and_keeps_other_values():
+    conn = fake_gateway.FakeGateway(isa_keys=1)
+    # Linked after the synthetic INVESTIGATION and ASSAY DATA FILES annotations.
+    link_annotation(conn, "ARC:ISA:INVESTIGATION:ONTOLOGY SOURCE REFERENCE", [("Term Source Name", "'EFO'")])
+    link_annotation(conn, "ARC:ISA:ASSAY:ASSAY", [("Measurement Type", "'imaging', 'light', 'confocal'"),
+                                                  ("Technology Type", "'microscopy'")])
+    link_annotation(conn, "openmicroscopy.org/omero/client/mapAnnotation", [("Stain", "'DAPI', GFP")])
+
+    investigation, study, assay, other = ISA_Export.fetch_metadata_from_project(conn, "Project", 1)
+
+    assert list(investigation) == ["ARC:ISA:INVESTIGATION:ONTOLOGY SOURCE REFERENCE",
+                                   "ARC:ISA:INVESTIGATION:INVESTIGATION"]
+    assert study == {"ARC:ISA:STUDY:STUDY": {"Study Key 0": ["value 0", "value 1"]}}
+    assert assay == {
+        "ARC:ISA:ASSAY:ASSAY": {"Measurement Type": ["imaging", "light", "confocal"],
+                                "Technology Type": ["microscopy"]},
+        "ARC:ISA:ASSAY:ASSAY DATA FILES": {"Assay Data Files Key 0": ["value 0", "value 1"]},
+    }
+    # Values of other namespaces are not split into quoted values.
+    assert other == {"openmicroscopy.org/omero/client/mapAnnotation": {"Stain": ["'DAPI', GFP"]}}
+
+    table = ISA_Export.isa_table(assay)
+    assert table.values.tolist() == [
+        ["ASSAY", "", "", ""],
+        ["Measurement Type", "imaging", "light", "confocal"],
+        ["Technology Type", "microscopy", "", ""],
+        ["ASSAY DATA FILES", "", "", ""],
+        ["Assay Data Files Key 0", "value 0", "value 1", ""],
+    ]
+
+
+def test_missing_project_returns_empty_metadata():
+    assert ISA_Export.fetch_metadata_from_project(fake_gateway.FakeGateway(), "Project", 9) == ({}, {}, {}, {})
@@ -0,0 +1,103 @@
+import json
+import omero.model
+from omero.rtypes import rstring
+import ISA_Import
+from bench_isa_parser import legacy_extract_metadata_from_xlsx, write_synthetic_sheet
+from shared import fake_gateway, instrumentation
+from shared.concurrency import chunked
+
+ASSAY_NS = "ARC:ISA:ASSAY:ASSAY DATA FILES"
+
+
+def test_chunked():
+    assert list(chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked([], 3)) == []
+
+
+def test_streaming_parser_matches_pandas(tmp_path, monkeypatch):
+    # Small blocks so that rows and namespaces straddle block boundaries.
+    monkeypatch.setattr(ISA_Import, "XLSX_CHUNK_ROWS", 7)
+    file_path = str(tmp_path / "isa.assay.xlsx")
+    write_synthetic_sheet(file_path, 200, 5)
+
+    legacy = legacy_extract_metadata_from_xlsx(file_path, "Assay")
+    streamed = ISA_Import.extract_metadata_from_xlsx(file_path, "Assay")
+
+    assert json.dumps(streamed) == json.dumps(legacy)
+
+
+def counted_project(monkeypatch, **scale):
+    """Return project 1 of a fake server whose calls are counted, and the counters."""
+    monkeypatch.setattr(instrumentation, "_active", None)
+    counters = instrumentation.enable()
+    conn = instrumentation.instrument(fake_gateway.FakeGateway(**scale))
+    return conn, conn.getObject("Project", 1), counters
+
+
+def sync(project, metadata, conn, counters, **kwargs):
+    """Run sync_metadata; return its counts and the number of update and delete calls it made."""
+    before = counters.calls.copy()
+    counts = ISA_Import.sync_metadata(project, metadata, conn, "Assay", **kwargs)
+    calls = counters.calls - before
+    updates = sum(count for name, count in calls.items() if name.startswith("update."))
+    return counts, updates, calls["gateway.deleteObjects"]
+
+
+def assay_annotations(conn):
+    """Return namespace -> [(ID, key-value pairs)] of the assay annotations on project 1."""
+    annotations = {}
+    for ann_id in conn.store.linked_annotation_ids("Project", 1):
+        ns, kv_pairs, _ = conn.store.annotation(ann_id)
+        if ns.startswith("ARC:ISA:ASSAY:"):
+            annotations.setdefault(ns, []).append((ann_id, kv_pairs))
+    return annotations
+
+
+def test_sync_updates_in_place_creates_and_then_writes_nothing(monkeypatch):
+    conn, project, counters = counted_project(monkeypatch, isa_keys=2)
+    (assay_id, _), = assay_annotations(conn)[ASSAY_NS]
+    metadata = {
+        ASSAY_NS: {"Assay Data Files Key 0": "'edited'", "Assay Data Files Key 1": "'value 1', 'value 2'"},
+        "ARC:ISA:ASSAY:ASSAY PERFORMERS": {"Last Name": "'Doe'"},
+    }
+
+    counts, updates, deletes = sync(project, metadata, conn, counters)
+    assert counts == {"unchanged": 0, "updated": 1, "created": 1, "deleted": 0}
+    assert (updates, deletes) == (1, 0)
+    annotations = assay_annotations(conn)
+    # The changed annotation keeps its ID, the new namespace gets a new annotation.
+    assert annotations[ASSAY_NS] == [(assay_id, list(metadata[ASSAY_NS].items()))]
+    (created_id, created_pairs), = annotations["ARC:ISA:ASSAY:ASSAY PERFORMERS"]
+    assert created_id != assay_id and created_pairs == [("Last Name", "'Doe'")]
+
+    counts, updates, deletes = sync(project, metadata, conn, counters, delete_removed=True)
+    assert counts == {"unchanged": 2, "updated": 0, "created": 0, "deleted": 0}
+    assert (updates, deletes) == (0, 0)
+
+
+def test_sync_deletes_removed_namespaces_and_duplicates(monkeypatch):
+    conn, project, counters = counted_project(monkeypatch, isa_keys=2)
+    for ns in (ASSAY_NS, "ARC:ISA:ASSAY:REMOVED"):
+        ann = omero.model.MapAnnotationI()
+        ann.setNs(rstring(ns))
+        ann.setMapValue([omero.model.NamedValue("Key", "value")])
+        link = omero.model.ProjectAnnotationLinkI()
+        link.setParent(omero.model.ProjectI(1, False))
+        link.setChild(ann)
+        conn.getUpdateService().saveObject(link)
+    annotations = assay_annotations(conn)
+    (original_id, kv_pairs), (duplicate_id, _) = annotations[ASSAY_NS]
+    (removed_id, _), = annotations["ARC:ISA:ASSAY:REMOVED"]
+    other_namespaces = [ann_id for ann_id in conn.store.linked_annotation_ids("Project", 1)
+                        if not conn.store.annotation(ann_id)[0].startswith("ARC:ISA:ASSAY:")]
+
+    # Without delete_removed nothing is written for an unchanged file.
+    assert sync(project, {ASSAY_NS: dict(kv_pairs)}, conn, counters)[1:] == (0, 0)
+
+    counts, updates, deletes = sync(project, {ASSAY_NS: dict(kv_pairs)}, conn, counters, delete_removed=True)
+    assert counts == {"unchanged": 1, "updated": 0, "created": 0, "deleted": 2}
+    assert (updates, deletes) == (0, 1)
+    assert conn.store.deleted == {duplicate_id, removed_id}
+    assert assay_annotations(conn) == {ASSAY_NS: [(original_id, kv_pairs)]}
+    # Annotations of the investigation and study files are left alone.
+    assert conn.store.linked_annotation_ids("Project", 1) == other_namespaces + [original_id]
@@ -0,0 +1,150 @@
+import pytest
+import ROI_Export
+import ROI_Import
+from shape_codecs import shape_key, shape_to_dict
+from shared import fake_gateway
+from shared.roi_filters import RoiFilter
+
+ROI_FORMATS = ["json", "ndjson", "ndjson.gz", "npz"]
+
+
+def extra_rois():
+    """ROIs of the shape types the fake server does not generate, with and without mask bytes."""
+    return [
+        {"ROI_ID": 901, "Shapes": [
+            {"type": "Mask", "theZ": 1, "theT": 0, "x": 2.0, "y": 3.0, "width": 8.0, "height": 2.0,
+             "bytes": bytes([0x0f, 0xf0])},
+            {"type": "Mask", "theZ": 2, "theT": 0, "x": 0.0, "y": 0.0, "width": 4.0, "height": 4.0},
+        ]},
+        {"ROI_ID": 902, "Shapes": [
+            {"type": "Polyline", "theZ": 0, "theT": 1, "points": "0.1,0.2 1234567.125,3.3 5,6"},
+            {"type": "Label", "theZ": 0, "theT": 0, "text": "nucleus", "x": 4.5, "y": 7.0},
+        ]},
+    ]
+
+
+def shape_keys(roi_dicts):
+    return [[shape_key(shape) for shape in roi_dict["Shapes"]] for roi_dict in roi_dicts]
+
+
+@pytest.mark.parametrize("fmt", ROI_FORMATS)
+def test_export_import_round_trip(tmp_path, fmt):
+    source = fake_gateway.FakeGateway(images_per_dataset=2)
+    roi_dicts = list(ROI_Export.iter_roi_dicts(1, source)) + extra_rois()
+    expected = shape_keys(roi_dicts)
+    filename = str(tmp_path / f"image_1_ID1_rois.{fmt}")
+    ROI_Export.write_roi_file(1, roi_dicts, filename, fmt)
+
+    target = fake_gateway.FakeGateway(images_per_dataset=2, rois_per_image=0)
+    assert ROI_Import.import_rois_from_json(filename, target, batch_size=2) == len(expected)
+
+    saved = [{"Shapes": [shape_to_dict(s) for s in roi.copyShapes()]} for roi in target.store.saved_rois[1]]
+    assert shape_keys(saved) == expected
+
+
+@pytest.mark.parametrize("fmt", ROI_FORMATS)
+def test_batched_export_writes_the_same_files(tmp_path, fmt):
+    conn = fake_gateway.FakeGateway(images_per_dataset=5, rois_per_image=4)
+    dataset = conn.getObject("Dataset", 1)
+    ROI_Export.export_dataset_rois(conn, dataset, str(tmp_path / "per_image"), fmt=fmt, page_size=3)
+    ROI_Export.export_dataset_rois(conn, dataset, str(tmp_path / "batched"), 2, fmt, page_size=3)
+
+    for image_id in range(1, 6):
+        name = f"image_{image_id}_ID{image_id}_rois.{fmt}"
+        per_image = ROI_Import.read_roi_file(str(tmp_path / "per_image" / name))
+        batched = ROI_Import.read_roi_file(str(tmp_path / "batched" / name))
+        assert per_image[0] == batched[0] == image_id
+        assert list(per_image[1]) == list(batched[1])
+
+
+def filtered_reference(roi_dicts, roi_filter):
+    """Apply a RoiFilter to fully exported ROIs on the client."""
+    def on_planes(shape, key, plane_range):
+        return plane_range is None or shape.get(key) is None or plane_range[0] <= shape[key] <= plane_range[1]
+
+    selected = []
+    for roi_dict in roi_dicts:
+        if roi_filter.roi_ids and roi_dict["ROI_ID"] not in roi_filter.roi_ids:
+            continue
+        shapes = [shape for shape in roi_dict["Shapes"]
+                  if (not roi_filter.shape_types or shape["type"] in roi_filter.shape_types)
+                  and on_planes(shape, "theZ", roi_filter.z_range) and on_planes(shape, "theT", roi_filter.t_range)]
+        if shapes or not roi_filter.filters_shapes():
+            selected.append({"ROI_ID": roi_dict["ROI_ID"], "Shapes": shapes})
+    return selected
+
+
+FILTERS = [
+    RoiFilter(shape_types=["Polygon"]),
+    RoiFilter(z_range=(1, 1)),
+    RoiFilter(shape_types=["Rectangle", "Line"], z_range=(0, 1), t_range=(0, 0)),
+    RoiFilter(roi_ids=[2, 5, 11, 18]),
+    RoiFilter(shape_types=["Ellipse"], roi_ids=[1, 2, 3, 4, 5, 6, 7]),
+]
+
+
+@pytest.mark.parametrize("roi_filter", FILTERS, ids=lambda roi_filter: roi_filter.describe())
+@pytest.mark.parametrize("page_size", [1, 2, 1000])
+def test_filtered_export_matches_client_side_filter(roi_filter, page_size):
+    conn = fake_gateway.FakeGateway(images_per_dataset=4, rois_per_image=5, shapes_per_roi=3)
+    image_ids = [1, 2, 3, 4]
+    expected = {image_id: filtered_reference(ROI_Export.iter_roi_dicts(image_id, conn), roi_filter)
+                for image_id in image_ids}
+    assert any(expected.values())
+
+    per_image = {image_id: list(ROI_Export.iter_roi_dicts(image_id, conn, page_size, roi_filter))
+                 for image_id in image_ids}
+    batched = dict(ROI_Export.fetch_roi_dicts(conn, image_ids, page_size, roi_filter))
+
+    assert per_image == expected
+    assert batched == expected
+
+
+def test_compare_timing_uses_pool_and_measurements(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=3, rois_per_image=2)
+    pool = fake_gateway.FakeConnectionPool(conn, 2)
+    folder = str(tmp_path / "dataset_1")
+    ROI_Export.compare_export_timing(conn, conn.getObject("Dataset", 1), folder, 2, "json", pool,
+                                     measurements="csv", repeats=1)
+
+    for image_id in range(1, 4):
+        assert (tmp_path / "dataset_1" / f"image_{image_id}_ID{image_id}_rois.json").exists()
+        assert (tmp_path / "dataset_1" / f"image_{image_id}_ID{image_id}_measurements.csv").exists()
+
+
+def test_workers_are_rejected_for_a_single_image(tmp_path, monkeypatch, capsys):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2, datasets_per_project=1, projects=1)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["ROI_Export.py", "--workers", "2"])
+    monkeypatch.setattr("builtins.input", lambda prompt="": "2")
+    monkeypatch.setattr(ROI_Export, "open_connection", lambda: conn)
+    monkeypatch.setattr(ROI_Export, "ConnectionPool", fake_gateway.FakeConnectionPool)
+    monkeypatch.setattr(ROI_Export, "close_connection", lambda conn: None)
+    ROI_Export.main()
+
+    assert "--workers applies to Dataset and Project exports" in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_shape_codecs_match_the_legacy_chain():
+    import omero.model
+    from omero.rtypes import rdouble, rlong, rstring
+    from bench_shape_codecs import legacy_shape_to_dict, make_shapes
+
+    mask = omero.model.MaskI()
+    for setter in (mask.setX, mask.setY, mask.setWidth, mask.setHeight):
+        setter(rdouble(4))
+    mask.setBytes(b"\x0f")
+    label = omero.model.LabelI()
+    label.setTextValue(rstring("nucleus"))
+    label.setX(rdouble(5))
+    polyline = omero.model.PolylineI()
+    polyline.setPoints(rstring("1,2 3,4"))
+    for i, s in enumerate((mask, label, polyline)):
+        s.setId(rlong(i))
+
+    for s in make_shapes(10) + [mask, label, polyline]:
+        shape = shape_to_dict(s)
+        # The legacy chain dropped the mask bytes.
+        assert shape.pop("bytes", None) == (b"\x0f" if s is mask else None)
+        assert list(shape.items()) == list(legacy_shape_to_dict(s).items())
@@ -0,0 +1,30 @@
+import pytest
+from shared.roi_filters import RoiFilter, parse_range, plane_range
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("3", (3, 3)), ("2-5", (2, 5)), (4, (4, 4)), ([1, 2], (1, 2)), ((0, 0), (0, 0)), (None, None), ("", None),
+])
+def test_plane_range(value, expected):
+    assert plane_range(value) == expected
+
+
+@pytest.mark.parametrize("value", ["4-2", "-1", [4, 2], [-1, 3], (2,), [1, 2, 3], "x"])
+def test_invalid_plane_range(value):
+    with pytest.raises(ValueError):
+        plane_range(value)
+
+
+def test_parse_range_rejects_reversed_range():
+    with pytest.raises(ValueError, match="Invalid plane range '4-2'"):
+        parse_range("4-2")
+
+
+def test_from_fields():
+    roi_filter = RoiFilter.from_fields("Polygon, Line", "2-3", [0, 1], "5,6")
+    assert (roi_filter.shape_types, roi_filter.z_range, roi_filter.t_range, roi_filter.roi_ids) == (
+        ["Polygon", "Line"], (2, 3), (0, 1), [5, 6])
+    assert roi_filter.describe() == "Polygon/Line, Z=2-3, T=0-1, 2 ROI IDs"
+    assert not RoiFilter.from_fields()
+    with pytest.raises(ValueError, match="Unknown shape types"):
+        RoiFilter.from_fields("Circle")
@@ -0,0 +1,87 @@
+import gc
+import os
+import warnings
+import ROI_Export
+import ROI_Import
+from shared import fake_gateway
+
+
+def test_folder_import_rejects_renamed_file(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2)
+    exported = str(tmp_path / "image_1_ID1_rois.json")
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn), exported)
+    os.rename(exported, tmp_path / "image_2_ID2_rois.json")
+
+    counts = ROI_Import.import_roi_folder(conn, str(tmp_path))
+
+    assert counts["failed"] == 1 and counts["imported"] == 0
+    assert conn.store.saved_rois == {}
+    journal = ROI_Import.ImportJournal(str(tmp_path / ROI_Import.JOURNAL_NAME))
+    assert "does not match" in journal.entries["image_2_ID2_rois.json"]["error"]
+    journal.close()
+
+
+def test_dedup_reimport_writes_nothing(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2)
+    filename = str(tmp_path / "image_1_ID1_rois.npz")
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn), filename, "npz")
+
+    assert ROI_Import.import_rois_from_json(filename, conn, batch_size=10, dedup=True) == 0
+    assert conn.store.saved_rois == {}
+
+    # A ROI the file holds twice is only skipped as often as it is on the image.
+    roi_dict = next(ROI_Export.iter_roi_dicts(1, conn))
+    ROI_Export.write_roi_file(1, [roi_dict, dict(roi_dict, ROI_ID=999)], filename, "npz")
+    assert ROI_Import.import_rois_from_json(filename, conn, dedup=True) == 1
+    assert ROI_Import.import_rois_from_json(filename, conn, dedup=True) == 0
+
+
+def fail_once(conn, image_id, after_calls):
+    """Make saveArray fail once for image_id, after after_calls successful saves of it."""
+    update_service = conn.getUpdateService()
+    save_array = update_service.saveArray
+    calls = []
+
+    def flaky_save_array(rois, ctx=None):
+        if rois[0].getImage().getId().getValue() == image_id:
+            calls.append(len(rois))
+            if len(calls) == after_calls + 1:
+                raise RuntimeError("connection lost")
+        return save_array(rois, ctx)
+
+    update_service.saveArray = flaky_save_array
+
+
+def test_folder_import_resumes_from_the_journal(tmp_path):
+    source = fake_gateway.FakeGateway(images_per_dataset=3, rois_per_image=3)
+    ROI_Export.export_dataset_rois(source, source.getObject("Dataset", 1), str(tmp_path), fmt="ndjson")
+    target = fake_gateway.FakeGateway(images_per_dataset=3, rois_per_image=0)
+    # The import of image 2 breaks off after its first ROI was saved.
+    fail_once(target, 2, after_calls=1)
+
+    first = ROI_Import.import_roi_folder(target, str(tmp_path), batch_size=1)
+    assert (first["imported"], first["failed"], first["resumed"]) == (2, 1, 0)
+    assert len(target.store.saved_rois[2]) == 1
+
+    second = ROI_Import.import_roi_folder(target, str(tmp_path), batch_size=1)
+    assert (second["imported"], second["failed"], second["resumed"]) == (1, 0, 2)
+    assert {image_id: len(rois) for image_id, rois in target.store.saved_rois.items()} == {1: 3, 2: 3, 3: 3}
+
+    third = ROI_Import.import_roi_folder(target, str(tmp_path), batch_size=1)
+    assert (third["imported"], third["resumed"]) == (0, 3)
+
+
+def test_missing_image_leaves_no_file_open(tmp_path):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2)
+    filename = str(tmp_path / "image_1_ID1_rois.ndjson")
+    ROI_Export.write_roi_file(1, ROI_Export.iter_roi_dicts(1, conn), filename, "ndjson")
+    other_server = fake_gateway.FakeGateway(images_per_dataset=0)
+
+    gc.collect()  # objects left by earlier tests
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", ResourceWarning)
+        assert ROI_Import.import_rois_from_json(filename, other_server) is None
+        gc.collect()
+
+    assert not [warning for warning in caught
+                if issubclass(warning.category, ResourceWarning) and filename in str(warning.message)]
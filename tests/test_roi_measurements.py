@@ -0,0 +1,95 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+import ROI_Export
+from roi_measurements import MEASUREMENT_COLUMNS, ShapeColumns, measure_shapes, parse_points
+from shared import fake_gateway
+
+
+def measure(*shapes):
+    """Measure shapes given as dictionaries of one ROI of image 1; returns the table indexed by shape ID."""
+    columns = ShapeColumns()
+    for shape_id, shape in enumerate(shapes, 1):
+        columns.add(10, dict(shape, id=shape_id, theZ=0, theT=0))
+    return measure_shapes(1, columns).set_index("shape_id")
+
+
+def check(row, area, perimeter, centroid, bbox):
+    assert row["area"] == pytest.approx(area)
+    assert row["perimeter"] == pytest.approx(perimeter)
+    assert (row["centroid_x"], row["centroid_y"]) == pytest.approx(centroid)
+    assert (row["bbox_x_min"], row["bbox_y_min"], row["bbox_x_max"], row["bbox_y_max"]) == pytest.approx(bbox)
+
+
+def test_shapes_are_measured_like_by_hand():
+    table = measure(
+        {"type": "Polygon", "points": "0,0 4,0 4,3 0,3"},
+        {"type": "Polygon", "points": "0,0 6,0 0,3"},
+        {"type": "Polyline", "points": "0,0 3,4 3,10"},
+        {"type": "Rectangle", "x": 1.0, "y": 2.0, "width": 4.0, "height": 3.0},
+        {"type": "Ellipse", "x": 5.0, "y": 5.0, "radiusX": 3.0, "radiusY": 3.0},
+        {"type": "Ellipse", "x": 0.0, "y": 0.0, "radiusX": 2.0, "radiusY": 1.0},
+        {"type": "Line", "x1": 0.0, "y1": 0.0, "x2": 3.0, "y2": 4.0},
+        {"type": "Point", "x": 2.0, "y": 7.0},
+        {"type": "Label", "text": "nucleus", "x": 1.0, "y": 1.0},
+    )
+    assert list(table.index) == list(range(1, 9))  # Labels are not measured
+    check(table.loc[1], 12, 14, (2, 1.5), (0, 0, 4, 3))
+    check(table.loc[2], 9, 9 + math.sqrt(45), (2, 1), (0, 0, 6, 3))
+    # Open: no closing segment, centroid weighted by the segment lengths 5 and 6.
+    check(table.loc[3], 0, 11, (25.5 / 11, 52 / 11), (0, 0, 3, 10))
+    check(table.loc[4], 12, 14, (3, 3.5), (1, 2, 5, 5))
+    check(table.loc[5], 9 * math.pi, 6 * math.pi, (5, 5), (2, 2, 8, 8))
+    # Ramanujan's approximation, h = (a - b)^2 / (a + b)^2 = 1/9.
+    h = 1 / 9
+    check(table.loc[6], 2 * math.pi, math.pi * 3 * (1 + 3 * h / (10 + math.sqrt(4 - 3 * h))), (0, 0), (-2, -1, 2, 1))
+    check(table.loc[7], 0, 5, (1.5, 2), (0, 0, 3, 4))
+    check(table.loc[8], 0, 0, (2, 7), (2, 7, 2, 7))
+    assert (table["roi_id"] == 10).all() and (table["image_id"] == 1).all()
+
+
+def test_degenerate_and_empty_polygons():
+    table = measure(
+        {"type": "Polygon", "points": "0,0 1,1 2,2"},
+        {"type": "Polygon", "points": "0,0 4,0"},
+        {"type": "Polygon", "points": "3,1"},
+        {"type": "Polyline", "points": "5,5"},
+        {"type": "Polygon", "points": ""},
+        {"type": "Polygon"},
+    )
+    # Zero area: the centroid falls back to the mean of the vertices.
+    check(table.loc[1], 0, 4 * math.sqrt(2), (1, 1), (0, 0, 2, 2))
+    check(table.loc[2], 0, 8, (2, 0), (0, 0, 4, 0))
+    check(table.loc[3], 0, 0, (3, 1), (3, 1, 3, 1))
+    check(table.loc[4], 0, 0, (5, 5), (5, 5, 5, 5))
+    for shape_id in (5, 6):
+        row = table.loc[shape_id]
+        assert (row["area"], row["perimeter"]) == (0, 0)
+        assert row[["centroid_x", "centroid_y", "bbox_x_min", "bbox_y_min", "bbox_x_max", "bbox_y_max"]].isna().all()
+
+
+def test_parse_points_rejects_other_formats():
+    xy, offsets = parse_points(["1,2 3,4", "", "5.5,-6"])
+    assert xy.tolist() == [[1, 2], [3, 4], [5.5, -6]] and offsets.tolist() == [0, 2, 2, 3]
+    with pytest.raises(ValueError, match="Unsupported points format"):
+        parse_points(["1 2 3,4"])
+
+
+def test_export_writes_measurement_tables(tmp_path, monkeypatch):
+    conn = fake_gateway.FakeGateway(images_per_dataset=2, rois_per_image=3, shapes_per_roi=2)
+    answers = iter(["1", "json", ""])  # dataset ID, format, one request per image
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["ROI_Export.py", "--measurements", "csv"])
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+    monkeypatch.setattr(ROI_Export, "open_connection", lambda: conn)
+    monkeypatch.setattr(ROI_Export, "close_connection", lambda conn: None)
+    ROI_Export.main()
+
+    for image_id in (1, 2):
+        table = pd.read_csv(tmp_path / "dataset_1" / f"image_{image_id}_ID{image_id}_measurements.csv")
+        assert list(table.columns) == MEASUREMENT_COLUMNS
+        assert len(table) == 6 and (table["image_id"] == image_id).all()
+        roi_ids = sorted(set(table["roi_id"]))
+        assert roi_ids == [3 * (image_id - 1) + k for k in (1, 2, 3)]
+        assert np.isfinite(table["area"]).all()